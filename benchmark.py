@@ -0,0 +1,262 @@
+from generator import Generator, iter_validate
+from replacer import Replacer
+from scraper import FixturePageSource, parse_html_page
+from utils import UTILITIES
+import argparse
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+
+SYNTAX_PATH = 'syntax_structures/syntax.json'
+MAP_PATH = 'syntax_structures/utility_map.json'
+FIXTURE_DIR = 'benchmarks/fixtures'
+# results of a full run of the committed tree, compared against by default
+BASELINE_PATH = 'benchmarks/baseline.json'
+
+
+def bench_generation(syntax_path=SYNTAX_PATH, map_path=MAP_PATH, utilities=None, limit=200000,
+                     synthetic_flags=120):
+    """Measures the generation rate and peak memory of every utility.
+
+    Each utility is generated in a freshly spawned process, so its peak resident set size is not
+    inflated by the ones before it. A synthetic utility with synthetic_flags flags stands in for
+    option spaces larger than any scraped one.
+
+    :param syntax_path: (str) A file path to retrieve syntax structure.
+    :param map_path: (str) A file path to retrieve utility, flag, arg mappings.
+    :param utilities: (optional list) of (str) utilities, defaults to every supported utility.
+    :param limit: (int) the maximum number of commands generated per utility.
+    :param synthetic_flags: (int) the number of flags of the synthetic utility, 0 to skip it.
+    :returns (dict) mapping "generation/<utility>" to its measurements.
+    """
+    cases = [(syntax_path, map_path, ut) for ut in utilities or UTILITIES]
+    with tempfile.TemporaryDirectory() as tmp:
+        if synthetic_flags:
+            cases.append(_synthetic_grammar(tmp, synthetic_flags) + ('synthetic',))
+
+        ret = {}
+        for case in cases:
+            with concurrent.futures.ProcessPoolExecutor(
+                    1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                res = pool.submit(_generation_case, *case, limit).result()
+            if res is not None:
+                ret[f"generation/{case[-1]}"] = res
+        return ret
+
+
+def _generation_case(syntax_path, map_path, utility, limit):
+    """Generates the commands of one utility and measures the rate and peak memory."""
+    gen = Generator(syntax_path, map_path, utilities=[utility])
+    if not gen.utilities or not gen._valid_utilities(utility):
+        return None
+
+    start = time.perf_counter()
+    count = sum(1 for _ in itertools.islice(gen.iter_commands(utility), limit))
+    elapsed = time.perf_counter() - start
+    return {'commands': count, 'seconds': elapsed,
+            'commands_per_sec': count / elapsed if elapsed else 0.0,
+            'peak_rss_kb': _peak_rss_kb()}
+
+
+def _synthetic_grammar(directory, n_flags):
+    """Writes the syntax structure and flag mapping of a utility with n_flags flags."""
+    syntax_path = os.path.join(directory, 'syntax.json')
+    map_path = os.path.join(directory, 'utility_map.json')
+    with open(syntax_path, 'w') as fp:
+        json.dump({'synthetic': 'synthetic [Options] [File]'}, fp)
+    with open(map_path, 'w') as fp:
+        json.dump({'synthetic': {f"-{i}": "[File]" if i % 3 == 0 else None
+                                 for i in range(n_flags)}}, fp)
+    return syntax_path, map_path
+
+
+def bench_substitution(rep_path='rep_map.json', in_path='data/generic_training.txt', scale=20,
+                       processes=1):
+    """Measures the substitution rate over a training file repeated scale times.
+
+    :param rep_path: (str) the path to a json file with the word mappings.
+    :param in_path: (str) the path to a text file of generic commands.
+    :param scale: (int) the number of copies of the file to substitute at once.
+    :param processes: (int) the number of processes to substitute with.
+    :returns (dict) mapping "substitution" to its measurements.
+    """
+    with open(in_path) as fp:
+        text = fp.read()
+    if not text.endswith("\n"):
+        text += "\n"
+
+    replacer = Replacer.from_file(rep_path)
+    with tempfile.TemporaryDirectory() as tmp:
+        scaled_path, out_path = os.path.join(tmp, 'in.txt'), os.path.join(tmp, 'out.txt')
+        with open(scaled_path, 'w') as fp:
+            for _ in range(scale):
+                fp.write(text)
+        stats = replacer.replace_file(scaled_path, out_path, processes=processes)
+    return {'substitution': stats}
+
+
+def bench_validation(syntax_path=SYNTAX_PATH, map_path=MAP_PATH, n_commands=500, workers=8,
+                     seed=0):
+    """Measures the validation rate with every utility replaced by a no-op stub.
+
+    Every utility resolves to a shell script that exits straight away, so the measurement covers
+    the cost of spawning, waiting on and collecting shells rather than the commands themselves.
+
+    :param syntax_path: (str) A file path to retrieve syntax structure.
+    :param map_path: (str) A file path to retrieve utility, flag, arg mappings.
+    :param n_commands: (int) the number of sampled commands to validate.
+    :param workers: (int) the number of commands to run concurrently.
+    :param seed: (int) the seed of the command sample.
+    :returns (dict) mapping "validation" to its measurements.
+    """
+    gen = Generator(syntax_path, map_path)
+    cmds = gen.sample_commands(gen.utilities, n_commands, random.Random(seed))
+
+    path = os.environ.get('PATH', '')
+    with tempfile.TemporaryDirectory() as stubs:
+        for ut in UTILITIES:
+            stub = os.path.join(stubs, ut)
+            with open(stub, 'w') as fp:
+                fp.write("#!/bin/sh\nexit 0\n")
+            os.chmod(stub, 0o755)
+
+        os.environ['PATH'] = stubs + os.pathsep + path
+        try:
+            start, accepted = time.perf_counter(), 0
+            for res in iter_validate(enumerate(cmds), workers=workers, timeout=5):
+                accepted += res.code == 0
+            elapsed = time.perf_counter() - start
+        finally:
+            os.environ['PATH'] = path
+
+    return {'validation': {'commands': len(cmds), 'accepted': accepted, 'workers': workers,
+                           'seconds': elapsed,
+                           'commands_per_sec': len(cmds) / elapsed if elapsed else 0.0}}
+
+
+def bench_scraping(fixture_dir=FIXTURE_DIR, repeat=20):
+    """Measures the parse time of the man pages stored in a fixture directory.
+
+    :param fixture_dir: (str) a directory of pages named like "find.1.html".
+    :param repeat: (int) the number of times every page is parsed.
+    :returns (dict) mapping "scraping" to its measurements.
+    """
+    source = FixturePageSource(fixture_dir)
+    utilities = sorted({name.split('.')[0] for name in os.listdir(fixture_dir)
+                        if name.endswith('.html')})
+    pages = [source.fetch(ut) for ut in utilities]
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for html in pages:
+            parse_html_page(html)
+    elapsed = time.perf_counter() - start
+    parsed = len(pages) * repeat
+    return {'scraping': {'pages': parsed, 'seconds': elapsed,
+                         'pages_per_sec': parsed / elapsed if elapsed else 0.0,
+                         'ms_per_page': 1000 * elapsed / parsed if parsed else 0.0}}
+
+
+def run_benchmarks(only=None, quick=False):
+    """Runs the benchmark suite.
+
+    :param only: (optional list) of (str) benchmark names, among "generation", "substitution",
+        "validation" and "scraping". Defaults to all of them.
+    :param quick: (bool) whether to run smaller inputs, e.g. for a smoke test.
+    :returns (dict) with the environment in "meta" and the measurements in "results".
+    """
+    benchmarks = {
+        'generation': lambda: bench_generation(limit=20000 if quick else 200000,
+                                               synthetic_flags=40 if quick else 120),
+        'substitution': lambda: bench_substitution(scale=2 if quick else 20),
+        'validation': lambda: bench_validation(n_commands=50 if quick else 500),
+        'scraping': lambda: bench_scraping(repeat=2 if quick else 20),
+    }
+
+    results = {}
+    for name, bench in benchmarks.items():
+        if only and name not in only:
+            continue
+        start = time.perf_counter()
+        results.update(bench())
+        print(f"Ran {name} benchmark in {time.perf_counter() - start:.1f}s")
+
+    meta = {'python': sys.version.split()[0], 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'quick': quick, 'time': time.time()}
+    return {'meta': meta, 'results': results}
+
+
+def compare(results, baseline, tolerance=0.1):
+    """Compares benchmark measurements with a baseline.
+
+    Rates ("*_per_sec") are better when higher, per page times and peak memory when lower.
+    Measurements that are worse than the baseline by more than the tolerance are regressions.
+
+    :param results: (dict) the "results" of a benchmark run.
+    :param baseline: (dict) the "results" of the baseline run.
+    :param tolerance: (float) the relative change allowed before flagging a regression.
+    :returns (list) of (dict) comparisons with the benchmark, metric, baseline and current
+        values, the relative change and whether it is a regression.
+    """
+    ret = []
+    for name, metrics in sorted(results.items()):
+        for metric, value in metrics.items():
+            base = baseline.get(name, {}).get(metric)
+            if metric not in ('peak_rss_kb', 'ms_per_page') \
+                    and not metric.endswith('_per_sec') or not base:
+                continue
+            change = (value - base) / base
+            worse = -change if metric.endswith('_per_sec') else change
+            ret.append({'benchmark': name, 'metric': metric, 'baseline': base, 'current': value,
+                        'change': change, 'regression': worse > tolerance})
+    return ret
+
+
+def _peak_rss_kb():
+    """Gets the peak resident set size of this process in kilobytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark generation, substitution, "
+                                                 "validation and man page parsing.")
+    parser.add_argument('--out', default='benchmark_results.json')
+    parser.add_argument('--baseline', default=BASELINE_PATH,
+                        help="a previous results file to compare against, '' to skip")
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--only', nargs='+',
+                        choices=['generation', 'substitution', 'validation', 'scraping'])
+    parser.add_argument('--quick', action='store_true', help="run smaller inputs")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.only, args.quick)
+    with open(args.out, 'w') as fp:
+        json.dump(report, fp, indent=2)
+    print(f"Saved results to {args.out}")
+
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        if baseline['meta'].get('quick') != args.quick:
+            print(f"Warning: {args.baseline} was not run with the same --quick setting, "
+                  f"rates are not comparable")
+        comparisons = compare(report['results'], baseline['results'], args.tolerance)
+        for c in comparisons:
+            flag = "REGRESSION" if c['regression'] else ""
+            print(f"{c['benchmark']:<28} {c['metric']:<18} {c['baseline']:>14.2f} "
+                  f"{c['current']:>14.2f} {c['change']:>+8.1%} {flag}")
+        if any(c['regression'] for c in comparisons):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,75 +1,209 @@
+import argparse
 import os
-import openai
 import json
 import time
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
-import openai
-from tenacity import (
-    retry,
-    stop_after_attempt,
-    wait_random_exponential,
-)  # for exponential backoff
-
-
-@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
-def completion_with_backoff(**kwargs):
-    return openai.Completion.create(**kwargs)
-
-with open('random_bash.txt', 'a') as the_file:
-    start=1
-    end=4000
-    prompts=["Generate bash command and do not include example: \n" for _ in range(10)]
-    for i in range(start, end):
-        response = completion_with_backoff(
-          model="text-davinci-003",
-          prompt=prompts,
-          temperature=1,
-          max_tokens=256,
-          top_p=1,
-          frequency_penalty=0,
-          presence_penalty=0
-        )
-        if (i-start) % 2 ==0:
-            print(i)
-        for k in range(10):
-            cmd=response.choices[k].text
-            if cmd.startswith("\n"):
-                if "\n" not in cmd[1:]:
-                    the_file.write(cmd[1:]+"\n")
-
-
-# with open('valid_bash2.txt') as the_file2:
-#     content_list = [line for line in the_file2]
-
-with open('/Users/Desktop/chatgpt-api/nl2bash-data.json') as user_file:
-  file_contents = user_file.read()
-parsed_json = json.loads(file_contents)
-
-with open('/Users/Desktop/chatgpt-api/nl2bash-data_new_eng.json', 'a') as the_file:
-    end=10348
-    start=10338
-    step=10
-    for i in range(start, end, step):
-        prompts = []
-        for k in range(i, i+10):
-            prompt="Translate to english:\n"+parsed_json[str(k)]["cmd"]+"\n"
-            prompts.append(prompt)
-        response = completion_with_backoff(
-          model="text-davinci-003",
-          prompt=prompts,
-          temperature=0,
-          max_tokens=256,
-          top_p=1,
-          frequency_penalty=0,
-          presence_penalty=0
-        )
-        if (i-start) % 20 ==0:
-            print(i)
-        for choice in response.choices:
-            invocation=choice.text
-            if invocation.startswith("\n"):
-                invocation=invocation[1:]
-            my_json_string = json.dumps({'invocation': invocation, 'cmd': prompts[choice.index][22:-1]})
-            the_file.write("\"" + str(choice.index + i+1) + "\": " + my_json_string + ",\n")
+from corpus import CorpusWriter, PairCorpus, iter_legacy_records
+from journal import Journal
+from llm_cache import ResponseCache
+from llm_client import LLMRunner, OpenAIBackend, HTTPBackend, MockServer
+from metrics import METRICS, Progress, configure, sinks_from_paths
 
+GENERATE_PROMPT = "Generate bash command and do not include example: \n"
+TRANSLATE_PROMPT = "Translate to english:\n"
+
+COMPLETION_PARAMS = dict(
+    model="text-davinci-003",
+    max_tokens=256,
+    top_p=1,
+    frequency_penalty=0,
+    presence_penalty=0
+)
+
+
+def generate_bash(runner, out_path='random_bash.txt', n_prompts=40000, ledger_path=None,
+                  chunk_size=1000):
+    """Prompts for random bash commands and writes the single line answers to a file.
+
+    Progress is recorded in a job ledger after every chunk of prompts, so a killed job resumes
+    with the prompts it had not finished.
+
+    :param runner: (LLMRunner) the runner to send the prompts through.
+    :param out_path: (str) the path of the file to write the generated commands to.
+    :param n_prompts: (int) the number of prompts to send.
+    :param ledger_path: (optional str) the path of the job ledger, defaults to the output path
+        with a ".ledger" suffix.
+    :param chunk_size: (int) the number of prompts to complete between ledger writes.
+    """
+    with Journal(ledger_path or out_path + ".ledger") as ledger:
+        done = ledger.completed()
+        todo = [i for i in range(n_prompts) if i not in done]
+        print(f"{len(done)} prompts already completed, {len(todo)} remaining")
+
+        start = time.perf_counter()
+        progress, completed = Progress("generate", total=len(todo)), 0
+        for chunk in _chunks(todo, chunk_size):
+            texts = runner.run([GENERATE_PROMPT for _ in chunk], temperature=1,
+                               **COMPLETION_PARAMS)
+            for i, cmd in zip(chunk, texts):
+                if cmd.startswith("\n") and "\n" not in cmd[1:]:
+                    METRICS.inc('llm_answers_total', outcome='accepted')
+                    ledger.append(i, cmd=cmd[1:])
+                else:
+                    METRICS.inc('llm_answers_total', outcome='rejected')
+                    ledger.append(i, cmd=None)
+            ledger.sync()
+            completed += len(chunk)
+            progress.update(completed)
+        progress.close()
+
+        with open(out_path, 'w') as the_file:
+            for record in sorted(ledger.replay(), key=lambda r: r['index']):
+                if record['cmd'] is not None:
+                    the_file.write(record['cmd'] + "\n")
+
+    _report(runner, len(todo), time.perf_counter() - start)
+
+
+def translate_commands(runner, data_path, out_path, start=None, end=None, ledger_path=None,
+                       chunk_size=1000):
+    """Translates the commands of a dataset to English.
+
+    Progress is recorded in a job ledger after every chunk of prompts, so a killed job resumes
+    exactly where it stopped, and the output file is rebuilt from the ledger at the end.
+
+    :param runner: (LLMRunner) the runner to send the prompts through.
+    :param data_path: (str) the path of a json file mapping indices to {"cmd": ...} records, or
+        of a ".jsonl" pair corpus.
+    :param out_path: (str) the path of the json file mapping indices to {"invocation", "cmd"}
+        records to write, or of a ".jsonl" pair corpus to create.
+    :param start: (optional int) the first dataset key to translate, defaults to the smallest
+        key. Keys are the ids of a json file and the positions of a pair corpus.
+    :param end: (optional int) the dataset key to stop at, defaults to past the largest key.
+    :param ledger_path: (optional str) the path of the job ledger, defaults to the output path
+        with a ".ledger" suffix.
+    :param chunk_size: (int) the number of prompts to complete between ledger writes.
+    """
+    if data_path.endswith('.jsonl'):
+        corpus = PairCorpus(data_path)
+        keys = range(len(corpus))
+        dataset = corpus.__getitem__
+    else:
+        corpus = None
+        records = dict(iter_legacy_records(data_path))
+        keys = sorted(records)
+        dataset = records.__getitem__
+    if start is None:
+        start = keys[0] if keys else 0
+    if end is None:
+        end = keys[-1] + 1 if keys else 0
+
+    with Journal(ledger_path or out_path + ".ledger") as ledger:
+        done = ledger.completed()
+        todo = [k for k in keys if start <= k < end and k not in done]
+        print(f"{len(done)} commands already translated, {len(todo)} remaining")
+
+        began = time.perf_counter()
+        progress, completed = Progress("translate", total=len(todo)), 0
+        for chunk in _chunks(todo, chunk_size):
+            rows = [dataset(k) for k in chunk]
+            texts = runner.run([TRANSLATE_PROMPT + row["cmd"] + "\n" for row in rows],
+                               temperature=0, **COMPLETION_PARAMS)
+            for k, row, invocation in zip(chunk, rows, texts):
+                if invocation.startswith("\n"):
+                    invocation = invocation[1:]
+                ledger.append(k, id=row.get('id', k) if corpus is not None else k,
+                              invocation=invocation, cmd=row["cmd"])
+            ledger.sync()
+            completed += len(chunk)
+            progress.update(completed)
+        progress.close()
+
+        records = sorted(ledger.replay(), key=lambda r: r['index'])
+        if out_path.endswith('.jsonl'):
+            if os.path.exists(out_path):
+                os.remove(out_path)
+            with CorpusWriter(out_path) as writer:
+                for r in records:
+                    writer.append(r['invocation'], r['cmd'], id=r['id'])
+        else:
+            with open(out_path, 'w') as the_file:
+                the_file.write("{\n")
+                the_file.write(",\n".join(
+                    "\"" + str(r['id']) + "\": " +
+                    json.dumps({'invocation': r['invocation'], 'cmd': r['cmd']}) for r in records))
+                the_file.write("\n}\n")
+    if corpus is not None:
+        corpus.close()
+
+    _report(runner, len(todo), time.perf_counter() - began)
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _report(runner, n_prompts, elapsed):
+    stats = runner.stats()
+    print(f"Completed {n_prompts} prompts in {stats['requests']} requests over {elapsed:.1f}s "
+          f"({n_prompts / elapsed if elapsed else 0:.1f} prompts/sec), "
+          f"{stats['rate_limited']} requests rate limited, {stats['errors']} failed and retried")
+    if runner.cache is not None:
+        print(f"Response cache hit rate {stats['cache_hit_rate']:.1%}, "
+              f"{stats['saved_requests']} requests saved")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate bash commands and their English "
+                                                 "translations with a completions API.")
+    parser.add_argument('task', choices=['generate', 'translate'])
+    parser.add_argument('--backend', choices=['openai', 'http', 'mock'], default='openai')
+    parser.add_argument('--url', help="completions endpoint for the http backend")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--rpm', type=float, default=3000, help="maximum requests per minute")
+    parser.add_argument('--tpm', type=float, default=250000, help="maximum tokens per minute")
+    parser.add_argument('--prompts', type=int, default=40000, help="prompts to generate with")
+    parser.add_argument('--data', default='nl2bash-data.json', help="dataset to translate")
+    parser.add_argument('--start', type=int)
+    parser.add_argument('--end', type=int)
+    parser.add_argument('--out')
+    parser.add_argument('--ledger', help="job ledger, defaults to the output path + .ledger")
+    parser.add_argument('--cache', default='llm_cache.db', help="response cache database")
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--metrics-jsonl', help="JSON lines file to log metrics and progress to")
+    parser.add_argument('--metrics-prom', help="Prometheus text file to write metrics to")
+    args = parser.parse_args()
+
+    sinks = sinks_from_paths(args.metrics_jsonl, args.metrics_prom)
+    if sinks:
+        configure(sinks)
+
+    mock = None
+    if args.backend == 'openai':
+        backend = OpenAIBackend(os.getenv("OPENAI_API_KEY"))
+    elif args.backend == 'http':
+        backend = HTTPBackend(args.url, os.getenv("OPENAI_API_KEY"))
+    else:
+        mock = MockServer().start()
+        backend = HTTPBackend(mock.url)
+
+    cache = None if args.no_cache else ResponseCache(args.cache)
+    runner = LLMRunner(backend, concurrency=args.concurrency, requests_per_minute=args.rpm,
+                       tokens_per_minute=args.tpm, cache=cache)
+    try:
+        if args.task == 'generate':
+            generate_bash(runner, args.out or 'random_bash.txt', args.prompts, args.ledger)
+        else:
+            translate_commands(runner, args.data, args.out or 'nl2bash-data_new_eng.json',
+                               args.start, args.end, args.ledger)
+    finally:
+        METRICS.flush()
+        if cache:
+            cache.close()
+        if mock:
+            mock.stop()
+
+
+if __name__ == '__main__':
+    main()
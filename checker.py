@@ -0,0 +1,278 @@
+from utils import ARG_TYPES
+import collections
+import json
+import re
+
+try:
+    import bashlex
+except ImportError:
+    bashlex = None
+
+
+SHORT_NUMBER = re.compile(r"-\d+$")
+PUNCTUATION = set('();<>|&')
+# splits commands without any quoting into words and runs of punctuation
+SIMPLE_TOKEN = re.compile(r"[();<>|&]+|[^\s();<>|&]+")
+SEPARATORS = {'|', '||', '&&', ';', '&', ';;', '|&'}
+NESTED_COMMAND_FLAGS = {'-exec', '-execdir', '-ok', '-okdir'}
+SUBSTITUTIONS = ('$(', '`', '<(', '>(')
+# operators of find expressions, which take no argument of their own
+FIND_OPERATORS = {'-a', '-and', '-o', '-or', '-not', ',', '!', '(', ')'}
+
+
+class StaticChecker:
+    def __init__(self, syntax_path='syntax.json', map_path='utility_map.json', arg_types=None,
+                 use_bashlex=False, rep_path=None):
+        """Initializes a checker that rejects malformed commands without running them.
+
+        Commands are tokenized in process and every stage of a pipeline or command list that
+        starts with a known utility has its flags checked against the utility mappings. Long
+        options missing from the mappings and find operators are not rejected, only counted, see
+        `warnings`.
+
+        :param syntax_path: (str) a file path to retrieve syntax structure.
+        :param map_path: (str) a file path to retrieve utility, flag, arg mappings.
+        :param arg_types: (list) of (str) argument types that require a value. Defaults to the
+            list in utils.py.
+        :param use_bashlex: (bool) whether to also reject commands bashlex cannot parse. Much
+            slower than the other checks and requires bashlex to be installed.
+        :param rep_path: (optional str) a file path to the word mappings, whose keys are
+            placeholders as well as the argument types.
+        """
+        with open(syntax_path) as fp:
+            self.syntax = json.load(fp)
+
+        with open(map_path) as fp:
+            self.mappings = json.load(fp)
+
+        if use_bashlex and bashlex is None:
+            raise ImportError("bashlex is required to parse commands with use_bashlex")
+
+        self.arg_types = set(ARG_TYPES if arg_types is None else arg_types)
+        placeholders = set(ARG_TYPES) | self.arg_types
+        if rep_path is not None:
+            with open(rep_path) as fp:
+                placeholders |= set(json.load(fp))
+        self.placeholder = re.compile("|".join(map(re.escape, sorted(placeholders))))
+        self.use_bashlex = use_bashlex
+        self.counts = collections.Counter()
+        self.unmapped = collections.Counter()
+
+    def check(self, cmd):
+        """Finds the reason a command is malformed, if any.
+
+        :param cmd: (str) the concrete command to check.
+        :returns (str) the reason the command was rejected, or None if it passed every check.
+        """
+        reason = self._classify(cmd)
+        self.counts[reason or 'passed'] += 1
+        return reason
+
+    def filter(self, cmds):
+        """Lazily filters out malformed commands.
+
+        :param cmds: (iterable) of (str) concrete commands.
+        :returns a generator of (str) commands that passed every check.
+        """
+        for cmd in cmds:
+            if self.check(cmd) is None:
+                yield cmd
+
+    def rejections(self):
+        """Gets the number of commands rejected for each reason.
+
+        :returns (dict) mapping each rejection reason to its number of commands.
+        """
+        return {reason: count for reason, count in self.counts.items() if reason != 'passed'}
+
+    def warnings(self):
+        """Gets the number of words that were let through without a flag mapping, by kind.
+
+        :returns (dict) mapping "unknown_long_option" and "find_operator" to their number of
+            words.
+        """
+        return dict(self.unmapped)
+
+    def _classify(self, cmd):
+        """Runs every check on a command without counting the outcome."""
+        if not cmd.strip():
+            return 'empty_command'
+        if self.placeholder.search(cmd):
+            return 'unresolved_placeholder'
+
+        if self.use_bashlex:
+            try:
+                bashlex.parse(cmd)
+            except Exception:
+                return 'parse_error'
+
+        if any(sub in cmd for sub in SUBSTITUTIONS):
+            # words inside substitutions cannot be attributed to a utility without a full parse
+            return None
+
+        try:
+            tokens = tokenize(cmd)
+        except ValueError:
+            return 'unbalanced_quotes'
+
+        stage = []
+        for token in tokens + [';']:
+            if token in SEPARATORS and type(token) is str:
+                reason = self._check_stage(stage)
+                if reason:
+                    return reason
+                stage = []
+            else:
+                stage.append(token)
+        return None
+
+    def _check_stage(self, tokens):
+        """Checks the flags of a single simple command.
+
+        :param tokens: (list) of (str) the words of the command.
+        :returns (str) the reason the command was rejected, or None.
+        """
+        if tokens and tokens[0] == 'sudo':
+            tokens = tokens[1:]
+        if not tokens or tokens[0] not in self.mappings:
+            return None
+
+        utility = tokens[0]
+        flags = self.mappings[utility]
+        # the first operand of utilities like xargs starts the command they run
+        runs_command = '[Command]' in self.syntax.get(utility, '')
+
+        i = 1
+        while i < len(tokens):
+            token = tokens[i]
+            i += 1
+            if not token:
+                continue
+            if type(token) is str and (token[0] in '<>' or token[-1] in '<>'):
+                # redirection, the following word is its target
+                i += 1
+                continue
+            if token == '--' or token in self.mappings or token in NESTED_COMMAND_FLAGS:
+                # end of options or start of a nested command
+                return None
+            if token[0] != '-' or token == '-':
+                if runs_command:
+                    return None
+                continue
+            if '$' in token or SHORT_NUMBER.match(token):
+                continue
+
+            flag = token.split('=')[0] if token.startswith('--') else token
+            if utility == 'find' and flag in FIND_OPERATORS:
+                if flag not in flags:
+                    self.unmapped['find_operator'] += 1
+                continue
+            if flag in flags:
+                if flags[flag] and '=' not in token:
+                    if i >= len(tokens) or type(tokens[i]) is str and tokens[i][0] in '<>':
+                        # scraped argument types may be wrong, only trust the predefined ones
+                        if flags[flag] in self.arg_types:
+                            return 'missing_argument'
+                        continue
+                    i += 1
+            elif token.startswith('--'):
+                self.unmapped['unknown_long_option'] += 1
+            elif not self._is_short_cluster(token, flags):
+                return 'unknown_flag'
+        return None
+
+    @staticmethod
+    def _is_short_cluster(token, flags):
+        """Determines whether a token is several short flags or a short flag with its value.
+
+        :param token: (str) a word starting with a single hyphen, e.g. "-la" or "-n5".
+        :param flags: (dict) the flag, arg mappings of the utility.
+        :returns (bool) whether the token is made of known short flags.
+        """
+        if token.startswith('--') or token[:2] not in flags:
+            return False
+        for char in token[1:]:
+            if not char.isalpha():
+                # the rest of the word is the value of the previous flag
+                return True
+            flag = "-" + char
+            if flag not in flags:
+                return False
+            if flags[flag]:
+                return True
+        return True
+
+
+def tokenize(cmd):
+    """Splits a command into words and operators.
+
+    :param cmd: (str) the command to split.
+    :returns (list) of (str) tokens. Words with quoted characters are `Word` instances, so they
+        are never mistaken for operators.
+    :raises ValueError: if a quote is not closed.
+    """
+    if '"' in cmd or "'" in cmd or '\\' in cmd:
+        return _tokenize(cmd)
+    return SIMPLE_TOKEN.findall(cmd)
+
+
+class Word(str):
+    """A word that contained quoting, so it can never be an operator."""
+
+
+def _tokenize(cmd):
+    """Splits a command into words and operators, honouring quotes and backslash escapes.
+
+    :param cmd: (str) the command to split.
+    :returns (list) of (str) tokens. Words with quoted characters are `Word` instances.
+    :raises ValueError: if a quote is not closed.
+    """
+    tokens, word, quoted = [], [], False
+    i, n = 0, len(cmd)
+
+    def end_word():
+        if word or quoted:
+            text = "".join(word)
+            tokens.append(Word(text) if quoted else text)
+        word.clear()
+
+    while i < n:
+        char = cmd[i]
+        if char == '\\' and i + 1 < n:
+            word.append(cmd[i + 1])
+            quoted = True
+            i += 2
+        elif char == "'":
+            close = cmd.find("'", i + 1)
+            if close < 0:
+                raise ValueError("no closing quotation")
+            word.append(cmd[i + 1:close])
+            quoted = True
+            i = close + 1
+        elif char == '"':
+            i += 1
+            while i < n and cmd[i] != '"':
+                if cmd[i] == '\\' and i + 1 < n and cmd[i + 1] in '"\\$`':
+                    i += 1
+                word.append(cmd[i])
+                i += 1
+            if i >= n:
+                raise ValueError("no closing quotation")
+            quoted = True
+            i += 1
+        elif char.isspace():
+            end_word()
+            quoted = False
+            i += 1
+        elif char in PUNCTUATION:
+            end_word()
+            quoted = False
+            start = i
+            while i < n and cmd[i] in PUNCTUATION:
+                i += 1
+            tokens.append(cmd[start:i])
+        else:
+            word.append(char)
+            i += 1
+    end_word()
+    return tokens
@@ -0,0 +1,342 @@
+from checker import tokenize
+from journal import read_records
+import argparse
+import collections
+
+import numpy as np
+
+# bumped whenever the model file layout changes
+MODEL_VERSION = 1
+
+
+class FlagCompatibility:
+    def __init__(self):
+        """Initializes an empty model of the flags that cannot be combined, per utility.
+
+        For every utility the model holds its flag names and three bit matrices, packed eight
+        flags per byte: conflicts[i, j] is set when flags i and j make a command fail together,
+        requires[i, j] when flag j is one of the flags flag i fails without, and dependent[i]
+        when flag i fails without one of the flags in requires[i] (with no flags in requires[i],
+        flag i always fails). It also keeps the validation outcomes it was learned from, to
+        predict the acceptance rate of the commands it does not prune.
+
+        Build one with `learn`, or `load` a saved one.
+        """
+        self.flags = {}
+        self.conflicts = {}
+        self.requires = {}
+        self.dependent = {}
+        self.stats = {}
+
+    def __contains__(self, utility):
+        return utility in self.flags
+
+    @classmethod
+    def learn(cls, outcomes, generator, min_support=5, threshold=0.05, corpus=None):
+        """Learns the conflicts and requirements of flags from validation outcomes.
+
+        Flags i and j conflict when at least min_support commands combine them, at most a
+        threshold share of those were accepted, and each flag was accepted more often than
+        that without the other. A flag is dependent when at least min_support commands hold it
+        without a conflicting flag or any flag it was accepted with, and at most a threshold
+        share of those were accepted. Timed out commands are not outcomes of their flags and
+        should be left out.
+
+        :param outcomes: (iterable) of (str, bool) tuples of a generated command, generic or
+            with its words replaced, and whether it was accepted, e.g. from `journal_outcomes`.
+        :param generator: (Generator) the generator the commands came from, for the flags of
+            every utility.
+        :param min_support: (int) the number of commands needed to learn a conflict or
+            requirement.
+        :param threshold: (float) the acceptance rate at or below which flags are doomed.
+        :param corpus: (optional CorpusStats) statistics of training commands. Flags used
+            together in the training commands are never learned as conflicting.
+        :returns (FlagCompatibility) the model.
+        """
+        names = {ut: flag_names(generator._valid_flags(ut)) for ut in generator.utilities}
+        rows = collections.defaultdict(list)
+        for cmd, accepted in outcomes:
+            ut, flags = command_flags(cmd, names)
+            if ut is not None:
+                rows[ut].append((flags, accepted))
+
+        model = cls()
+        for ut, observed in sorted(rows.items()):
+            flags = names[ut]
+            index = {name: i for i, name in enumerate(flags)}
+            x = np.zeros((len(observed), len(flags)), dtype=np.float32)
+            for r, (used, _) in enumerate(observed):
+                x[r, [index[name] for name in used]] = 1
+            y = np.array([accepted for _, accepted in observed], dtype=np.float32)
+
+            conflicts = _learn_conflicts(x, y, min_support, threshold)
+            if corpus is not None:
+                seen, together = corpus.cooccurrence(ut)
+                known = [index[name] for name in seen if name in index]
+                rows_seen = [i for i, name in enumerate(seen) if name in index]
+                conflicts[np.ix_(known, known)] &= together[np.ix_(rows_seen, rows_seen)] == 0
+            requires, dependent = _learn_requirements(x, y, conflicts, min_support, threshold)
+
+            model.add(ut, flags, conflicts, requires, dependent)
+            kept = model._kept(ut, x.astype(bool))
+            model.stats[ut] = np.array([len(y), y.sum(), kept.sum(), y[kept].sum()],
+                                       dtype=np.int64)
+        return model
+
+    def add(self, utility, flags, conflicts, requires, dependent):
+        """Sets the model of a utility.
+
+        :param utility: (str) the utility.
+        :param flags: (list) of (str) flag names, e.g. "-name".
+        :param conflicts: (numpy.ndarray) symmetric boolean matrix of conflicting flags.
+        :param requires: (numpy.ndarray) boolean matrix of the flags each flag needs one of.
+        :param dependent: (numpy.ndarray) boolean vector of the flags that need another flag.
+        """
+        self.flags[utility] = list(flags)
+        self.conflicts[utility] = np.packbits(conflicts, axis=1, bitorder='little')
+        self.requires[utility] = np.packbits(requires, axis=1, bitorder='little')
+        self.dependent[utility] = np.packbits(dependent, bitorder='little')
+        self.stats.setdefault(utility, np.zeros(4, dtype=np.int64))
+
+    def bitsets(self, utility, flags):
+        """Gets the conflicts and requirements of rendered flags as bitsets.
+
+        :param utility: (str) the utility.
+        :param flags: (list) of (str) flags rendered with their argument types, as passed to the
+            option space, e.g. ["-delete", "-fls [File]"].
+        :returns (tuple) of two (list) with an entry per flag: the (int) bitset of the flags it
+            conflicts with, and the (int) bitset of the flags it needs one of or None, as
+            expected by `CompatibleOptionSpace`. Flags unknown to the model are unconstrained.
+        """
+        if utility not in self.flags:
+            return [0] * len(flags), [None] * len(flags)
+        index = {name: i for i, name in enumerate(self.flags[utility])}
+        known = [index.get(name) for name in flag_names(flags)]
+
+        n = len(self.flags[utility])
+        conflicts = np.unpackbits(self.conflicts[utility], axis=1, count=n, bitorder='little')
+        requires = np.unpackbits(self.requires[utility], axis=1, count=n, bitorder='little')
+        dependent = np.unpackbits(self.dependent[utility], count=n, bitorder='little')
+
+        def bitset(row):
+            return sum(1 << j for j, k in enumerate(known) if k is not None and row[k])
+
+        conflict_sets, require_sets = [], []
+        for k in known:
+            conflict_sets.append(bitset(conflicts[k]) if k is not None else 0)
+            require_sets.append(bitset(requires[k]) if k is not None and dependent[k] else None)
+        return conflict_sets, require_sets
+
+    def acceptance_rate(self, utility=None):
+        """Predicts the share of the commands kept by the model that validation accepts.
+
+        The prediction is the acceptance rate of the learned outcomes the model would have kept.
+
+        :param utility: (optional str) the utility, defaults to all utilities pooled.
+        :returns (float) the predicted acceptance rate, or None without outcomes to predict from.
+        """
+        stats = self.stats.get(utility) if utility is not None \
+            else sum(self.stats.values(), np.zeros(4, dtype=np.int64))
+        if stats is None or not stats[2]:
+            return None
+        return float(stats[3] / stats[2])
+
+    def summary(self, utility):
+        """Summarizes the model of a utility.
+
+        :param utility: (str) the utility.
+        :returns (dict) with the number of flags, conflicting pairs and dependent flags, and of
+            learned outcomes, accepted outcomes, outcomes the model keeps and kept outcomes that
+            were accepted.
+        """
+        n = len(self.flags[utility])
+        conflicts = np.unpackbits(self.conflicts[utility], axis=1, count=n, bitorder='little')
+        dependent = np.unpackbits(self.dependent[utility], count=n, bitorder='little')
+        observed, accepted, kept, kept_accepted = self.stats[utility].tolist()
+        return {'flags': n, 'conflicts': int(conflicts.sum()) // 2,
+                'dependent': int(dependent.sum()), 'observed': observed, 'accepted': accepted,
+                'kept': kept, 'kept_accepted': kept_accepted}
+
+    def save(self, path):
+        """Saves the model to a ".npz" file.
+
+        :param path: (str) the path of the file.
+        """
+        arrays = {'version': np.array(MODEL_VERSION)}
+        for ut in self.flags:
+            arrays[f"{ut}:flags"] = np.array(self.flags[ut], dtype=str)
+            arrays[f"{ut}:conflicts"] = self.conflicts[ut]
+            arrays[f"{ut}:requires"] = self.requires[ut]
+            arrays[f"{ut}:dependent"] = self.dependent[ut]
+            arrays[f"{ut}:stats"] = self.stats[ut]
+        with open(path, 'wb') as fp:
+            np.savez_compressed(fp, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a model saved with `save`.
+
+        :param path: (str) the path of the file.
+        :returns (FlagCompatibility) the model.
+        """
+        model = cls()
+        with np.load(path) as data:
+            if int(data['version']) != MODEL_VERSION:
+                raise ValueError(f"{path} is not a version {MODEL_VERSION} flag model")
+            for name in data.files:
+                ut, sep, field = name.rpartition(':')
+                if not sep:
+                    continue
+                if field == 'flags':
+                    model.flags[ut] = data[name].tolist()
+                else:
+                    getattr(model, field)[ut] = data[name]
+        return model
+
+    def _kept(self, utility, x):
+        """Checks which commands, given as a boolean matrix of their flags, the model keeps."""
+        n = len(self.flags[utility])
+        conflicts = np.unpackbits(self.conflicts[utility], axis=1, count=n, bitorder='little')
+        requires = np.unpackbits(self.requires[utility], axis=1, count=n, bitorder='little')
+        dependent = np.unpackbits(self.dependent[utility], count=n, bitorder='little')
+        xf = x.astype(np.float32)
+
+        clash = ((xf @ conflicts.astype(np.float32)) * xf).sum(axis=1) > 0
+        met = (xf @ requires.T.astype(np.float32)) > 0
+        unmet = (x & dependent.astype(bool) & ~met).any(axis=1)
+        return ~clash & ~unmet
+
+
+def _learn_conflicts(x, y, min_support, threshold):
+    """Finds the pairs of flags that fail together but not apart."""
+    total = x.T @ x
+    accepted = x.T @ (x * y[:, None])
+    single, single_accepted = np.diag(total), np.diag(accepted)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # the acceptance rate of flag i in the commands without flag j
+        apart = single - total
+        rate_apart = np.where(apart >= min_support, (single_accepted[:, None] - accepted) / apart,
+                              0.0)
+        failing = (total >= min_support) & (accepted <= threshold * total)
+    conflicts = failing & (rate_apart > threshold) & (rate_apart.T > threshold)
+    np.fill_diagonal(conflicts, False)
+    return conflicts
+
+
+def _learn_requirements(x, y, conflicts, min_support, threshold):
+    """Finds the flags that fail unless combined with one of the flags they succeeded with."""
+    n = x.shape[1]
+    total = x.T @ x
+    accepted = x.T @ (x * y[:, None])
+    partners = (total >= min_support) & (accepted > threshold * total)
+    np.fill_diagonal(partners, False)
+
+    present = x.astype(bool)
+    requires = np.zeros((n, n), dtype=bool)
+    dependent = np.zeros(n, dtype=bool)
+    for i in range(n):
+        others = partners[i] | conflicts[i]
+        alone = present[:, i] & ~present[:, others].any(axis=1)
+        if alone.sum() >= min_support and y[alone].sum() <= threshold * alone.sum():
+            dependent[i] = True
+            requires[i] = partners[i]
+    return requires, dependent
+
+
+def flag_names(flags):
+    """Gets the names of flags rendered with their argument types.
+
+    :param flags: (list) of (str) rendered flags, e.g. ["-delete", "-fls [File]"].
+    :returns (list) of (str) flag names, e.g. ["-delete", "-fls"].
+    """
+    return [flag.split(' ')[0] for flag in flags]
+
+
+def command_flags(cmd, names):
+    """Finds the utility of a generated command and the flags of it the command uses.
+
+    :param cmd: (str) the command, generic or with its words replaced, optionally run with sudo.
+    :param names: (dict) mapping utilities to their (list) of (str) flag names.
+    :returns (tuple) of the (str) utility, or None when it is not in names, and the sorted
+        (list) of (str) names of its flags in the command.
+    """
+    try:
+        tokens = tokenize(cmd.strip())
+    except ValueError:
+        tokens = cmd.split()
+    if tokens[:1] == ['sudo']:
+        tokens = tokens[1:]
+    if not tokens or tokens[0] not in names:
+        return None, []
+    known = set(names[tokens[0]])
+    return tokens[0], sorted({t for t in tokens[1:] if type(t) is str and t in known})
+
+
+def journal_outcomes(cmds_path, journal_path):
+    """Reads the validation outcomes recorded by `validate_commands`.
+
+    :param cmds_path: (str) the path of the commands that were validated.
+    :param journal_path: (str) the path of the validation journal, which is only read, so it
+        may belong to a validation still running.
+    :returns a generator of (str, bool) tuples of every command that did not time out and
+        whether it was accepted.
+    """
+    with open(cmds_path) as fp:
+        cmds = fp.read().split('\n')
+    # read without opening a Journal, which would truncate the last record of a running job
+    for record in read_records(journal_path):
+        if not record.get('timed_out') and record['index'] < len(cmds):
+            yield cmds[record['index']], record['code'] == 0
+
+
+def cache_outcomes(cmds, cache, sudo=False, timeout=0.25):
+    """Looks up the validation outcomes of commands in a validation cache.
+
+    :param cmds: (iterable) of (str) commands.
+    :param cache: (ValidationCache) the cache, opened with the fixture version the commands
+        were validated with.
+    :param sudo: (bool) whether the commands were run as a root user.
+    :param timeout: (float) the timeout the commands were run with.
+    :returns a generator of (str, bool) tuples of every cached command that did not time out
+        and whether it was accepted.
+    """
+    for cmd in cmds:
+        hit = cache.get(" ".join(["sudo", cmd]) if sudo else cmd, sudo, timeout)
+        if hit is not None and not hit[2]:
+            yield cmd, hit[0] == 0
+
+
+def main():
+    from corpus_stats import CorpusStats
+    from generator import Generator
+
+    parser = argparse.ArgumentParser(description="Learn which flags cannot be combined from "
+                                                 "validation outcomes.")
+    parser.add_argument('--commands', required=True, help="the commands that were validated")
+    parser.add_argument('--journal', required=True, help="the journal of their validation")
+    parser.add_argument('--out', default='flag_model.npz')
+    parser.add_argument('--syntax-path', default='syntax.json')
+    parser.add_argument('--map-path', default='utility_map.json')
+    parser.add_argument('--corpus', nargs='*', help="training commands whose flag pairs are "
+                                                    "never learned as conflicting")
+    parser.add_argument('--min-support', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=0.05)
+    args = parser.parse_args()
+
+    generator = Generator(args.syntax_path, args.map_path)
+    corpus = CorpusStats(args.corpus) if args.corpus else None
+    model = FlagCompatibility.learn(journal_outcomes(args.commands, args.journal), generator,
+                                    args.min_support, args.threshold, corpus)
+    model.save(args.out)
+
+    for ut in model.flags:
+        s = model.summary(ut)
+        rate = model.acceptance_rate(ut)
+        print(f"{ut:<12} {s['conflicts']:>5} conflicts {s['dependent']:>4} dependent flags, "
+              f"kept {s['kept']}/{s['observed']} outcomes, predicted acceptance "
+              f"{'n/a' if rate is None else f'{rate:.1%}'}")
+    print(f"Saved flag model to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+import argparse
+import array
+import fcntl
+import json
+import mmap
+import os
+import re
+import sys
+
+# one "N": {...} record per line, as written by chatGPT_generate.py
+LEGACY_RECORD = re.compile(r'\s*"(\d+)":\s*(\{.*\})\s*,?\s*$')
+
+INDEX_MAGIC = b'BGPAIRS1'
+INDEX_SUFFIX = '.idx'
+
+
+class PairCorpus:
+    def __init__(self, path):
+        """Opens a corpus of natural language and bash command pairs for random access.
+
+        The corpus is a JSON lines file with one {"id", "invocation", "cmd"} record per line,
+        next to a sidecar index holding the byte offset of every record as little endian 64 bit
+        integers after an 8 byte header. Both files are memory mapped, so opening the corpus
+        reads neither, and record i is found with one lookup in the index. An index that is
+        missing or does not cover the whole corpus is rebuilt first.
+
+        :param path: (str) the path of the corpus.
+        """
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+        if not _index_matches(path, self.index_path):
+            build_index(path)
+
+        self._fp = open(path, 'rb')
+        self._index_fp = open(self.index_path, 'rb')
+        self._data = _map(self._fp)
+        self._index = _map(self._index_fp)
+        self._view = memoryview(self._index) if self._index is not None else None
+        self._offsets = _offsets(self._view)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, i):
+        """Reads one record.
+
+        :param i: (int) the position of the record, negative positions count from the end.
+        :returns (dict) the record.
+        """
+        if i < 0:
+            i += len(self._offsets)
+        if not 0 <= i < len(self._offsets):
+            raise IndexError("corpus index out of range")
+        start = self._offsets[i]
+        return json.loads(self._data[start:self._data.find(b"\n", start)])
+
+    def __iter__(self):
+        for i in range(len(self._offsets)):
+            yield self[i]
+
+    def close(self):
+        """Closes the memory maps and files of the corpus."""
+        for view in (self._offsets, self._view):
+            if isinstance(view, memoryview):
+                view.release()
+        self._offsets = ()
+        for obj in (self._data, self._index, self._fp, self._index_fp):
+            if obj is not None:
+                obj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CorpusWriter:
+    def __init__(self, path, sync_every=1000):
+        """Opens a corpus for appending records, creating it if it does not exist.
+
+        Only one writer can hold a corpus at a time. A record is written to the corpus before
+        its offset is written to the index, so after a crash the corpus may hold a partial line
+        or records missing from the index. Both are repaired when the corpus is opened again,
+        by dropping the partial line and indexing the missing records.
+
+        :param path: (str) the path of the corpus.
+        :param sync_every: (int) the number of records to append between syncs to disk.
+        """
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+        self.sync_every = sync_every
+        self._unsynced = 0
+
+        self.fp = open(path, 'ab')
+        try:
+            fcntl.flock(self.fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.fp.close()
+            raise RuntimeError(f"{path} is already open for writing")
+
+        _truncate_partial_record(path)
+        if not _index_matches(path, self.index_path):
+            build_index(path)
+        self.index_fp = open(self.index_path, 'ab')
+        self.offset = os.path.getsize(path)
+        self.count = (os.path.getsize(self.index_path) - len(INDEX_MAGIC)) // 8
+        # one past the highest id stored, found on the first append that needs it
+        self._next_id = None
+
+    def append(self, invocation, cmd, **fields):
+        """Appends a pair to the corpus.
+
+        :param invocation: (str) the natural language description.
+        :param cmd: (str) the bash command.
+        :param fields: other JSON serializable values to store, e.g. the legacy id. The id
+            defaults to one past the highest id in the corpus, so it is never reused.
+        :returns (int) the position of the record.
+        """
+        if 'id' not in fields:
+            if self._next_id is None:
+                self._next_id = _next_id(self.path)
+            fields['id'] = self._next_id
+        if self._next_id is not None and type(fields['id']) is int:
+            self._next_id = max(self._next_id, fields['id'] + 1)
+        line = (json.dumps(dict(fields, invocation=invocation, cmd=cmd)) + "\n").encode()
+        self.fp.write(line)
+        self.fp.flush()
+        self.index_fp.write(self.offset.to_bytes(8, 'little'))
+        self.index_fp.flush()
+
+        self.offset += len(line)
+        self.count += 1
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every:
+            self.sync()
+        return self.count - 1
+
+    def sync(self):
+        """Forces every record appended so far onto disk, the corpus before its index."""
+        for fp in (self.fp, self.index_fp):
+            fp.flush()
+            os.fsync(fp.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        """Syncs and closes the corpus, releasing it for other writers."""
+        self.sync()
+        self.index_fp.close()
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def build_index(path):
+    """Writes the sidecar index of a corpus by scanning it once.
+
+    :param path: (str) the path of the corpus.
+    :returns (int) the number of records indexed.
+    """
+    offsets = array.array('Q')
+    offset = 0
+    with open(path, 'rb') as fp:
+        for line in fp:
+            if not line.endswith(b"\n"):
+                break
+            offsets.append(offset)
+            offset += len(line)
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+
+    tmp = path + INDEX_SUFFIX + ".tmp"
+    with open(tmp, 'wb') as fp:
+        fp.write(INDEX_MAGIC)
+        offsets.tofile(fp)
+    os.replace(tmp, path + INDEX_SUFFIX)
+    return len(offsets)
+
+
+def iter_legacy_records(path):
+    """Lazily reads the records of a ChatGPT generated json file.
+
+    Files written one "N": {...} record per line are streamed. From the first line that is not,
+    the rest of the file is loaded whole, after repairing what appending fragments leaves
+    behind: a missing opening or closing brace and a trailing comma.
+
+    :param path: (str) the path of the file.
+    :returns a generator of (int, dict) tuples of the legacy id and record.
+    """
+    seen = set()
+    with open(path) as fp:
+        for line in fp:
+            match = LEGACY_RECORD.match(line)
+            if match:
+                try:
+                    record = json.loads(match.group(2))
+                except json.JSONDecodeError:
+                    break
+                seen.add(int(match.group(1)))
+                yield int(match.group(1)), record
+            elif line.strip() not in ('{', '}', ''):
+                break
+        else:
+            return
+
+    with open(path) as fp:
+        text = fp.read().strip()
+    if not text.startswith('{'):
+        text = '{' + text
+    text = re.sub(r',\s*(}?)$', r'\1', text)
+    try:
+        records = json.loads(text)
+    except json.JSONDecodeError:
+        records = json.loads(text + '}')
+    for key, record in records.items():
+        if int(key) not in seen:
+            yield int(key), record
+
+
+def convert_legacy(in_path, out_path):
+    """Converts a ChatGPT generated json file into an indexed pair corpus.
+
+    :param in_path: (str) the path of the json file.
+    :param out_path: (str) the path of the corpus to create, it must not exist yet.
+    :returns (int) the number of records converted.
+    """
+    if os.path.exists(out_path):
+        raise FileExistsError(out_path)
+    with CorpusWriter(out_path) as writer:
+        for key, record in iter_legacy_records(in_path):
+            writer.append(record['invocation'], record['cmd'], id=key)
+        return writer.count
+
+
+def _next_id(path):
+    """Finds one past the highest integer id of the records of a corpus, or 0 without any."""
+    ret = 0
+    with open(path, 'rb') as fp:
+        for line in fp:
+            record_id = json.loads(line).get('id')
+            if type(record_id) is int:
+                ret = max(ret, record_id + 1)
+    return ret
+
+
+def _index_matches(path, index_path):
+    """Checks that an index exists and covers exactly the complete records of a corpus."""
+    if not os.path.exists(path) or not os.path.exists(index_path):
+        return False
+    size = os.path.getsize(path)
+    with open(index_path, 'rb') as fp:
+        if fp.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            return False
+        n = (os.path.getsize(index_path) - len(INDEX_MAGIC)) // 8
+        if n == 0:
+            return size == 0
+        fp.seek(len(INDEX_MAGIC) + 8 * (n - 1))
+        last = int.from_bytes(fp.read(8), 'little')
+    with open(path, 'rb') as fp:
+        fp.seek(last)
+        line = fp.readline()
+    return line.endswith(b"\n") and last + len(line) == size
+
+
+def _truncate_partial_record(path):
+    """Drops a trailing record left incomplete by an interrupted write."""
+    with open(path, 'rb+') as fp:
+        size = fp.seek(0, os.SEEK_END)
+        if not size:
+            return
+        fp.seek(size - 1)
+        if fp.read(1) == b"\n":
+            return
+        end = size
+        while end > 0:
+            start = max(0, end - 65536)
+            fp.seek(start)
+            pos = fp.read(end - start).rfind(b"\n")
+            if pos >= 0:
+                fp.truncate(start + pos + 1)
+                return
+            end = start
+        fp.truncate(0)
+
+
+def _map(fp):
+    """Memory maps a whole file for reading, or returns None for an empty file."""
+    if not os.fstat(fp.fileno()).st_size:
+        return None
+    return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _offsets(view):
+    """Views the offsets stored in a memory mapped index."""
+    if view is None:
+        return ()
+    if sys.byteorder == 'little':
+        return view[len(INDEX_MAGIC):].cast('Q')
+    offsets = array.array('Q', view[len(INDEX_MAGIC):])
+    offsets.byteswap()
+    return offsets
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert, index and read pair corpora.")
+    sub = parser.add_subparsers(dest='task', required=True)
+    convert = sub.add_parser('convert', help="convert a ChatGPT generated json file")
+    convert.add_argument('in_path')
+    convert.add_argument('out_path')
+    index = sub.add_parser('index', help="rebuild the index of a corpus")
+    index.add_argument('path')
+    get = sub.add_parser('get', help="print records by position")
+    get.add_argument('path')
+    get.add_argument('positions', type=int, nargs='+')
+    args = parser.parse_args()
+
+    if args.task == 'convert':
+        print(f"Converted {convert_legacy(args.in_path, args.out_path)} records")
+    elif args.task == 'index':
+        print(f"Indexed {build_index(args.path)} records")
+    else:
+        with PairCorpus(args.path) as corpus:
+            for i in args.positions:
+                print(json.dumps(corpus[i]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,361 @@
+from checker import NESTED_COMMAND_FLAGS, PUNCTUATION, SEPARATORS, tokenize
+from corpus import PairCorpus, iter_legacy_records
+import argparse
+import array
+import collections
+import hashlib
+import os
+import re
+
+import numpy as np
+
+STATS_SUFFIX = '.stats.npz'
+# bumped whenever the tokenization changes, so older caches are rebuilt
+STATS_VERSION = 1
+# pipeline positions from the last one on are counted together
+MAX_POSITION = 8
+
+_ASSIGNMENT = re.compile(r"^[A-Za-z_]\w*=")
+_ARRAYS = ('stage_cmd', 'stage_pos', 'stage_nested', 'stage_ut', 'flag_stage', 'flag_id')
+
+
+class CorpusStats:
+    def __init__(self, paths, cache=True):
+        """Computes utility and flag statistics over files of commands.
+
+        Every file is tokenized once into integer arrays, with utilities and flags interned into
+        one vocabulary: a row per pipeline stage holding its command, position and utility, and a
+        row per flag holding its stage. The arrays are cached next to each file and reused until
+        its contents change, so statistics over any combination of files are computed with NumPy
+        without reading the commands again.
+
+        A stage is a simple command of a pipeline or command list, and the command run by a
+        "find -exec" flag is a nested stage at the position of its parent. Flags are the words
+        starting with a hyphen, with the value of "--flag=value" removed.
+
+        :param paths: (list) of (str) paths of text files with one command per line, json files
+            generated by chatGPT_generate.py or ".jsonl" pair corpora.
+        :param cache: (bool) whether to read and write the cached arrays.
+        """
+        if isinstance(paths, str):
+            paths = [paths]
+        self.paths = list(paths)
+        self.vocab, self.ids = [], {}
+        parts = {name: [] for name in _ARRAYS}
+        self.n_commands, n_stages = 0, 0
+        for path in self.paths:
+            tokens = load_tokens(path, cache)
+            remap = np.array([self.ids.setdefault(t, len(self.ids)) for t in tokens['vocab']],
+                             dtype=np.int32)
+            self.vocab.extend(list(self.ids)[len(self.vocab):])
+            parts['stage_cmd'].append(tokens['stage_cmd'] + self.n_commands)
+            parts['stage_pos'].append(tokens['stage_pos'])
+            parts['stage_nested'].append(tokens['stage_nested'])
+            parts['stage_ut'].append(remap[tokens['stage_ut']])
+            parts['flag_stage'].append(tokens['flag_stage'] + n_stages)
+            parts['flag_id'].append(remap[tokens['flag_id']])
+            self.n_commands += tokens['n_commands']
+            n_stages += len(tokens['stage_ut'])
+        for name, dtype in zip(_ARRAYS, (np.int32, np.int32, bool, np.int32, np.int32, np.int32)):
+            setattr(self, name, np.concatenate(parts[name]) if parts[name]
+                    else np.zeros(0, dtype=dtype))
+        self._compute()
+
+    def _compute(self):
+        v = len(self.vocab)
+        top = ~self.stage_nested
+
+        self.stage_freq = np.bincount(self.stage_ut, minlength=v)
+        self.command_freq = np.bincount(self.stage_ut[top & (self.stage_pos == 0)], minlength=v)
+
+        # (utility, flag) pairs with their counts, sorted by utility then flag
+        self.flag_keys, self.flag_freq = _count_rows([self.stage_ut[self.flag_stage],
+                                                      self.flag_id], v)
+
+        # every pair of distinct flags of a stage, each stage counted once per pair
+        stage_flags, _ = _count_rows([self.flag_stage, self.flag_id], max(v, len(self.stage_ut)))
+        stages, flags = stage_flags[:, 0], stage_flags[:, 1]
+        later = np.searchsorted(stages, stages, side='right') - np.arange(len(stages)) - 1
+        first = np.repeat(np.arange(len(stages)), later)
+        offset = np.arange(len(first)) - np.repeat(np.cumsum(later) - later, later)
+        second = first + 1 + offset
+        self.pair_keys, self.pair_freq = _count_rows([self.stage_ut[stages[first]], flags[first],
+                                                      flags[second]], v)
+
+        # positions of the top level stages and the number of stages of every command
+        self.utilities = np.unique(self.stage_ut[top])
+        rows = np.searchsorted(self.utilities, self.stage_ut[top])
+        pos = np.minimum(self.stage_pos[top], MAX_POSITION - 1)
+        self.position_freq = np.bincount(rows * MAX_POSITION + pos,
+                                         minlength=len(self.utilities) * MAX_POSITION
+                                         ).reshape(-1, MAX_POSITION)
+        depths = np.bincount(self.stage_cmd[top], minlength=self.n_commands)
+        self.depth_freq = np.bincount(depths)
+        last = self.stage_pos[top] == depths[self.stage_cmd[top]] - 1
+        self.last_freq = np.bincount(rows[last & (depths[self.stage_cmd[top]] > 1)],
+                                     minlength=len(self.utilities))
+
+    def utility_counts(self, stages=False):
+        """Counts the utilities of the commands.
+
+        :param stages: (bool) whether to count the utility of every stage, including the ones
+            after a pipe and nested ones, instead of the first utility of every command.
+        :returns (Counter) mapping (str) utilities to their counts.
+        """
+        return self._counter(self.stage_freq if stages else self.command_freq)
+
+    def flag_counts(self, utility=None):
+        """Counts the flags used with a utility.
+
+        :param utility: (optional str) the utility, defaults to every utility.
+        :returns (Counter) mapping (str) flags to the number of times they were used.
+        """
+        keys, counts = self.flag_keys, self.flag_freq
+        if utility is not None:
+            selected = keys[:, 0] == self.ids.get(utility, -1)
+            keys, counts = keys[selected], counts[selected]
+        ret = collections.Counter()
+        for flag, count in zip(keys[:, 1].tolist(), counts.tolist()):
+            ret[self.vocab[flag]] += count
+        return ret
+
+    def flags(self):
+        """Gets every flag used in the commands.
+
+        :returns (set) of (str) flags.
+        """
+        return {self.vocab[i] for i in np.unique(self.flag_id).tolist()}
+
+    def cooccurrence(self, utility):
+        """Builds the flag co-occurrence matrix of a utility.
+
+        :param utility: (str) the utility.
+        :returns (tuple) of the (list) of (str) flags used with the utility, sorted by count, and
+            a symmetric (numpy.ndarray) counting the stages each pair of flags appears in
+            together, with the count of each flag on the diagonal.
+        """
+        ut = self.ids.get(utility, -1)
+        selected = self.flag_keys[:, 0] == ut
+        flag_ids, counts = self.flag_keys[selected, 1], self.flag_freq[selected]
+        order = np.argsort(-counts, kind='stable')
+        flag_ids, counts = flag_ids[order], counts[order]
+
+        lookup = np.full(len(self.vocab), -1, dtype=np.int64)
+        lookup[flag_ids] = np.arange(len(flag_ids))
+        matrix = np.zeros((len(flag_ids), len(flag_ids)), dtype=np.int64)
+        pairs = self.pair_keys[self.pair_keys[:, 0] == ut]
+        weights = self.pair_freq[self.pair_keys[:, 0] == ut]
+        a, b = lookup[pairs[:, 1]], lookup[pairs[:, 2]]
+        matrix[a, b] = weights
+        matrix[b, a] = weights
+        # the diagonal counts every use of a flag, repeats within a stage included
+        matrix[np.diag_indices_from(matrix)] = counts
+        return [self.vocab[i] for i in flag_ids.tolist()], matrix
+
+    def position_counts(self, utility):
+        """Counts the pipeline positions of a utility.
+
+        :param utility: (str) the utility.
+        :returns (dict) with "positions", a (list) counting the stages at each position of a
+            pipeline or command list, the last one counting that position and later ones, and
+            "last", the number of times the utility ended a command with more than one stage.
+        """
+        row = np.searchsorted(self.utilities, self.ids.get(utility, -1))
+        if row == len(self.utilities) or self.utilities[row] != self.ids.get(utility, -1):
+            return {'positions': [0] * MAX_POSITION, 'last': 0}
+        return {'positions': self.position_freq[row].tolist(), 'last': int(self.last_freq[row])}
+
+    def depth_counts(self):
+        """Counts the commands by their number of top level stages.
+
+        :returns (Counter) mapping (int) numbers of stages to the number of commands.
+        """
+        return collections.Counter({depth: count for depth, count
+                                    in enumerate(self.depth_freq.tolist()) if count})
+
+    def _counter(self, freq):
+        ids = np.flatnonzero(freq)
+        return collections.Counter(dict(zip((self.vocab[i] for i in ids.tolist()),
+                                            freq[ids].tolist())))
+
+
+def _count_rows(columns, base):
+    """Counts the distinct rows of integer columns whose values are all below base.
+
+    Rows are packed into one int64 each where they fit, which is much faster to sort than rows
+    of an array.
+
+    :returns (tuple) of the distinct rows as a (numpy.ndarray) of one row per line, sorted, and
+        their counts.
+    """
+    if base ** len(columns) >= 1 << 63:
+        rows, counts = np.unique(np.stack(columns, axis=1), axis=0, return_counts=True)
+        return rows.reshape(-1, len(columns)), counts
+    keys = np.zeros(len(columns[0]), dtype=np.int64)
+    for col in columns:
+        keys = keys * base + col
+    keys, counts = np.unique(keys, return_counts=True)
+    rows = np.empty((len(keys), len(columns)), dtype=np.int64)
+    for i in range(len(columns) - 1, -1, -1):
+        keys, rows[:, i] = np.divmod(keys, base)
+    return rows, counts
+
+
+def load_tokens(path, cache=True):
+    """Tokenizes a file of commands into integer arrays, or loads them from its cache.
+
+    The cache is a ".stats.npz" file next to the commands, holding the SHA-256 digest of the
+    file it was built from, so edits to the file invalidate it.
+
+    :param path: (str) the path of the file.
+    :param cache: (bool) whether to read and write the cache.
+    :returns (dict) with the "vocab", a (list) of (str) interned utilities and flags, the
+        "n_commands", and the (numpy.ndarray) "stage_cmd", "stage_pos", "stage_nested",
+        "stage_ut", "flag_stage" and "flag_id" described in `tokenize_commands`.
+    """
+    digest = _digest(path)
+    cache_path = path + STATS_SUFFIX
+    if cache and os.path.exists(cache_path):
+        with np.load(cache_path) as data:
+            if int(data['version']) == STATS_VERSION and bytes(data['digest']) == digest:
+                ret = {name: data[name] for name in _ARRAYS}
+                ret['n_commands'] = int(data['n_commands'])
+                ret['vocab'] = bytes(data['vocab']).decode().split("\n") \
+                    if len(data['vocab']) else []
+                return ret
+
+    ret = tokenize_commands(_read_commands(path))
+    if cache:
+        tmp = cache_path + ".tmp"
+        try:
+            with open(tmp, 'wb') as fp:
+                np.savez(fp, version=STATS_VERSION, n_commands=ret['n_commands'],
+                         digest=np.frombuffer(digest, dtype=np.uint8),
+                         vocab=np.frombuffer("\n".join(ret['vocab']).encode(), dtype=np.uint8),
+                         **{name: ret[name] for name in _ARRAYS})
+            os.replace(tmp, cache_path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    return ret
+
+
+def tokenize_commands(cmds):
+    """Tokenizes commands into integer arrays.
+
+    :param cmds: (iterable) of (str) commands, blank ones are skipped.
+    :returns (dict) with the "vocab", a (list) of (str) interned utilities and flags, the
+        "n_commands", and a (numpy.ndarray) per column of the stages and flags: "stage_cmd",
+        "stage_pos", "stage_nested" and "stage_ut" for the command, position, nesting and
+        utility id of every stage, and "flag_stage" and "flag_id" for the stage and flag id of
+        every flag.
+    """
+    vocab, ids = [], {}
+    columns = {name: array.array('i') for name in _ARRAYS}
+    stage_cmd, stage_pos, stage_nested = (columns['stage_cmd'], columns['stage_pos'],
+                                          columns['stage_nested'])
+    stage_ut, flag_stage, flag_id = columns['stage_ut'], columns['flag_stage'], columns['flag_id']
+
+    def intern(token):
+        i = ids.get(token)
+        if i is None:
+            i = ids[token] = len(vocab)
+            vocab.append(str(token))
+        return i
+
+    def add_stage(n, pos, nested, token):
+        stage_cmd.append(n)
+        stage_pos.append(pos)
+        stage_nested.append(nested)
+        stage_ut.append(intern(token))
+        return len(stage_ut) - 1
+
+    n = 0
+    for cmd in cmds:
+        cmd = cmd.strip()
+        if not cmd:
+            continue
+        try:
+            tokens = tokenize(cmd)
+        except ValueError:
+            tokens = cmd.split()
+
+        pos, top, stage, nested_next = 0, None, None, False
+        for token in tokens:
+            plain = type(token) is str
+            if plain and token in SEPARATORS:
+                pos += top is not None
+                top = stage = None
+                nested_next = False
+            elif nested_next:
+                stage = add_stage(n, pos, True, token)
+                nested_next = False
+            elif stage is None:
+                if not plain or not (token[0] in PUNCTUATION or _ASSIGNMENT.match(token)):
+                    top = stage = add_stage(n, pos, False, token)
+            elif stage != top and token in (';', '+'):
+                stage = top
+            elif plain and len(token) > 1 and token[0] == '-':
+                flag_stage.append(stage)
+                flag_id.append(intern(token.split('=', 1)[0] if token[1] == '-' else token))
+                nested_next = stage == top and token in NESTED_COMMAND_FLAGS
+        n += 1
+
+    ret = {name: np.frombuffer(col, dtype=np.int32).copy() if len(col)
+           else np.zeros(0, dtype=np.int32) for name, col in columns.items()}
+    ret['stage_nested'] = ret['stage_nested'].astype(bool)
+    ret['vocab'] = vocab
+    ret['n_commands'] = n
+    return ret
+
+
+def _read_commands(path):
+    """Reads the commands of a text file, a generated json file or a pair corpus."""
+    if path.endswith('.jsonl'):
+        with PairCorpus(path) as corpus:
+            for record in corpus:
+                yield record['cmd']
+    elif path.endswith('.json'):
+        for _, record in iter_legacy_records(path):
+            yield record['cmd']
+    else:
+        with open(path) as fp:
+            yield from fp
+
+
+def _digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            h.update(chunk)
+    return h.digest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print utility and flag statistics of files of "
+                                                 "commands.")
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--utility', help="also print the flags and pipeline positions of a "
+                                          "utility")
+    parser.add_argument('--no-cache', action='store_true')
+    args = parser.parse_args()
+
+    stats = CorpusStats(args.paths, cache=not args.no_cache)
+    print(f"{stats.n_commands} commands, {len(stats.stage_ut)} stages, {len(stats.flag_id)} flags")
+    print("Stages per command: " + ", ".join(f"{d}: {c}" for d, c
+                                             in sorted(stats.depth_counts().items())))
+    for ut, count in stats.utility_counts().most_common(args.top):
+        print(f"{ut:<16} {count:>8}")
+
+    if args.utility:
+        print(f"\nPositions of {args.utility}: {stats.position_counts(args.utility)}")
+        flags, matrix = stats.cooccurrence(args.utility)
+        flags, matrix = flags[:args.top], matrix[:args.top, :args.top]
+        print(" " * 16 + "".join(f"{flag[:7]:>8}" for flag in flags))
+        for flag, row in zip(flags, matrix.tolist()):
+            print(f"{flag:<16}" + "".join(f"{count:>8}" for count in row))
+
+
+if __name__ == '__main__':
+    main()
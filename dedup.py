@@ -0,0 +1,308 @@
+from checker import tokenize, Word, SEPARATORS
+from corpus import PairCorpus, iter_legacy_records
+import argparse
+import collections
+import hashlib
+import json
+import re
+import zlib
+
+import numpy as np
+
+NUMBER = re.compile(r"-?\d+(\.\d+)?$")
+PRIME = (1 << 31) - 1
+# utilities whose flags mean the same in any order. The expressions of find, the nested command
+# of xargs and the options of tar, echo, ssh and the like depend on their order, so the words of
+# every other utility are kept as they are.
+ORDER_FREE = {'grep', 'rm', 'ls', 'sort', 'chmod', 'wc', 'cat', 'cut', 'head', 'mv', 'chown',
+              'cp', 'mkdir', 'tr', 'tail', 'dirname', 'uniq', 'ln', 'split', 'tee', 'diff', 'du',
+              'file', 'md5sum', 'comm', 'mktemp', 'df', 'rev', 'rmdir', 'od'}
+
+
+def normalize(cmd, literals=False, flag_args=None):
+    """Builds the normal form of a command used to detect duplicates.
+
+    Whitespace is collapsed and, for the utilities in ORDER_FREE, the flags of each pipeline
+    stage are sorted together with their values, so commands that only differ in spacing or in
+    the order of such flags share a normal form. Repeated flags, e.g. the keys of sort, keep
+    their relative order, and the words of other utilities, e.g. find, keep theirs.
+
+    :param cmd: (str) the command to normalize.
+    :param literals: (bool) whether to also replace quoted strings and numbers with "<str>" and
+        "<num>", so commands that only differ in literal values share a normal form.
+    :param flag_args: (optional dict) mapping utilities to a (dict) of whether each of their
+        flags takes an argument, see `load_flag_args`. A flag it does not know is kept
+        together with the word that follows it, unless that word is another flag.
+    :returns (str) the normal form of the command.
+    """
+    try:
+        tokens = tokenize(cmd.strip())
+    except ValueError:
+        return " ".join(cmd.split())
+
+    ret, stage = [], []
+    for token in tokens + [';']:
+        if token in SEPARATORS and type(token) is str:
+            ret.extend(_normalize_stage(stage, literals, flag_args or {}))
+            ret.append(token)
+            stage = []
+        else:
+            stage.append(token)
+    return " ".join(ret[:-1])
+
+
+def load_flag_args(map_path):
+    """Loads the flags that take an argument from the utility mappings.
+
+    :param map_path: (str) a file path to retrieve utility, flag, arg mappings.
+    :returns (dict) mapping every utility to a (dict) of whether each of its flags is mapped to
+        an argument type.
+    """
+    with open(map_path) as fp:
+        mappings = json.load(fp)
+    return {ut: {flag: bool(arg) for flag, arg in flags.items()} for ut, flags in mappings.items()}
+
+
+def _normalize_stage(tokens, literals, flag_args):
+    """Sorts the flags of a single simple command of an order free utility, keeping every flag
+    with its value, and optionally abstracts its literals."""
+    if not tokens:
+        return tokens
+    reorder = tokens[0] in ORDER_FREE
+    mapped = flag_args.get(tokens[0], {})
+    if literals:
+        tokens = ["<str>" if type(t) is Word else "<num>" if NUMBER.match(t) else t
+                  for t in tokens]
+    if not reorder:
+        return tokens
+
+    flags, operands, i = [], [], 1
+    while i < len(tokens):
+        t = tokens[i]
+        if t == '--':
+            # the remaining words are operands, even when they start with a hyphen
+            operands.extend(tokens[i:])
+            break
+        if not t.startswith('-'):
+            operands.append(t)
+            i += 1
+            continue
+        takes_arg = mapped.get(t) if t in mapped else \
+            i + 1 < len(tokens) and not tokens[i + 1].startswith('-')
+        if takes_arg and i + 1 < len(tokens):
+            flags.append((t, tokens[i + 1]))
+            i += 2
+        else:
+            flags.append((t,))
+            i += 1
+    flags.sort(key=lambda flag: flag[0])
+    return [tokens[0]] + [t for flag in flags for t in flag] + operands
+
+
+class Deduplicator:
+    def __init__(self, threshold=0.8, num_perm=64, bands=16, shingle_size=2, near=True,
+                 literals=False, seed=1, map_path=None):
+        """Initializes a streaming detector of exact and near duplicate commands.
+
+        Exact duplicates are found by hashing the normal form of each command. Near duplicates
+        are found by MinHash signatures over token shingles, with locality sensitive hashing
+        to only compare a command against clusters that share at least one band of its
+        signature. Only hashes and one signature per cluster are kept in memory, never the
+        commands themselves.
+
+        :param threshold: (float) the estimated Jaccard similarity above which two commands are
+            near duplicates.
+        :param num_perm: (int) the number of hash permutations in each MinHash signature.
+        :param bands: (int) the number of LSH bands, must divide num_perm. More bands find more
+            candidate pairs at lower similarities.
+        :param shingle_size: (int) the number of consecutive tokens in each shingle.
+        :param near: (bool) whether to detect near duplicates as well as exact duplicates.
+        :param literals: (bool) whether exact duplicates ignore quoted strings and numbers.
+        :param seed: (int) the seed of the hash permutations.
+        :param map_path: (optional str) a file path to retrieve utility, flag, arg mappings, to
+            know which flags take an argument when sorting flags.
+        """
+        if num_perm % bands:
+            raise ValueError("bands must divide num_perm")
+
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.near = near
+        self.literals = literals
+        self.flag_args = load_flag_args(map_path) if map_path else None
+
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, PRIME, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, PRIME, num_perm, dtype=np.uint64)
+
+        self.seen = set()
+        self.buckets = {}
+        self.signatures = np.zeros((0, num_perm), dtype=np.uint32)
+        self.cluster_sizes = []
+        self.cluster_lines = []
+        self.counts = collections.Counter()
+
+    def add(self, cmd):
+        """Records a command and classifies it against every command recorded before.
+
+        :param cmd: (str) the command.
+        :returns (str) "unique", "exact" for an exact duplicate or "near" for a near duplicate.
+        """
+        line = self.counts['lines']
+        self.counts['lines'] += 1
+
+        key = hashlib.blake2b(normalize(cmd, self.literals, self.flag_args).encode(),
+                              digest_size=8).digest()
+        if key in self.seen:
+            self.counts['exact'] += 1
+            return 'exact'
+        self.seen.add(key)
+
+        if not self.near:
+            self.counts['unique'] += 1
+            return 'unique'
+
+        sig = self.signature(cmd)
+        band_keys = [(i, sig[i * self.rows:(i + 1) * self.rows].tobytes())
+                     for i in range(self.bands)]
+
+        candidates = {c for band_key in band_keys for c in self.buckets.get(band_key, ())}
+        if candidates:
+            candidates = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+            similarity = (self.signatures[candidates] == sig).mean(axis=1)
+            best = similarity.argmax()
+            if similarity[best] >= self.threshold:
+                self.cluster_sizes[candidates[best]] += 1
+                self.counts['near'] += 1
+                return 'near'
+
+        cluster = len(self.cluster_sizes)
+        if cluster == len(self.signatures):
+            # grow the signature matrix geometrically
+            self.signatures = np.resize(self.signatures, (max(1024, 2 * cluster), self.num_perm))
+        self.signatures[cluster] = sig
+        self.cluster_sizes.append(1)
+        self.cluster_lines.append(line)
+        for band_key in band_keys:
+            self.buckets.setdefault(band_key, []).append(cluster)
+        self.counts['unique'] += 1
+        return 'unique'
+
+    def filter(self, cmds):
+        """Lazily removes exact and near duplicates from a stream of commands.
+
+        :param cmds: (iterable) of (str) commands.
+        :returns a generator of (str) the first command of every cluster.
+        """
+        for cmd in cmds:
+            if self.add(cmd) == 'unique':
+                yield cmd
+
+    def signature(self, cmd):
+        """Computes the MinHash signature of a command.
+
+        :param cmd: (str) the command.
+        :returns (numpy.ndarray) of num_perm (uint32) minimum hash values.
+        """
+        tokens = normalize(cmd, literals=True, flag_args=self.flag_args).split(" ")
+        n = self.shingle_size
+        shingles = {" ".join(tokens[i:i + n]) for i in range(max(1, len(tokens) - n + 1))}
+        hashes = np.array([zlib.crc32(s.encode()) for s in shingles], dtype=np.uint64)
+        permuted = (np.outer(self.a, hashes) + self.b[:, None]) % PRIME
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def stats(self, top=10):
+        """Gets the duplicate and cluster statistics of every command recorded so far.
+
+        :param top: (int) the number of largest clusters to list.
+        :returns (dict) of line and duplicate counts, the cluster size histogram and the line
+            numbers and sizes of the largest clusters.
+        """
+        lines = self.counts['lines']
+        sizes = collections.Counter(self.cluster_sizes)
+        largest = sorted(range(len(self.cluster_sizes)), key=lambda c: -self.cluster_sizes[c])
+        return {
+            'lines': lines,
+            'unique': self.counts['unique'],
+            'exact_duplicates': self.counts['exact'],
+            'near_duplicates': self.counts['near'],
+            'duplicate_rate': (self.counts['exact'] + self.counts['near']) / lines if lines else 0,
+            'clusters': len(self.cluster_sizes),
+            'cluster_size_histogram': {str(k): v for k, v in sorted(sizes.items())},
+            'largest_clusters': [{'first_line': self.cluster_lines[c],
+                                  'size': self.cluster_sizes[c]} for c in largest[:top]
+                                 if self.cluster_sizes[c] > 1],
+        }
+
+
+def iter_file_commands(path):
+    """Lazily reads the commands of a text file, a ChatGPT generated json file or a pair corpus.
+
+    Text files hold one command per line. Json files map indices to {"cmd": ...} records and
+    are read with `iter_legacy_records`, and ".jsonl" pair corpora with `PairCorpus`, see
+    corpus.py.
+
+    :param path: (str) the path of the file.
+    :returns a generator of (str) commands.
+    """
+    if path.endswith('.jsonl'):
+        with PairCorpus(path) as corpus:
+            for record in corpus:
+                yield record['cmd']
+        return
+    if not path.endswith('.json'):
+        with open(path) as fp:
+            for line in fp:
+                line = line.rstrip('\n')
+                if line:
+                    yield line
+        return
+
+    for _, record in iter_legacy_records(path):
+        yield record['cmd']
+
+
+def dedup_file(in_path, out_path=None, **kwargs):
+    """Removes exact and near duplicates from a file of commands.
+
+    :param in_path: (str) the path of a text or json file of commands.
+    :param out_path: (optional str) the path of the text file to write unique commands to.
+    :param kwargs: the parameters of the Deduplicator.
+    :returns (dict) the statistics of the Deduplicator.
+    """
+    dedup = Deduplicator(**kwargs)
+    cmds = dedup.filter(iter_file_commands(in_path))
+    if out_path:
+        with open(out_path, 'w') as fp:
+            for cmd in cmds:
+                fp.write(cmd + "\n")
+    else:
+        collections.deque(cmds, maxlen=0)
+    return dedup.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Remove exact and near duplicate commands.")
+    parser.add_argument('in_path')
+    parser.add_argument('--out')
+    parser.add_argument('--threshold', type=float, default=0.8)
+    parser.add_argument('--num-perm', type=int, default=64)
+    parser.add_argument('--bands', type=int, default=16)
+    parser.add_argument('--exact-only', action='store_true')
+    parser.add_argument('--literals', action='store_true',
+                        help="ignore quoted strings and numbers for exact duplicates")
+    parser.add_argument('--map-path', help="the utility mappings, to know which flags take an "
+                                           "argument, e.g. syntax_structures/utility_map.json")
+    args = parser.parse_args()
+
+    stats = dedup_file(args.in_path, args.out, threshold=args.threshold, num_perm=args.num_perm,
+                       bands=args.bands, near=not args.exact_only, literals=args.literals,
+                       map_path=args.map_path)
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == '__main__':
+    main()
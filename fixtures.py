@@ -0,0 +1,210 @@
+from metrics import METRICS
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+# ioctl request cloning the extents of one file into another on btrfs, xfs and other reflink
+# capable filesystems
+FICLONE = 0x40049409
+
+# shared memory filesystem preferred for workspaces, so resets never touch a disk
+SHM_DIR = '/dev/shm'
+
+_FILE_NAME = re.compile(r"^[\w-]+\.\w+$")
+
+
+def default_contents(name, lines=20):
+    """Builds the text of a fixture file, different lines for each file so that commands like
+    diff, comm, sort and uniq have something to work on.
+
+    :param name: (str) the name of the file.
+    :param lines: (int) the number of lines.
+    :returns (str) the contents of the file.
+    """
+    seed = sum(map(ord, name))
+    return "".join(f"{name} line {(i * seed) % lines} value {i % 5}\n" for i in range(lines))
+
+
+class Fixtures:
+    def __init__(self, rep_path='rep_map.json', files=None, base_dir=None):
+        """Initializes a manager of identical fixture workspaces to validate commands in.
+
+        The files the replacement mapping refers to, such as "temp.txt" and "temp2.txt", are
+        written once to a template directory, and the "." directory of the mapping is each
+        workspace itself. Every worker thread gets its own workspace cloned from the template,
+        nested in a private parent directory so that commands reaching into ".." do not see the
+        other workspaces,
+        with reflinks where the filesystem supports them and plain copies otherwise. Hardlinks
+        are never used since chmod, chown and in place writes would change the template.
+        Workspaces live on /dev/shm when it is available.
+
+        :param rep_path: (str) the path to a json file with the word mappings.
+        :param files: (optional dict) mapping file names to their contents, defaults to every
+            file name among the mapping values with `default_contents`.
+        :param base_dir: (optional str) the directory to create the template and workspaces in.
+        """
+        if files is None:
+            with open(rep_path) as fp:
+                reps = json.load(fp)
+            files = {name: default_contents(name) for name in reps.values()
+                     if _FILE_NAME.match(name)}
+        self.files = files
+
+        if base_dir is None and os.access(SHM_DIR, os.W_OK):
+            base_dir = SHM_DIR
+        self.root = tempfile.mkdtemp(prefix='bash_gen_fixtures_', dir=base_dir)
+        self.template = os.path.join(self.root, 'template')
+        os.makedirs(os.path.join(self.template, 'workspace'))
+        for name, contents in sorted(files.items()):
+            with open(os.path.join(self.template, 'workspace', name), 'w') as fp:
+                fp.write(contents)
+
+        self.reflink = True
+        self.resets = 0
+        self.clean = 0
+        self.reset_seconds = 0.0
+        self._count = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def version(self):
+        """Identifies the fixture files, e.g. as the fixture version of a ValidationCache.
+
+        :returns (str) a hex digest of the names and contents of the fixture files.
+        """
+        return hashlib.sha256(json.dumps(sorted(self.files.items())).encode()).hexdigest()
+
+    def workspace(self):
+        """Gets the workspace of the calling thread, reset to the template state.
+
+        The workspace is only rebuilt when a previous command changed it or its parent, which
+        is detected by comparing the name, type, size, mode, owner and modification time of
+        every entry with their state right after the last reset.
+
+        :returns (str) the path of the workspace.
+        """
+        path = getattr(self._local, 'path', None)
+        if path is None:
+            with self._lock:
+                self._count += 1
+                path = os.path.join(self.root, str(self._count))
+            self._local.path = path
+        elif self._local.signature is not None and self._local.signature == _signature(path):
+            with self._lock:
+                self.clean += 1
+            return os.path.join(path, 'workspace')
+        self.reset(path)
+        self._local.signature = _signature(path)
+        return os.path.join(path, 'workspace')
+
+    def reset(self, path):
+        """Rebuilds the private directory of a workspace as a fresh clone of the template.
+
+        :param path: (str) the path of the directory holding the workspace.
+        :returns (float) the number of seconds the reset took.
+        """
+        start = time.perf_counter()
+        if os.path.lexists(path):
+            _remove_tree(path)
+        self._clone_tree(self.template, path)
+        elapsed = time.perf_counter() - start
+        METRICS.observe('fixture_reset_seconds', elapsed)
+        with self._lock:
+            self.resets += 1
+            self.reset_seconds += elapsed
+        return elapsed
+
+    def stats(self):
+        """Gets the reset statistics of the workspaces.
+
+        :returns (dict) with the number of resets, the number of commands that left their
+            workspace unchanged, and the total and mean reset time.
+        """
+        return {'resets': self.resets, 'clean': self.clean, 'reset_seconds': self.reset_seconds,
+                'mean_reset_ms': 1000 * self.reset_seconds / self.resets if self.resets else 0.0}
+
+    def close(self):
+        """Removes the template and every workspace."""
+        _remove_tree(self.root)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _clone_tree(self, src, dst):
+        """Clones a directory tree, with reflinks while the filesystem supports them."""
+        os.mkdir(dst)
+        shutil.copystat(src, dst)
+        for entry in os.scandir(src):
+            target = os.path.join(dst, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                self._clone_tree(entry.path, target)
+            elif entry.is_symlink():
+                os.symlink(os.readlink(entry.path), target)
+            else:
+                self._clone_file(entry.path, target)
+                shutil.copymode(entry.path, target)
+
+    def _clone_file(self, src, dst):
+        if self.reflink:
+            with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+                try:
+                    fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+                    return
+                except OSError as e:
+                    if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL,
+                                       errno.ENOSYS):
+                        raise
+                    self.reflink = False
+        shutil.copyfile(src, dst)
+
+
+def _signature(path):
+    """Summarizes the state of every entry of a directory tree, relative to its root, or None
+    when the tree cannot be read."""
+    try:
+        return _scan(path)
+    except OSError:
+        return None
+
+
+def _scan(path):
+    ret = []
+    stack = [""]
+    while stack:
+        rel = stack.pop()
+        with os.scandir(os.path.join(path, rel)) as entries:
+            for entry in entries:
+                st = entry.stat(follow_symlinks=False)
+                name = os.path.join(rel, entry.name)
+                ret.append((name, st.st_mode, st.st_uid, st.st_gid, st.st_size,
+                            st.st_mtime_ns if not entry.is_dir(follow_symlinks=False) else 0))
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(name)
+    st = os.stat(path)
+    ret.append(("", st.st_mode, st.st_uid, st.st_gid))
+    return sorted(ret)
+
+
+def _remove_tree(path):
+    """Removes a directory tree, even when a command took away the permissions to do so."""
+    def allow(func, target, _):
+        os.chmod(os.path.dirname(target) or target, 0o700)
+        if os.path.isdir(target) and not os.path.islink(target):
+            os.chmod(target, 0o700)
+        func(target)
+
+    try:
+        os.chmod(path, 0o700)
+    except FileNotFoundError:
+        return
+    shutil.rmtree(path, onerror=allow)
@@ -0,0 +1,312 @@
+from compatibility import command_flags, flag_names
+from option_space import _nth_bit, _popcount
+import argparse
+import random
+
+# the kinds of coverage of a utility: its flags, the argument types of its flags and the pairs
+# of its flags used together
+DIMENSIONS = ('flag', 'arg_type', 'pair')
+
+
+class CoverageIndex:
+    def __init__(self, generator):
+        """Initializes an incremental index of what a set of commands covers, per utility.
+
+        For the option space of each utility, the index keeps a bitset of the flags used, a
+        bitset of the argument types used and, for every flag, a bitset of the flags it was used
+        together with. Adding a command or computing what it would add costs a few integer
+        operations, so the index can score many candidate commands.
+
+        :param generator: (Generator) the generator whose option spaces define the flags of
+            every utility.
+        """
+        self.generator = generator
+        self._utilities = {}
+
+    def utility(self, utility):
+        """Gets the coverage of a utility.
+
+        :param utility: (str) the utility.
+        :returns (UtilityCoverage) the coverage of the utility.
+        """
+        if utility not in self._utilities:
+            self._utilities[utility] = UtilityCoverage(self.generator.option_space(utility))
+        return self._utilities[utility]
+
+    def add_command(self, cmd):
+        """Adds the flags of a generated command to the index.
+
+        :param cmd: (str) the command, generic or with its words replaced.
+        :returns (bool) whether the command belongs to a utility of the generator.
+        """
+        words = cmd.split()
+        if words[:1] == ['sudo']:
+            words = words[1:]
+        ut = words[0] if words else None
+        if ut not in self.generator.utilities or not self.generator._valid_utilities(ut):
+            return False
+        cov = self.utility(ut)
+        _, flags = command_flags(cmd, {ut: cov.names})
+        cov.add(sorted({cov.positions[name] for name in flags}))
+        return True
+
+    def update(self, cmds):
+        """Adds the flags of many generated commands to the index, e.g. a validated corpus.
+
+        :param cmds: (iterable) of (str) commands, generic or with their words replaced.
+        :returns (int) the number of commands added.
+        """
+        return sum(self.add_command(cmd) for cmd in cmds if cmd.strip())
+
+    def report(self, utilities=None):
+        """Summarizes the coverage of utilities.
+
+        :param utilities: (optional list) of (str) utilities, defaults to every utility of the
+            index.
+        :returns (dict) mapping every dimension to a (tuple) of the covered and total counts
+            over the utilities, and "commands" to the number of commands added.
+        """
+        ret = {dim: (0, 0) for dim in DIMENSIONS}
+        ret['commands'] = 0
+        for ut in utilities if utilities is not None else list(self._utilities):
+            cov = self.utility(ut)
+            for dim, (covered, total) in cov.counts().items():
+                ret[dim] = (ret[dim][0] + covered, ret[dim][1] + total)
+            ret['commands'] += cov.commands
+        return ret
+
+
+class UtilityCoverage:
+    def __init__(self, space):
+        """Initializes the coverage of the option space of a utility, with nothing covered.
+
+        Flags and pairs of flags that no combination of the option space holds are left out of
+        what there is to cover.
+
+        :param space: (OptionSpace) the option space.
+        """
+        self.space = space
+        self.names = flag_names(space.flags)
+        self.positions = {name: i for i, name in enumerate(self.names)}
+        types = [flag.split(' ', 1)[1] if ' ' in flag else None for flag in space.flags]
+        self.types = sorted({t for t in types if t is not None})
+        self._type_bits = [1 << self.types.index(t) if t is not None else 0 for t in types]
+
+        n = len(space.flags)
+        # pairs are kept once, in the row of their first flag
+        self._pairable = [space.compatible(i) & ~((2 << i) - 1) for i in range(n)]
+        self._usable = sum(1 << i for i in range(n) if space.compatible(i) or _in_space(space, [i]))
+        self._usable_types = 0
+        for i in range(n):
+            if self._usable >> i & 1:
+                self._usable_types |= self._type_bits[i]
+        self.totals = {'flag': _popcount(self._usable), 'arg_type': _popcount(self._usable_types),
+                       'pair': sum(map(_popcount, self._pairable))}
+        self.flags = 0
+        self.arg_types = 0
+        self.pairs = [0] * n
+        self.commands = 0
+
+    def gain(self, positions):
+        """Computes what a combination of flags would add to the coverage.
+
+        :param positions: (list) of (int) strictly increasing flag positions.
+        :returns (tuple) of the number of new flags and argument types, and of new pairs.
+        """
+        new = 0
+        arg_types = self.arg_types
+        for a in positions:
+            new += not self.flags >> a & 1
+            if self._type_bits[a] & ~arg_types:
+                new += 1
+                arg_types |= self._type_bits[a]
+        pairs = sum(not self.pairs[a] >> b & 1 for i, a in enumerate(positions)
+                    for b in positions[i + 1:])
+        return new, pairs
+
+    def add(self, positions):
+        """Adds a combination of flags to the coverage.
+
+        :param positions: (list) of (int) strictly increasing flag positions.
+        :returns (tuple) of the number of new flags and argument types, and of new pairs.
+        """
+        gain = self.gain(positions)
+        for i, a in enumerate(positions):
+            self.flags |= 1 << a
+            self.arg_types |= self._type_bits[a]
+            for b in positions[i + 1:]:
+                self.pairs[a] |= 1 << b
+        self.commands += 1
+        return gain
+
+    def counts(self):
+        """Counts the covered flags, argument types and pairs.
+
+        :returns (dict) mapping every dimension to a (tuple) of the covered and total counts.
+        """
+        return {'flag': (_popcount(self.flags & self._usable), self.totals['flag']),
+                'arg_type': (_popcount(self.arg_types & self._usable_types),
+                             self.totals['arg_type']),
+                'pair': (sum(_popcount(row & pairable) for row, pairable
+                             in zip(self.pairs, self._pairable)), self.totals['pair'])}
+
+    def reached(self, target, dimensions=DIMENSIONS):
+        """Checks whether the coverage of every given dimension reached a target share.
+
+        :param target: (float) the share of each dimension to cover, from 0 to 1.
+        :param dimensions: (tuple) of (str) dimensions, among DIMENSIONS.
+        :returns (bool) whether the target is reached.
+        """
+        counts = self.counts()
+        return all(counts[dim][0] >= target * counts[dim][1] for dim in dimensions)
+
+    def uncovered(self, rng):
+        """Picks a flag, or a pair of flags, that is not covered yet.
+
+        :param rng: (random.Random) the random number generator to use.
+        :returns (list) of (int) one or two flag positions, or None when everything is covered.
+        """
+        n = len(self.space.flags)
+        flags = self._usable & ~self.flags
+        if flags:
+            return [_nth_bit(flags, rng.randrange(_popcount(flags)))]
+        rows = [a for a in range(n) if self._pairable[a] & ~self.pairs[a]]
+        if not rows:
+            return None
+        a = rng.choice(rows)
+        missing = self._pairable[a] & ~self.pairs[a]
+        return [a, _nth_bit(missing, rng.randrange(_popcount(missing)))]
+
+
+def iter_covering(generator, utility, coverage=None, target=0.95, max_commands=None,
+                  candidates=32, patience=64, accept=None, rng=None, dimensions=DIMENSIONS):
+    """Lazily generates commands that add the most coverage, until a target coverage.
+
+    Every command is the best of a round of candidates: half are drawn uniformly from the option
+    space and half are built around a flag or pair of flags not covered yet. Candidates are
+    ranked by the new flags and argument types they cover, then by the new pairs. A utility is
+    done once every dimension reaches the target, once patience rounds in a row add nothing, or
+    once its option space is used up.
+
+    :param generator: (Generator) the generator providing the option spaces.
+    :param utility: (str) or (lst) of (str) of the utility(s) to generate commands for.
+    :param coverage: (optional CoverageIndex) the coverage to extend, e.g. of a validated
+        corpus. Generated commands are added to it.
+    :param target: (float) the share of each dimension to cover, from 0 to 1.
+    :param max_commands: (optional int) the maximum number of commands per utility.
+    :param candidates: (int) the number of candidates per round.
+    :param patience: (int) the number of rounds in a row without new coverage before giving up.
+    :param accept: (optional callable) a function taking a command and returning whether it is
+        valid, e.g. running it. Only accepted commands are yielded and covered.
+    :param rng: (optional random.Random) the random number generator to use.
+    :param dimensions: (tuple) of (str) the dimensions the target applies to.
+    :returns a generator of (str) commands.
+    """
+    rng = rng or random.Random()
+    coverage = coverage or CoverageIndex(generator)
+    for ut in generator._valid_utilities(utility):
+        space = generator.option_space(ut)
+        cov = coverage.utility(ut)
+        used, emitted, stalls = set(), 0, 0
+        while (max_commands is None or emitted < max_commands) and len(used) < len(space) \
+                and stalls < patience and not cov.reached(target, dimensions):
+            best = None
+            for index in _candidates(space, cov, used, candidates, rng):
+                positions = space.combination(index)
+                gain = cov.gain(positions)
+                if best is None or gain > best[0]:
+                    best = (gain, index, positions)
+            if best is None or best[0] == (0, 0):
+                stalls += 1
+                continue
+
+            _, index, positions = best
+            used.add(index)
+            cmd = generator.grammar.render(ut, space[index])
+            if accept is not None and not accept(cmd):
+                stalls += 1
+                continue
+            stalls = 0
+            cov.add(positions)
+            emitted += 1
+            yield cmd
+
+
+def _in_space(space, positions):
+    """Checks whether a combination of flags is in an option space."""
+    try:
+        space.rank(positions)
+    except ValueError:
+        return False
+    return True
+
+
+def _candidates(space, cov, used, k, rng):
+    """Draws the indices of candidate combinations not used yet."""
+    ret = set()
+    for _ in range(k // 2):
+        index = rng.randrange(len(space))
+        if index not in used:
+            ret.add(index)
+
+    n = len(space.flags)
+    for _ in range(k - k // 2):
+        positions = cov.uncovered(rng)
+        if positions is None:
+            break
+        for _ in range(3 - len(positions)):
+            # grow the combination with flags that can join it, or stop at the current size
+            joinable = ((1 << n) - 1) & ~sum(1 << p for p in positions)
+            for p in positions:
+                joinable &= space.compatible(p)
+            if not joinable or rng.random() < 0.25:
+                break
+            positions = sorted(positions + [_nth_bit(joinable, rng.randrange(_popcount(joinable)))])
+        try:
+            index = space.rank(positions)
+        except ValueError:
+            continue
+        if index not in used:
+            ret.add(index)
+    return sorted(ret)
+
+
+def main():
+    from compatibility import FlagCompatibility
+    from generator import Generator, write_commands
+
+    parser = argparse.ArgumentParser(description="Generate commands until they cover the flags, "
+                                                 "argument types and flag pairs of utilities.")
+    parser.add_argument('--out', default='covering_cmds.txt')
+    parser.add_argument('--syntax-path', default='syntax.json')
+    parser.add_argument('--map-path', default='utility_map.json')
+    parser.add_argument('--compat', help="a flag compatibility model, see compatibility.py")
+    parser.add_argument('--validated', nargs='*', default=[],
+                        help="files of validated commands whose coverage is extended")
+    parser.add_argument('--utilities', nargs='*')
+    parser.add_argument('--target', type=float, default=0.95)
+    parser.add_argument('--max-commands', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    compat = FlagCompatibility.load(args.compat) if args.compat else None
+    generator = Generator(args.syntax_path, args.map_path, compat=compat)
+    utilities = args.utilities or generator.utilities
+    coverage = CoverageIndex(generator)
+    for path in args.validated:
+        with open(path) as fp:
+            coverage.update(fp)
+
+    count = write_commands(iter_covering(generator, utilities, coverage, args.target,
+                                         args.max_commands, rng=random.Random(args.seed)),
+                           args.out)
+    total = generator.count_commands(utilities)
+    print(f"Generated {count} commands out of {total} possible to {args.out}")
+    report = coverage.report(generator._valid_utilities(utilities))
+    for dim in DIMENSIONS:
+        covered, size = report[dim]
+        print(f"{dim:<9} coverage {covered}/{size} ({covered / size if size else 1:.1%})")
+
+
+if __name__ == '__main__':
+    main()
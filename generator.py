@@ -1,34 +1,62 @@
 from utils import UTILITIES, ARG_TYPES
+from compatibility import FlagCompatibility
+from flag_coverage import DIMENSIONS, CoverageIndex, iter_covering
+from grammar import load_grammar
+from journal import Journal
+from metrics import METRICS, Progress
+from option_space import OptionSpace, CompatibleOptionSpace
+from quota import load_distribution, allocate_quotas, distribution_report
+from replacer import Replacer
+from sandbox import Sandbox
+import bisect
 import collections
+import concurrent.futures
+import hashlib
 import json
+import os
 import random
-import subprocess
-import threading
+import time
+
+_ARG_TYPES = frozenset(ARG_TYPES)
 
 
 def valid_arg(flag):
     """Determines whether a flag argument scraped flag is in the predefined flag types"""
-    return flag in ARG_TYPES or not flag
+    return not flag or flag in _ARG_TYPES
 
 
 class Generator:
-    def __init__(self, syntax_path='syntax.json', map_path='utility_map.json', utilities=None):
+    def __init__(self, syntax_path='syntax.json', map_path='utility_map.json', utilities=None,
+                 grammar_path=None, compat=None):
         """Initializes the Generator class.
 
         :param syntax_path: (str) A file path to retrieve syntax structure.
         :param map_path: (str) A file path to retrieve utility, flag, arg mappings.
         :param utilities: (list) of (str) a list of utilities to generate.
+        :param grammar_path: (optional str) A file path to a grammar compiled from the syntax
+            structure and mappings with grammar.py. It is memory mapped instead of parsing the
+            json files, unless it is missing or stale.
+        :param compat: (optional FlagCompatibility or str) a model of the flags that cannot be
+            combined, or the path of a saved one, see compatibility.py. Options combinations the
+            model predicts to fail are left out of the option spaces.
         """
-        with open(syntax_path) as fp:
-            self.syntax = json.load(fp)
-
-        with open(map_path) as fp:
-            self.mappings = json.load(fp)
+        if isinstance(compat, str):
+            compat = FlagCompatibility.load(compat)
+        self.compat = compat
+        self.grammar = load_grammar(syntax_path, map_path, grammar_path)
+        self.syntax = self.grammar.syntax
 
         if utilities is None:
             utilities = UTILITIES
 
-        self.utilities = list(filter(lambda x: x in self.syntax and x in self.mappings, utilities))
+        self.utilities = list(filter(lambda x: x in self.syntax and self.grammar.has_mapping(x),
+                                     utilities))
+        self._spaces = {}
+
+    @property
+    def mappings(self):
+        """The flag to argument type mappings of every utility."""
+        return self.grammar.mappings
 
     def get_utilities(self):
         """Gets a list of all of the utilities supported by the generator, ordered by usage"""
@@ -37,80 +65,259 @@ class Generator:
     def generate_commands(self, utility, max_commands=None):
         """Generates commands for a given utility or list of utilities.
 
+        When max_commands is smaller than the number of possible commands, the commands are
+        sampled uniformly without replacement straight from the option space index.
+
         :param utility: (str) or (lst) of (str) of the utility(s) to generate commands for.
         :param max_commands: (int) the maximum number of commands to generate.
 
         :returns a (list) of (str) of generated commands.
         """
-        if type(utility) == list:
-            ret = []
-            for ut in utility:
-                ret.extend(self.generate_commands(ut))
+        total = self.count_commands(utility)
+
+        if not max_commands or max_commands > total:
+            ret = list(self.iter_commands(utility))
         else:
-            ops = self._generate_options(utility)
-            ret = []
-            if utility not in self.syntax or "Invalid" in self.syntax[utility]:
-                return ret
-
-            syntax = self.syntax[utility]
-            for option_combo in ops:
-                ret.append(syntax.replace("[Options]", option_combo))
-
-        if not max_commands or max_commands > len(ret):
-            print(f"Generated {len(ret)} commands for {utility}")
-            return ret
-        print(f"Generated {max_commands} commands for {utility}")
-        return random.sample(ret, max_commands)
-
-    def generate_all_commands(self, save_path=None):
+            ret = self.sample_commands(utility, max_commands)
+        METRICS.inc('generated_commands_total', len(ret),
+                    utility=utility if isinstance(utility, str) else ",".join(utility))
+        return ret
+
+    def iter_commands(self, utility):
+        """Lazily generates commands for a given utility or list of utilities.
+
+        Commands are yielded as soon as they are built, and every option combination is produced
+        exactly once, so no set of previously generated commands needs to be kept in memory.
+
+        :param utility: (str) or (lst) of (str) of the utility(s) to generate commands for.
+        :returns a generator of (str) generated commands.
+        """
+        for ut in self._valid_utilities(utility):
+            if ut not in self.grammar.templates:
+                for option_combo in self._iter_options(ut):
+                    yield self.grammar.render(ut, option_combo)
+                continue
+            prefix, suffix = self.grammar.templates[ut]
+            for option_combo in self._iter_options(ut):
+                yield prefix + option_combo + suffix
+
+    def count_commands(self, utility):
+        """Counts the commands that can be generated without generating them.
+
+        :param utility: (str) or (lst) of (str) of the utility(s) to count commands for.
+        :returns (int) the exact number of commands `iter_commands` would generate.
+        """
+        return sum(len(self.option_space(ut)) for ut in self._valid_utilities(utility))
+
+    def command_at(self, utility, index):
+        """Gets the command at a given position of `iter_commands` without enumerating.
+
+        :param utility: (str) or (lst) of (str) of the utility(s) the command belongs to.
+        :param index: (int) the position of the command.
+        :returns (str) the command.
+        """
+        uts = self._valid_utilities(utility)
+        offsets = self._offsets(uts)
+        if index < 0:
+            index += offsets[-1]
+        if not 0 <= index < offsets[-1]:
+            raise IndexError("command index out of range")
+
+        pos = bisect.bisect_right(offsets, index) - 1
+        ut = uts[pos]
+        return self.grammar.render(ut, self.option_space(ut)[index - offsets[pos]])
+
+    def sample_commands(self, utility, k, rng=None):
+        """Samples commands uniformly without replacement by unranking random indices.
+
+        :param utility: (str) or (lst) of (str) of the utility(s) to sample commands for.
+        :param k: (int) the number of commands to sample.
+        :param rng: (optional random.Random) the random number generator to use.
+        :returns (list) of (str) sampled commands.
+        """
+        rng = rng or random
+        uts = self._valid_utilities(utility)
+        offsets = self._offsets(uts)
+
+        ret = []
+        for index in rng.sample(range(offsets[-1]), k):
+            pos = bisect.bisect_right(offsets, index) - 1
+            ut = uts[pos]
+            option_combo = self.option_space(ut)[index - offsets[pos]]
+            ret.append(self.grammar.render(ut, option_combo))
+        return ret
+
+    def option_space(self, utility):
+        """Gets the random access index over the options combinations of a utility.
+
+        :param utility: (str) the utility to get the option space for.
+        :returns (OptionSpace) the option space of the utility.
+        """
+        if utility not in self._spaces:
+            flags = self._valid_flags(utility)
+            if self.compat is not None and utility in self.compat:
+                self._spaces[utility] = CompatibleOptionSpace(
+                    flags, *self.compat.bitsets(utility, flags))
+            else:
+                self._spaces[utility] = OptionSpace(flags)
+        return self._spaces[utility]
+
+    def predicted_acceptance(self, utility, counts=None):
+        """Predicts how many generated commands validation will accept, to plan its budget.
+
+        Needs a compatibility model. Utilities the model has no outcomes for are predicted with
+        the acceptance rate of all utilities pooled.
+
+        :param utility: (str) or (lst) of (str) of the utility(s) to predict for.
+        :param counts: (optional dict) mapping utilities to the number of commands generated
+            for them, defaults to their whole option spaces.
+        :returns (dict) with the number of commands, the number of combinations pruned by the
+            model, the expected number of accepted commands and the predicted acceptance rate,
+            None when the model has no outcomes at all.
+        """
+        pooled = self.compat.acceptance_rate() if self.compat is not None else None
+        commands, pruned, expected = 0, 0, 0.0
+        for ut in self._valid_utilities(utility):
+            space = self.option_space(ut)
+            n = len(space) if counts is None else counts.get(ut, 0)
+            pruned += len(OptionSpace(space.flags)) - len(space)
+            rate = self.compat.acceptance_rate(ut) if self.compat is not None else None
+            rate = pooled if rate is None else rate
+            commands += n
+            expected += n * (rate or 0.0)
+        if pooled is None:
+            return {'commands': commands, 'pruned': pruned, 'expected_accepted': None,
+                    'rate': None}
+        return {'commands': commands, 'pruned': pruned, 'expected_accepted': expected,
+                'rate': expected / commands if commands else 0.0}
+
+    def iter_all_commands(self):
+        """Lazily generates the maximum number of commands for every utility.
+
+        :returns a generator of (str) generated commands.
+        """
+        return self.iter_commands(self.utilities)
+
+    def generate_all_commands(self, save_path=None, build_dir=None):
         """Generates the maximum number of commands for every utility.
 
-        :param save_path: (optional str) the path to a file to save the commands to.
+        :param save_path: (optional str) the path to a file to save the commands to. Commands are
+            streamed to the file as they are generated.
+        :param build_dir: (optional str) a directory to build the commands in incrementally, one
+            shard per utility. Only the shards of utilities whose syntax structure or flag
+            mapping changed since the last build are generated again, see incremental.py.
         :returns (list) of (str) the commands generated.
         """
+        if build_dir is not None:
+            # incremental.py builds on this module, so it is imported only when needed
+            from incremental import build_commands, iter_shards
+            self._report_acceptance(self.utilities)
+            build_commands(self, build_dir, save_path=save_path)
+            return list(iter_shards(build_dir))
+
         ret = []
-        for ut in self.utilities:
-            if ut in self.syntax and ut in self.mappings:
-                ret.extend(self.generate_commands(ut))
+        self._report_acceptance(self.utilities)
+        cmds = self.iter_all_commands()
+        if save_path:
+            write_commands(_collect(cmds, ret), save_path)
+        else:
+            ret.extend(cmds)
+
+        return ret
 
+    def generate_covering_commands(self, utility=None, save_path=None, target=0.95,
+                                   coverage=None, max_commands=None, rng=None, accept=None):
+        """Generates commands until they cover the flags, argument types and flag pairs of
+        utilities.
+
+        Each command is picked among candidates for the coverage it adds, so the target is
+        reached with a small share of the option space, see `iter_covering` in flag_coverage.py.
+
+        :param utility: (optional str) or (lst) of (str) of the utility(s) to generate commands
+            for, defaults to every utility.
+        :param save_path: (optional str) the path to a file to save the commands to.
+        :param target: (float) the share of the flags, argument types and flag pairs of each
+            utility to cover, from 0 to 1.
+        :param coverage: (optional CoverageIndex) the coverage of commands already validated,
+            only what they miss is generated.
+        :param max_commands: (optional int) the maximum number of commands per utility.
+        :param rng: (optional random.Random) the random number generator to use.
+        :param accept: (optional callable) a function taking a command and returning whether it
+            is valid. Only accepted commands are kept and covered.
+        :returns (list) of (str) the commands generated.
+        """
+        utilities = self._valid_utilities(utility if utility is not None else self.utilities)
+        coverage = coverage or CoverageIndex(self)
+        cmds = iter_covering(self, utilities, coverage, target, max_commands, accept=accept,
+                             rng=rng)
+
+        ret = []
         if save_path:
-            with open(save_path, 'w') as fp:
-                fp.write("\n".join(ret))
+            write_commands(_collect(cmds, ret), save_path)
+        else:
+            ret.extend(cmds)
 
+        report = coverage.report(utilities)
+        print(f"Generated {len(ret)} of {self.count_commands(utilities)} commands, covering "
+              + ", ".join(f"{report[dim][0]}/{report[dim][1]} {dim}s" for dim in DIMENSIONS))
         return ret
 
-    def generate_scaled_commands(self, training_path='data/original_training.txt', save_path=None):
+    def generate_scaled_commands(self, training_path='data/original_training.txt', save_path=None,
+                                 multiplier=10, total=None, top=20, rng=None, report_path=None):
         """Generates commands scaled to distribution of training data.
 
-        :param training_path: (str) the path to the training commands.
+        Every utility of the reference distribution gets a quota in proportion to its count.
+        Quotas larger than the number of commands a utility can generate are capped, and the
+        shortfall is redistributed proportionally to the other utilities, see `allocate_quotas`
+        in quota.py. Quotas are filled by sampling each option space without enumerating it,
+        and commands are streamed to the save file as they are generated.
+
+        :param training_path: (str) the path to the training commands, or to a json file mapping
+            utilities to counts, or a (dict) / (Counter) of utility counts.
         :param save_path: (optional str) the path to a file to save the commands to.
+        :param multiplier: (float) the number of commands to generate per reference command.
+        :param total: (optional int) the total number of commands to generate, overrides the
+            multiplier.
+        :param top: (optional int) the number of most common utilities to use, None uses all.
+        :param rng: (optional random.Random) the random number generator to use.
+        :param report_path: (optional str) the path to a json file to save a comparison of the
+            target and achieved distributions to.
         :returns (list) of (str) the commands generated.
         """
         print(f"Generating commands to match distribution of {training_path}")
-        with open(training_path) as fp:
-            cmds = fp.read().split('\n')
-            ut_list = [cmd.split(' ')[0] for cmd in cmds]
-            ut_count = collections.Counter(ut_list)
-
-        multiplier = 10
-
-        generated_cmds = []
-        for ut, count in ut_count.most_common(20):
-            if ut not in self.syntax:
-                print(f"No support for {ut} utility, not included in the dataset")
+        weights = load_distribution(training_path, top)
+        if total is None:
+            total = round(sum(weights.values()) * multiplier)
+
+        capacities = {}
+        for ut in weights:
+            if self._valid_utilities(ut):
+                capacities[ut] = self.count_commands(ut)
             else:
-                cmds_to_add = self.generate_commands(ut, ut_count[ut] * multiplier)
-                if ut_count[ut] * multiplier > len(cmds_to_add):
-                    print(f"Unable to generate enough commands for {ut}, generated "
-                          f"{len(cmds_to_add)}/{multiplier * ut_count[ut]}")
-                else:
-                    print(f"Successfully generated {len(cmds_to_add)} commands for {ut}")
+                print(f"No support for {ut} utility, not included in the dataset")
+        quotas = allocate_quotas(weights, total, capacities)
+        self._report_acceptance(list(quotas), quotas)
 
-                generated_cmds.extend(cmds_to_add)
+        def scaled():
+            for ut, quota in quotas.items():
+                if quota and quota == capacities[ut]:
+                    yield from self.iter_commands(ut)
+                elif quota:
+                    yield from self.sample_commands(ut, quota, rng)
 
+        generated_cmds = []
+        cmds = scaled()
         if save_path:
-            with open(save_path, 'w') as fp:
-                fp.write("\n".join(generated_cmds))
+            write_commands(_collect(cmds, generated_cmds), save_path)
+        else:
+            generated_cmds.extend(cmds)
+
+        report = distribution_report(weights, quotas, capacities)
+        print(f"Generated {report['total']}/{total} commands, total variation distance from "
+              f"the target distribution {report['distance']:.4f}")
+        if report_path:
+            with open(report_path, 'w') as fp:
+                json.dump(report, fp, indent=2)
 
         return generated_cmds
 
@@ -120,37 +327,103 @@ class Generator:
         :param utility: (str) the utility to generate combinations for
         :return: (list) of (str) of options combinations for the given utility.
         """
-        flag_map = self.mappings[utility]
+        return list(self._iter_options(utility))
+
+    def _iter_options(self, utility):
+        """Lazily generates the distinct options combinations for a particular utility.
+
+        Only flags whose arguments pass `valid_arg` are combined. A combination of one or two
+        flags is produced when at least one more valid flag follows it, mirroring the original
+        triple loop, but each combination is produced exactly once.
+
+        :param utility: (str) the utility to generate combinations for
+        :return: a generator of (str) options combinations for the given utility.
+        """
+        return iter(self.option_space(utility))
+
+    def _report_acceptance(self, utility, counts=None):
+        """Prints the predicted acceptance of the commands to generate, given a compatibility
+        model."""
+        if self.compat is None:
+            return
+        pred = self.predicted_acceptance(utility, counts)
+        if pred['rate'] is None:
+            print(f"Pruned {pred['pruned']} incompatible options combinations")
+            return
+        print(f"Pruned {pred['pruned']} incompatible options combinations, predicted acceptance "
+              f"rate {pred['rate']:.1%} ({pred['expected_accepted']:.0f} of {pred['commands']} "
+              f"commands)")
+
+    def _valid_utilities(self, utility):
+        """Filters a utility or list of utilities down to the distinct ones that can be generated.
+
+        :param utility: (str) or (lst) of (str) of the utility(s).
+        :return: (list) of (str) utilities with a valid syntax structure and flag mapping.
+        """
+        utilities = utility if isinstance(utility, (list, tuple)) else [utility]
 
         ret = []
-        keys = list(flag_map.keys())
-        for i in range(len(keys)):
-            for j in range(i + 1, len(keys)):
-                for k in range(j + 1, len(keys)):
-                    if all(valid_arg(flag_map[x]) for x in [keys[i], keys[j], keys[k]]):
-                        f1 = " ".join([keys[i], flag_map[keys[i]]]) if flag_map[keys[i]] else keys[
-                            i]
-                        f2 = " ".join([keys[j], flag_map[keys[j]]]) if flag_map[keys[j]] else keys[
-                            j]
-                        f3 = " ".join([keys[k], flag_map[keys[k]]]) if flag_map[keys[k]] else keys[
-                            k]
-                        ret.append(f1)
-                        ret.append(" ".join([f1, f2]))
-                        ret.append(" ".join([f1, f2, f3]))
-        return list(set(ret))
-
-
-def replace(rep_path, in_path, out_path='replaced_cmds.txt', reverse=False):
+        for ut in utilities:
+            if ut in ret or ut not in self.syntax or not self.grammar.has_mapping(ut):
+                continue
+            if "Invalid" not in self.syntax[ut]:
+                ret.append(ut)
+        return ret
+
+    def _offsets(self, utilities):
+        """Gets the cumulative command counts of a list of utilities, starting at 0."""
+        offsets = [0]
+        for ut in utilities:
+            offsets.append(offsets[-1] + len(self.option_space(ut)))
+        return offsets
+
+    def _valid_flags(self, utility):
+        """Gets the flags of a utility with valid arguments, rendered with their argument types.
+
+        :param utility: (str) the utility to get flags for.
+        :return: (list) of (str) flags, e.g. ["-delete", "-fls [File]"].
+        """
+        return self.grammar.valid_flags(utility)
+
+
+def write_commands(cmds, path):
+    """Streams commands to a file, one command per line.
+
+    :param cmds: (iterable) of (str) commands to write.
+    :param path: (str) the path of the file to write the commands to.
+    :returns (int) the number of commands written.
+    """
+    count = 0
+    with open(path, 'w') as fp:
+        for cmd in cmds:
+            if count:
+                fp.write("\n")
+            fp.write(cmd)
+            count += 1
+    return count
+
+
+def _collect(items, out):
+    """Yields every item of an iterable while also appending it to a list."""
+    for item in items:
+        out.append(item)
+        yield item
+
+
+def replace(rep_path, in_path, out_path='replaced_cmds.txt', reverse=False, processes=1):
     """Replaces particular words within a list of commands according to a given mapping.
 
     This function can be used to turn a list of generic commands to actual executable commands,
-    or vice versa.
+    or vice versa. The file is streamed through a single compiled matcher in chunks, see
+    `Replacer` in replacer.py.
 
     :param rep_path: (str) the path to a json file with the word mappings.
     :param in_path: (str) the path to a text file with all of the commands to be converted.
     :param out_path: (str) the path to the new file to save all of the converted commands to.
     :param reverse: (bool) whether to reverse the direction of the replacement (i.e. replacing
         executable commands with generic commands).
+    :param processes: (int) the number of processes to convert the file with.
+    :returns (dict) with the number of lines converted, the seconds taken and lines/sec.
 
     Replacement json must be in the format
     {
@@ -159,106 +432,238 @@ def replace(rep_path, in_path, out_path='replaced_cmds.txt', reverse=False):
     }
 
     and would convert
-    'find Folder -regex File' -->   'find /abc -regex temp.text'
+    'find [Folder] -regex [File]' -->   'find /abc -regex temp.txt'
     """
+    stats = Replacer.from_file(rep_path, reverse).replace_file(in_path, out_path,
+                                                               processes=processes)
+    print(f"Replaced {stats['lines']} lines in {stats['seconds']:.1f}s "
+          f"({stats['lines_per_sec']:.0f} lines/sec)")
+    return stats
 
-    with open(in_path, 'r') as fp:
-        old_cmds = fp.read()
-
-    with open(rep_path, 'r') as fp:
-        reps = json.load(fp)
-
-    if reverse:
-        reps = {value: key for (key, value) in reps.items()}
-
-    cmds = []
-    old_cmds = old_cmds.split('\n')
-    for cmd in old_cmds:
-        new_cmd = []
-        for word in cmd.split(' '):
-            if word in reps:
-                word = reps[word]
-            new_cmd.append(word)
-        cmds.append(" ".join(new_cmd))
-
-    with open(out_path, 'w') as fp:
-        fp.write("\n".join(cmds))
 
-
-def validate_commands(file_path, out_path=None, checkpoint=0, sudo=False):
+def validate_commands(file_path, out_path=None, checkpoint=0, sudo=False, workers=1, timeout=0.25,
+                      cache=None, journal_path=None, checker=None, sandbox=None, fixtures=None):
     """Validates a list of commands and returns only the valid commands.
 
     Takes in a text file of bash commands and runs them on the command line. All of those
     with non zero exit statuses are returned.
 
+    The outcome of every command is appended to a journal as soon as it is known. Running again
+    with the same journal resumes the validation, skipping every command already recorded, and
+    the output file is written in one pass over the journal once all commands are processed.
+    Progress is printed every few seconds, and when the registry in metrics.py is configured, the
+    outcome and latency of every command are recorded per utility.
+
     ****NOTE****
     Only run in an isolated environment. These commands will be run and will alter the state of
-    the environment.
+    the environment. With more than one worker, commands run concurrently, so commands that
+    change the environment can affect the outcome of other commands running at the same time,
+    unless they run in fixture workspaces.
     ****----****
 
     :param file_path: (str) a file path to a text file of commands.
     :param out_path: (optional str) a file path to save the validated commands to.
+    :param checkpoint: (int) the number of leading commands to skip.
     :param sudo: (bool) whether to run the commands as a root user.
+    :param workers: (int) the number of commands to run concurrently.
+    :param timeout: (float) the number of seconds a command may run before it is killed.
+    :param cache: (optional ValidationCache) a cache of previous results, only commands without
+        a cached result are run.
+    :param journal_path: (optional str) a file path to record progress to. Defaults to the output
+        path with a ".journal" suffix. The journal holds a hash of the input file and is only
+        resumed for the same input. Once the output file is written, the journal is renamed
+        with a ".done" suffix.
+    :param checker: (optional StaticChecker) a checker that rejects malformed commands before
+        they are run.
+    :param sandbox: (optional Sandbox) the execution backend to run commands with, defaults to
+        one with the default resource limits, see sandbox.py.
+    :param fixtures: (optional Fixtures) fixture workspaces to run commands in, so every command
+        starts from the same files regardless of the order they run in, see fixtures.py.
     :returns: (list) of (str) commands that came back with a zero exit status.
     """
     with open(file_path, 'r') as f:
         cmds = f.read().split('\n')
-    ret = []
 
-    if checkpoint > 0 and out_path:
-        with open(out_path, 'r') as fp:
-            ret = fp.read().split("\n")
-            ret.pop()
+    if journal_path is None and out_path:
+        journal_path = out_path + ".journal"
+    journal = None
+    if journal_path:
+        digest = hashlib.sha256("\n".join(cmds).encode()).hexdigest()
+        journal = Journal(journal_path, header={'input_sha256': digest})
+        if journal.stale:
+            print(f"Discarded {journal_path}, it records the validation of a different input")
+    done = journal.completed() if journal else set()
+    if done:
+        print(f"Resuming from {journal_path}, {len(done)} commands already processed")
+
+    def pending():
+        for count, cmd in enumerate(cmds):
+            if count < checkpoint or count in done or cmd.split(" ")[0] == "tar":
+                continue
+            if checker is not None and checker.check(cmd):
+                METRICS.inc('validated_commands_total', utility=cmd.split(" ")[0],
+                            outcome='rejected_statically')
+                continue
+            yield count, cmd
+
+    accepted = set()
+    start, processed, timeouts = time.perf_counter(), 0, 0
+    progress = Progress("validate", total=len(cmds))
+    for res in iter_validate(pending(), workers=workers, timeout=timeout, sudo=sudo, cache=cache,
+                             ordered=journal is None, sandbox=sandbox, fixtures=fixtures):
+        processed += 1
+        timeouts += res.timed_out
+
+        if res.code == 0:
+            accepted.add(res.index)
+        if journal:
+            journal.append(res.index, code=res.code, duration=res.duration,
+                           timed_out=res.timed_out, signal=res.signal, cpu_time=res.cpu_time)
+
+        if METRICS.enabled:
+            ut = cmds[res.index].split(" ")[0]
+            outcome = 'timeout' if res.timed_out else 'accepted' if res.code == 0 else 'rejected'
+            METRICS.inc('validated_commands_total', utility=ut, outcome=outcome,
+                        cached=str(res.cached).lower())
+            if not res.cached:
+                METRICS.observe('validation_latency_seconds', res.duration, utility=ut)
+        progress.update(len(done) + processed, accepted=len(accepted), timeouts=timeouts,
+                        acceptance_rate=len(accepted) / processed)
+    progress.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"Validated {processed} commands in {elapsed:.1f}s "
+          f"({processed / elapsed if elapsed else 0:.1f} commands/sec)")
+    if cache is not None:
+        stats = cache.stats()
+        print(f"Validation cache: {stats['hits']} hits, {stats['misses']} misses "
+              f"({stats['hit_rate']:.1%} hit rate)")
+    if checker is not None:
+        print(f"Statically rejected commands: {checker.rejections()}, let through without a "
+              f"flag mapping: {checker.warnings()}")
+    if fixtures is not None:
+        stats = fixtures.stats()
+        print(f"Fixture workspaces: {stats['resets']} resets ({stats['mean_reset_ms']:.2f}ms "
+              f"each), {stats['clean']} commands left their workspace unchanged")
+
+    if journal:
+        journal.close()
+        accepted = {record['index'] for record in journal.replay() if record['code'] == 0}
+
+    ret = [" ".join(["sudo", cmd]) if sudo else cmd
+           for count, cmd in enumerate(cmds) if count in accepted]
+    if out_path:
+        write_commands(ret, out_path)
+        if journal:
+            os.replace(journal_path, journal_path + ".done")
+    return ret
 
-    for count, cmd in enumerate(cmds):
-        if count < checkpoint or cmd.split(" ")[0] == "tar":
-            print(f"processed {count}/{len(cmds)} commands")
-            continue
 
-        if sudo:
-            cmd = " ".join(["sudo", cmd])
+ValidationResult = collections.namedtuple(
+    'ValidationResult', ['index', 'cmd', 'code', 'duration', 'timed_out', 'cached', 'signal',
+                         'cpu_time'], defaults=[None, None])
 
-        res = Command(cmd).run()
 
-        if res == 0:
-            print("SUCCESS")
-            ret.append(cmd)
+def iter_validate(cmds, workers=1, timeout=0.25, sudo=False, ordered=True, cache=None,
+                  sandbox=None, fixtures=None):
+    """Runs commands concurrently and streams back their exit statuses.
 
-        if out_path and count % 100 == 0:
-            with open(out_path, 'w') as fp:
-                ins = "\n".join(ret + [str(count)])
-                fp.write(ins)
-            print(f"BENCHMARK: {count}")
+    Each command runs through `Command` in its own shell and process group, under the resource
+    limits of the sandbox, so a pool of threads is enough to keep
+    `workers` shells busy at once. At most a few commands per worker are in flight at any time,
+    so arbitrarily long inputs can be streamed through.
 
-        print(f"processed {count}/{len(cmds)} commands")
+    :param cmds: (iterable) of (int, str) tuples of the index and text of each command.
+    :param workers: (int) the number of commands to run concurrently.
+    :param timeout: (float) the number of seconds a command may run before it is killed.
+    :param sudo: (bool) whether to run the commands as a root user.
+    :param ordered: (bool) whether to yield results in input order rather than as they complete.
+    :param cache: (optional ValidationCache) a cache of previous results. Cached commands are
+        not run again and the results of commands that are run are stored in it.
+    :param sandbox: (optional Sandbox) the execution backend to run commands with.
+    :param fixtures: (optional Fixtures) the fixture workspaces to run commands in. Each worker
+        runs its commands in its own workspace, reset whenever a command changed it.
+    :returns: a generator of (ValidationResult), killed commands having the negated signal
+        number as their exit status.
+    """
+    window = max(1, workers) * 4
+    sandbox = sandbox or Sandbox()
 
-    if out_path:
-        with open(out_path, 'w') as fp:
-            fp.write("\n".join(ret))
-    return ret
+    def submit(pool, index, cmd):
+        if sudo:
+            cmd = " ".join(["sudo", cmd])
+        hit = cache.get(cmd, sudo, timeout) if cache is not None else None
+        if hit is None:
+            return pool.submit(_run_indexed, index, cmd, timeout, sandbox, fixtures)
+
+        future = concurrent.futures.Future()
+        code, duration, timed_out, sig, cpu_time = hit
+        future.set_result(ValidationResult(index, cmd, code, duration, timed_out, True, sig,
+                                           cpu_time))
+        return future
+
+    def collect(future):
+        res = future.result()
+        if cache is not None and not res.cached:
+            cache.put(res.cmd, res.code, res.duration, res.timed_out, sudo, timeout, res.signal,
+                      res.cpu_time)
+        return res
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        if ordered:
+            in_flight = collections.deque()
+            for index, cmd in cmds:
+                in_flight.append(submit(pool, index, cmd))
+                if len(in_flight) >= window:
+                    yield collect(in_flight.popleft())
+            while in_flight:
+                yield collect(in_flight.popleft())
+        else:
+            in_flight = set()
+            for index, cmd in cmds:
+                in_flight.add(submit(pool, index, cmd))
+                if len(in_flight) >= window:
+                    done, in_flight = concurrent.futures.wait(
+                        in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        yield collect(future)
+            for future in concurrent.futures.as_completed(in_flight):
+                yield collect(future)
+
+
+def _run_indexed(index, cmd, timeout, sandbox, fixtures):
+    """Runs a single command and tags its result with the command's index."""
+    command = Command(cmd, sandbox)
+    code = command.run(timeout, fixtures.workspace() if fixtures is not None else None)
+    return ValidationResult(index, cmd, code, command.duration, command.timed_out, False,
+                            command.result.signal, command.result.cpu_time)
 
 
 class Command(object):
-    def __init__(self, cmd):
+    def __init__(self, cmd, sandbox=None):
+        """Initializes a shell command to validate.
+
+        :param cmd: (str) the command.
+        :param sandbox: (optional Sandbox) the execution backend to run the command with,
+            defaults to one with the default resource limits.
+        """
         self.cmd = cmd
-        self.process = None
+        self.sandbox = sandbox or Sandbox()
+        self.result = None
         self.code = None
+        self.duration = None
+        self.timed_out = False
 
-    def run_command(self):
-        # capturing the outputs of shell commands
-        self.process = subprocess.Popen(self.cmd, shell=True, stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE, stdin=subprocess.PIPE)
-        self.process.communicate()
-        self.code = self.process.returncode
-
-    # set default timeout to 2 minutes
-    def run(self, timeout=0.25):
-        thread = threading.Thread(target=self.run_command)
-        thread.start()
-        thread.join(timeout)
-        if thread.is_alive():
-            print('Command timeout, kill it: ' + self.cmd)
-            if self.process is not None:
-                self.process.terminate()
-                thread.join(timeout)
+    def run(self, timeout=0.25, cwd=None):
+        """Runs the command in its own process group, killing the whole group on timeout.
+
+        :param timeout: (float) the number of seconds the command may run before it is killed.
+        :param cwd: (optional str) the directory to run the command in.
+        :returns (int) the exit status of the command, the negated signal number when it was
+            killed by a signal, e.g. -9 when it timed out.
+        """
+        self.result = self.sandbox.run(self.cmd, timeout, cwd)
+        self.code = self.result.code
+        self.duration = self.result.wall_time
+        self.timed_out = self.result.timed_out
         return self.code
@@ -0,0 +1,277 @@
+from utils import ARG_TYPES
+import argparse
+import array
+import hashlib
+import json
+import marshal
+import mmap
+import os
+import struct
+import sys
+import time
+
+MAGIC = b'BASHGRAM'
+FORMAT_VERSION = 2
+# magic, format version, marshal version, python major and minor version, sha256 of the syntax
+# file, the map file and the argument types
+HEADER = struct.Struct('<8sIIBB32s32s32s')
+# marshal output is only guaranteed to load on the python version that wrote it
+PYTHON_VERSION = (marshal.version,) + tuple(sys.version_info[:2])
+OPTIONS = "[Options]"
+
+
+class StaleGrammarError(ValueError):
+    """Raised when a compiled grammar does not match the files it was compiled from."""
+
+
+class Grammar:
+    def __init__(self, utilities, syntax, strings, flags, valid, source_hashes=None):
+        """Initializes a grammar of syntax structures and flag mappings with interned strings.
+
+        Every flag, argument type and rendered flag is stored once in a string table and
+        referenced by its position in it. Grammars are usually built with `from_json` or
+        loaded with `load` rather than constructed directly.
+
+        :param utilities: (tuple) of (str) utilities, in the order of the syntax file.
+        :param syntax: (tuple) of (str) the syntax structure of each utility.
+        :param strings: (tuple) of (str) the string table.
+        :param flags: (tuple) of (array) of alternating flag and argument ids of each utility,
+            with an argument id of 0 for flags without arguments.
+        :param valid: (tuple) of (array) of the ids of the rendered flags of each utility with
+            valid arguments, e.g. "-fls [File]".
+        :param source_hashes: (optional tuple) of the (bytes) hashes of the syntax file, the map
+            file and the argument types the grammar was built from.
+        """
+        self.utilities = utilities
+        self.strings = strings
+        self.source_hashes = source_hashes
+        self._index = {ut: i for i, ut in enumerate(utilities)}
+        self._syntax = syntax
+        self._flags = flags
+        self._valid = valid
+        self._mappings = None
+
+        self.syntax = {ut: s for ut, s in zip(utilities, syntax) if s is not None}
+        self.templates = {}
+        for ut, s in self.syntax.items():
+            if s.count(OPTIONS) == 1:
+                self.templates[ut] = tuple(s.split(OPTIONS))
+
+    @property
+    def mappings(self):
+        """The flag to argument type mappings of every utility, decoded on first access."""
+        if self._mappings is None:
+            self._mappings = {ut: self.flag_map(ut) for ut in self.utilities
+                              if self._flags[self._index[ut]] is not None}
+        return self._mappings
+
+    def has_mapping(self, utility):
+        """Determines whether a utility has a flag mapping, without decoding every mapping."""
+        i = self._index.get(utility)
+        return i is not None and self._flags[i] is not None
+
+    def flag_map(self, utility):
+        """Gets the flag to argument type mapping of a single utility.
+
+        :param utility: (str) the utility.
+        :returns (dict) mapping (str) flags to (str) argument types, or None for no argument.
+        """
+        ids = self._flags[self._index[utility]]
+        strings = self.strings
+        return {strings[ids[i]]: strings[ids[i + 1]] if ids[i + 1] else None
+                for i in range(0, len(ids), 2)}
+
+    def valid_flags(self, utility):
+        """Gets the prefiltered flags of a utility, rendered with their argument types.
+
+        :param utility: (str) the utility to get flags for.
+        :returns (list) of (str) flags with valid arguments, e.g. ["-delete", "-fls [File]"].
+        """
+        strings = self.strings
+        return [strings[i] for i in self._valid[self._index[utility]]]
+
+    def render(self, utility, option_combo):
+        """Substitutes an options combination into the syntax structure of a utility.
+
+        :param utility: (str) the utility.
+        :param option_combo: (str) the options combination.
+        :returns (str) the command.
+        """
+        template = self.templates.get(utility)
+        if template is None:
+            return self.syntax[utility].replace(OPTIONS, option_combo)
+        return template[0] + option_combo + template[1]
+
+    @classmethod
+    def from_json(cls, syntax_path='syntax.json', map_path='utility_map.json',
+                  arg_types=ARG_TYPES):
+        """Builds a grammar from the json files written by the scraper.
+
+        :param syntax_path: (str) a file path to retrieve syntax structure.
+        :param map_path: (str) a file path to retrieve utility, flag, arg mappings.
+        :param arg_types: (list) of (str) the argument types flags may take to be generated.
+        :returns (Grammar) the grammar.
+        """
+        with open(syntax_path, 'rb') as fp:
+            syntax_bytes = fp.read()
+        with open(map_path, 'rb') as fp:
+            map_bytes = fp.read()
+        syntax = json.loads(syntax_bytes)
+        mappings = json.loads(map_bytes)
+
+        allowed = frozenset(arg_types)
+        table = {"": 0}
+
+        def intern(s):
+            return table.setdefault(s, len(table))
+
+        utilities = tuple(dict.fromkeys(list(syntax) + list(mappings)))
+        flags, valid = [], []
+        for ut in utilities:
+            if ut not in mappings:
+                flags.append(None)
+                valid.append(array.array('I'))
+                continue
+            ids, rendered = array.array('I'), array.array('I')
+            for flag, arg in mappings[ut].items():
+                ids.extend((intern(flag), intern(arg) if arg else 0))
+                if not arg or arg in allowed:
+                    rendered.append(intern(" ".join([flag, arg]) if arg else flag))
+            flags.append(ids)
+            valid.append(rendered)
+
+        hashes = _hash_sources(syntax_bytes, map_bytes, arg_types)
+        return cls(utilities, tuple(syntax.get(ut) for ut in utilities), tuple(table),
+                   tuple(flags), tuple(valid), hashes)
+
+    def save(self, path='grammar.bin'):
+        """Writes the grammar to a compact binary artifact that loads without parsing json.
+
+        :param path: (str) the path of the artifact to write.
+        :returns (int) the size of the artifact in bytes.
+        """
+        payload = marshal.dumps((
+            self.utilities,
+            self._syntax,
+            self.strings,
+            tuple(None if ids is None else ids.tobytes() for ids in self._flags),
+            tuple(ids.tobytes() for ids in self._valid),
+        ))
+        header = HEADER.pack(MAGIC, FORMAT_VERSION, *PYTHON_VERSION, *self.source_hashes)
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as fp:
+            fp.write(header)
+            fp.write(payload)
+        os.replace(tmp_path, path)
+        return len(header) + len(payload)
+
+    @classmethod
+    def load(cls, path='grammar.bin', syntax_path=None, map_path=None, arg_types=ARG_TYPES):
+        """Memory maps a compiled grammar artifact.
+
+        When the source files are given, the artifact is checked against them and the argument
+        types, so a grammar compiled from older files is never used by mistake. An artifact
+        written by another python version is stale as well.
+
+        :param path: (str) the path of the artifact.
+        :param syntax_path: (optional str) the syntax file the artifact must match.
+        :param map_path: (optional str) the map file the artifact must match.
+        :param arg_types: (list) of (str) the argument types the artifact must match.
+        :returns (Grammar) the grammar.
+        :raises StaleGrammarError: if the artifact was compiled from different sources or by
+            another python version.
+        :raises ValueError: if the file is not a grammar artifact of a supported version.
+        """
+        with open(path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if len(mm) < HEADER.size:
+                raise ValueError(f"{path} is not a compiled grammar")
+            magic, version, *rest = HEADER.unpack_from(mm)
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a compiled grammar")
+            if version != FORMAT_VERSION:
+                raise ValueError(f"{path} has grammar format {version}, expected "
+                                 f"{FORMAT_VERSION}")
+            written_by, hashes = tuple(rest[:3]), rest[3:]
+            if written_by != PYTHON_VERSION:
+                raise StaleGrammarError(f"{path} was compiled by python "
+                                        f"{written_by[1]}.{written_by[2]} (marshal version "
+                                        f"{written_by[0]}), recompile it")
+            if syntax_path and map_path:
+                with open(syntax_path, 'rb') as sfp, open(map_path, 'rb') as mfp:
+                    expected = _hash_sources(sfp.read(), mfp.read(), arg_types)
+                if tuple(hashes) != expected:
+                    raise StaleGrammarError(f"{path} is stale, recompile it from "
+                                            f"{syntax_path} and {map_path}")
+            with memoryview(mm) as view:
+                utilities, syntax, strings, flags, valid = marshal.loads(view[HEADER.size:])
+
+        flags = tuple(None if ids is None else _ids(ids) for ids in flags)
+        return cls(utilities, syntax, strings, flags, tuple(_ids(ids) for ids in valid),
+                   tuple(hashes))
+
+
+def load_grammar(syntax_path='syntax.json', map_path='utility_map.json', grammar_path=None):
+    """Loads a compiled grammar artifact, falling back to the json files.
+
+    :param syntax_path: (str) a file path to retrieve syntax structure.
+    :param map_path: (str) a file path to retrieve utility, flag, arg mappings.
+    :param grammar_path: (optional str) the path of a compiled grammar artifact.
+    :returns (Grammar) the grammar.
+    """
+    if grammar_path and os.path.exists(grammar_path):
+        try:
+            return Grammar.load(grammar_path, syntax_path, map_path)
+        except (ValueError, EOFError, TypeError) as e:
+            # marshal raises EOFError or TypeError on truncated or foreign payloads
+            print(f"Not using compiled grammar: {e}")
+    return Grammar.from_json(syntax_path, map_path)
+
+
+def compile_grammar(syntax_path='syntax.json', map_path='utility_map.json',
+                    out_path='grammar.bin'):
+    """Compiles the json syntax structures and flag mappings into a grammar artifact.
+
+    :param syntax_path: (str) a file path to retrieve syntax structure.
+    :param map_path: (str) a file path to retrieve utility, flag, arg mappings.
+    :param out_path: (str) the path of the artifact to write.
+    :returns (Grammar) the compiled grammar.
+    """
+    grammar = Grammar.from_json(syntax_path, map_path)
+    size = grammar.save(out_path)
+    print(f"Compiled {len(grammar.utilities)} utilities and {len(grammar.strings)} strings "
+          f"into {out_path} ({size} bytes)")
+    return grammar
+
+
+def _ids(data):
+    ids = array.array('I')
+    ids.frombytes(data)
+    return ids
+
+
+def _hash_sources(syntax_bytes, map_bytes, arg_types):
+    return (hashlib.sha256(syntax_bytes).digest(), hashlib.sha256(map_bytes).digest(),
+            hashlib.sha256("\n".join(arg_types).encode()).digest())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile syntax structures and flag mappings "
+                                                 "into a binary grammar.")
+    parser.add_argument('--syntax', default='syntax.json')
+    parser.add_argument('--map', default='utility_map.json')
+    parser.add_argument('--out', default='grammar.bin')
+    parser.add_argument('--check', action='store_true',
+                        help="only check that the compiled grammar is up to date")
+    args = parser.parse_args()
+
+    if args.check:
+        start = time.perf_counter()
+        Grammar.load(args.out, args.syntax, args.map)
+        print(f"{args.out} is up to date, loaded in {1000 * (time.perf_counter() - start):.2f}ms")
+    else:
+        compile_grammar(args.syntax, args.map, args.out)
+
+
+if __name__ == '__main__':
+    main()
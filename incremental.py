@@ -0,0 +1,262 @@
+from generator import Generator, write_commands, validate_commands
+from replacer import Replacer
+import argparse
+import hashlib
+import json
+import os
+
+MANIFEST_NAME = 'manifest.json'
+# bumped whenever the generated commands change for the same inputs, so every shard is rebuilt
+BUILD_VERSION = 1
+
+
+class BuildManifest:
+    def __init__(self, build_dir):
+        """Opens the manifest of an incremental build, creating the build directory if needed.
+
+        The manifest records, for every utility, the hash of the inputs its shards were built
+        from, the shard files and their sizes. It is rewritten after every shard, so a build
+        that is interrupted keeps the shards that were finished.
+
+        :param build_dir: (str) the directory holding the manifest and the shards.
+        """
+        self.build_dir = build_dir
+        self.path = os.path.join(build_dir, MANIFEST_NAME)
+        os.makedirs(build_dir, exist_ok=True)
+
+        self.data = {'version': BUILD_VERSION, 'utilities': [], 'commands': {}, 'validated': {}}
+        if os.path.exists(self.path):
+            with open(self.path) as fp:
+                data = json.load(fp)
+            if data.get('version') == BUILD_VERSION:
+                self.data = data
+
+    def fresh(self, stage, utility, key):
+        """Checks whether the shard of a utility was built from the same inputs and still exists.
+
+        :param stage: (str) "commands" or "validated".
+        :param utility: (str) the utility.
+        :param key: (str) the hash of the current inputs of the shard.
+        :returns (bool) whether the shard can be reused.
+        """
+        entry = self.data[stage].get(utility)
+        if entry is None or entry['hash'] != key:
+            return False
+        path = os.path.join(self.build_dir, entry['shard'])
+        return os.path.exists(path) and os.path.getsize(path) == entry['bytes']
+
+    def record(self, stage, utility, key, shard, **fields):
+        """Records a shard that was just built and saves the manifest.
+
+        :param stage: (str) "commands" or "validated".
+        :param utility: (str) the utility.
+        :param key: (str) the hash of the inputs of the shard.
+        :param shard: (str) the path of the shard, relative to the build directory.
+        :param fields: other JSON serializable values to record, e.g. the number of commands.
+        """
+        size = os.path.getsize(os.path.join(self.build_dir, shard))
+        self.data[stage][utility] = dict(fields, hash=key, shard=shard, bytes=size)
+        self.save()
+
+    def remove(self, stage, utility):
+        """Removes the shard of a utility and its entry."""
+        entry = self.data[stage].pop(utility, None)
+        if entry is not None:
+            path = os.path.join(self.build_dir, entry['shard'])
+            if os.path.exists(path):
+                os.remove(path)
+            self.save()
+
+    def shard_path(self, stage, utility):
+        """Gets the absolute path of the shard of a utility."""
+        return os.path.join(self.build_dir, self.data[stage][utility]['shard'])
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as fp:
+            json.dump(self.data, fp, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+def utility_hash(generator, utility):
+    """Hashes everything the commands of a utility are generated from.
+
+    That is the syntax structure of the utility, its flag mapping in order, the flags with valid
+    arguments and, with a compatibility model, the conflicts and requirements of its flags. An
+    edit to the json files that does not touch a utility leaves its hash unchanged.
+
+    :param generator: (Generator) the generator.
+    :param utility: (str) the utility.
+    :returns (str) a hex digest.
+    """
+    grammar = generator.grammar
+    flags = grammar.valid_flags(utility)
+    inputs = [BUILD_VERSION, grammar.syntax[utility], list(grammar.flag_map(utility).items()),
+              flags]
+    if generator.compat is not None and utility in generator.compat:
+        inputs.append(generator.compat.bitsets(utility, flags))
+    return hashlib.sha256(json.dumps(inputs).encode()).hexdigest()
+
+
+def build_commands(generator, build_dir, utilities=None, save_path=None):
+    """Generates the maximum number of commands of every utility, one shard per utility,
+    rebuilding only the shards whose inputs changed since the last build.
+
+    :param generator: (Generator) the generator.
+    :param build_dir: (str) the directory holding the manifest and the shards.
+    :param utilities: (optional list) of (str) utilities, defaults to every generator utility.
+        Shards of other utilities, generated and validated, are removed.
+    :param save_path: (optional str) the path to a file to save the commands of all shards to.
+    :returns (dict) with the lists of "rebuilt", "skipped" and "removed" utilities.
+    """
+    manifest = BuildManifest(build_dir)
+    utilities = generator._valid_utilities(utilities or generator.utilities)
+    os.makedirs(os.path.join(build_dir, 'commands'), exist_ok=True)
+
+    report = {'rebuilt': [], 'skipped': [], 'removed': []}
+    for ut in utilities:
+        key = utility_hash(generator, ut)
+        if manifest.fresh('commands', ut, key):
+            report['skipped'].append(ut)
+            continue
+        shard = os.path.join('commands', ut + '.txt')
+        tmp = os.path.join(build_dir, shard + '.tmp')
+        count = write_commands(generator.iter_commands(ut), tmp)
+        os.replace(tmp, os.path.join(build_dir, shard))
+        manifest.record('commands', ut, key, shard, commands=count)
+        report['rebuilt'].append(ut)
+
+    for ut in sorted(set(manifest.data['commands']) - set(utilities)):
+        manifest.remove('commands', ut)
+        manifest.remove('validated', ut)
+        report['removed'].append(ut)
+    manifest.data['utilities'] = utilities
+    manifest.save()
+
+    if save_path:
+        write_commands(iter_shards(build_dir, 'commands', utilities), save_path)
+    _print_report("Generation", report)
+    return report
+
+
+def validate_build(build_dir, rep_path='rep_map.json', utilities=None, save_path=None,
+                   sudo=False, timeout=0.25, fixtures=None, sandbox=None, **kwargs):
+    """Validates the command shards of a build, revalidating only the shards whose commands,
+    word mappings or validation settings changed since they were last validated.
+
+    The commands of each shard have their words replaced with the mappings, are run with
+    `validate_commands` and the accepted ones are kept in a validated shard. Every shard has its
+    own journal, so an interrupted validation resumes within the shard it stopped in.
+
+    :param build_dir: (str) the directory of a build made with `build_commands`.
+    :param rep_path: (str) the path to a json file with the word mappings.
+    :param utilities: (optional list) of (str) utilities, defaults to every utility of the last
+        build. Validated shards of other utilities are kept unless they are no longer built.
+    :param save_path: (optional str) the path to a file to save the accepted commands of all
+        shards to.
+    :param sudo: (bool) whether to run the commands as a root user.
+    :param timeout: (float) the number of seconds a command may run before it is killed.
+    :param fixtures: (optional Fixtures) fixture workspaces to run commands in.
+    :param sandbox: (optional Sandbox) the execution backend to run commands with.
+    :param kwargs: other arguments of `validate_commands`, e.g. workers or checker.
+    :returns (dict) with the lists of "rebuilt", "skipped" and "removed" utilities.
+    """
+    manifest = BuildManifest(build_dir)
+    if utilities is None:
+        utilities = manifest.data['utilities']
+    replacer = Replacer.from_file(rep_path)
+    with open(rep_path, 'rb') as fp:
+        rep_hash = hashlib.sha256(fp.read()).hexdigest()
+    settings = [rep_hash, sudo, timeout, fixtures.version() if fixtures is not None else None,
+                sandbox.prefix if sandbox is not None else None,
+                kwargs.get('checker') is not None]
+    os.makedirs(os.path.join(build_dir, 'validated'), exist_ok=True)
+
+    report = {'rebuilt': [], 'skipped': [], 'removed': []}
+    for ut in utilities:
+        if not manifest.fresh('commands', ut, manifest.data['commands'].get(ut, {}).get('hash')):
+            raise FileNotFoundError(f"no command shard of {ut} in {build_dir}, build it first")
+        key = hashlib.sha256(json.dumps([manifest.data['commands'][ut]['hash']] + settings)
+                             .encode()).hexdigest()
+        if manifest.fresh('validated', ut, key):
+            report['skipped'].append(ut)
+            continue
+
+        shard = os.path.join('validated', ut + '.txt')
+        out_path = os.path.join(build_dir, shard)
+        replaced = out_path + '.in'
+        replacer.replace_file(manifest.shard_path('commands', ut), replaced)
+        # journals are named after the inputs, so a stale one is never resumed
+        journal_path = f"{out_path}.{key[:16]}.journal"
+        for name in os.listdir(os.path.dirname(out_path)):
+            if name.startswith(ut + '.txt.') and '.journal' in name \
+                    and os.path.join(os.path.dirname(out_path), name) != journal_path:
+                os.remove(os.path.join(os.path.dirname(out_path), name))
+
+        accepted = validate_commands(replaced, out_path, sudo=sudo, timeout=timeout,
+                                     journal_path=journal_path, fixtures=fixtures,
+                                     sandbox=sandbox, **kwargs)
+        os.remove(replaced)
+        os.remove(journal_path + '.done')
+        manifest.record('validated', ut, key, shard, accepted=len(accepted))
+        report['rebuilt'].append(ut)
+
+    for ut in sorted(set(manifest.data['validated']) - set(manifest.data['commands'])):
+        manifest.remove('validated', ut)
+        report['removed'].append(ut)
+
+    if save_path:
+        write_commands(iter_shards(build_dir, 'validated', utilities), save_path)
+    _print_report("Validation", report)
+    return report
+
+
+def iter_shards(build_dir, stage='commands', utilities=None):
+    """Lazily reads the commands of the shards of a build.
+
+    :param build_dir: (str) the directory of the build.
+    :param stage: (str) "commands" for the generated commands or "validated" for the accepted
+        ones.
+    :param utilities: (optional list) of (str) utilities, defaults to every utility of the last
+        build, in order.
+    :returns a generator of (str) commands.
+    """
+    manifest = BuildManifest(build_dir)
+    for ut in utilities if utilities is not None else manifest.data['utilities']:
+        with open(manifest.shard_path(stage, ut)) as fp:
+            for line in fp:
+                line = line.rstrip('\n')
+                if line:
+                    yield line
+
+
+def _print_report(name, report):
+    print(f"{name}: rebuilt {len(report['rebuilt'])} shards ({', '.join(report['rebuilt'])}), "
+          f"skipped {len(report['skipped'])} unchanged shards, removed "
+          f"{len(report['removed'])} shards")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate and validate commands one shard per "
+                                                 "utility, rebuilding only changed shards.")
+    parser.add_argument('task', choices=['generate', 'validate'])
+    parser.add_argument('--build-dir', default='build')
+    parser.add_argument('--out', help="a file to save the commands of every shard to")
+    parser.add_argument('--syntax-path', default='syntax.json')
+    parser.add_argument('--map-path', default='utility_map.json')
+    parser.add_argument('--rep-path', default='rep_map.json')
+    parser.add_argument('--utilities', nargs='*')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=0.25)
+    args = parser.parse_args()
+
+    if args.task == 'generate':
+        generator = Generator(args.syntax_path, args.map_path)
+        build_commands(generator, args.build_dir, args.utilities, args.out)
+    else:
+        validate_build(args.build_dir, args.rep_path, args.utilities, args.out,
+                       timeout=args.timeout, workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
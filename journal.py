@@ -0,0 +1,116 @@
+import json
+import os
+
+
+class Journal:
+    def __init__(self, path, sync_every=100, header=None):
+        """Initializes an append-only journal of indexed records.
+
+        Each record is a single JSON line holding the index of the item it describes, so records
+        can be written in any order, e.g. as concurrent work completes. Writes are flushed to the
+        operating system immediately and synced to disk in batches.
+
+        A journal with a header describes the work its records belong to, e.g. a hash of the
+        input. An existing journal whose header differs is stale and is started over.
+
+        :param path: (str) the path to the journal file, created if it does not exist.
+        :param sync_every: (int) the number of records to write between syncs to disk.
+        :param header: (optional dict) JSON serializable values identifying the work.
+        """
+        self.path = path
+        self.sync_every = sync_every
+        self._unsynced = 0
+        self.stale = False
+
+        self._truncate_partial_record()
+        if header is not None and os.path.exists(path) and os.path.getsize(path):
+            first = next(read_records(path, headers=True), None)
+            self.stale = first != {'header': header}
+        self.fp = open(path, 'w' if self.stale else 'a')
+        if header is not None and not self.fp.tell():
+            self.fp.write(json.dumps({'header': header}) + "\n")
+            self.fp.flush()
+
+    def append(self, index, **fields):
+        """Appends a record to the journal.
+
+        :param index: (int) the index of the item the record describes.
+        :param fields: any other JSON serializable values to record.
+        """
+        self.fp.write(json.dumps(dict(index=index, **fields)) + "\n")
+        self.fp.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        """Forces all records written so far onto disk."""
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self._unsynced = 0
+
+    def replay(self):
+        """Reads back every complete record in the journal in the order they were written.
+
+        :returns a generator of (dict) records.
+        """
+        if not self.fp.closed:
+            self.fp.flush()
+        return read_records(self.path)
+
+    def completed(self):
+        """Gets the indices of every item with a record in the journal.
+
+        :returns (set) of (int) indices.
+        """
+        return {record['index'] for record in self.replay()}
+
+    def high_water_mark(self):
+        """Gets the number of leading items that all have a record in the journal.
+
+        Items past the high water mark may also have records when work completes out of order.
+
+        :returns (int) the smallest index without a record.
+        """
+        done = self.completed()
+        mark = 0
+        while mark in done:
+            mark += 1
+        return mark
+
+    def close(self):
+        """Syncs and closes the journal."""
+        self.sync()
+        self.fp.close()
+
+    def _truncate_partial_record(self):
+        """Removes a trailing record left half written by an interrupted run."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as fp:
+            data = fp.read()
+            if data and not data.endswith(b"\n"):
+                fp.truncate(data.rfind(b"\n") + 1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_records(path, headers=False):
+    """Reads the complete records of a journal file without modifying it.
+
+    A journal still being written may end with a partial record, which is skipped.
+
+    :param path: (str) the path to the journal file.
+    :param headers: (bool) whether to also yield the header record.
+    :returns a generator of (dict) records.
+    """
+    with open(path) as fp:
+        for line in fp:
+            if line.endswith("\n"):
+                record = json.loads(line)
+                if headers or 'header' not in record:
+                    yield record
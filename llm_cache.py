@@ -0,0 +1,95 @@
+import hashlib
+import json
+import sqlite3
+
+
+class ResponseCache:
+    def __init__(self, path='llm_cache.db', cache_sampled=False):
+        """Initializes an on-disk cache of completions, keyed by model, prompt and parameters.
+
+        Only deterministic requests, those with a temperature of 0, are cached by default, since
+        repeating a sampled prompt is usually meant to produce a different completion.
+
+        :param path: (str) the path to the SQLite database holding the cache.
+        :param cache_sampled: (bool) whether to also cache requests with a non zero temperature.
+        """
+        self.path = path
+        self.cache_sampled = cache_sampled
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, "
+                          "text TEXT)")
+        self.conn.commit()
+
+    def cacheable(self, params):
+        """Determines whether requests made with the given parameters may be cached.
+
+        :param params: (dict) the completion parameters.
+        :returns (bool) whether the completions can be looked up and stored.
+        """
+        return self.cache_sampled or params.get('temperature', 1) == 0
+
+    def key(self, prompt, params):
+        """Gets the cache key of a prompt sent with particular completion parameters.
+
+        :param prompt: (str) the prompt.
+        :param params: (dict) the completion parameters, including the model and temperature.
+        :returns (str) a hex digest identifying the request.
+        """
+        ident = json.dumps([params.get('model'), prompt, params.get('temperature'),
+                            sorted(params.items())], default=str)
+        return hashlib.sha256(ident.encode()).hexdigest()
+
+    def get(self, prompt, params):
+        """Looks up the stored completion of a prompt.
+
+        :param prompt: (str) the prompt.
+        :param params: (dict) the completion parameters.
+        :returns (str) the completion, or None if it is not cached.
+        """
+        row = self.conn.execute("SELECT text FROM completions WHERE key = ?",
+                                (self.key(prompt, params),)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, prompt, params, text):
+        """Stores the completion of a prompt.
+
+        :param prompt: (str) the prompt.
+        :param params: (dict) the completion parameters.
+        :param text: (str) the completion.
+        """
+        self.conn.execute("INSERT OR REPLACE INTO completions VALUES (?, ?)",
+                          (self.key(prompt, params), text))
+
+    def commit(self):
+        """Writes all stored completions to disk."""
+        self.conn.commit()
+
+    def stats(self):
+        """Gets the hit and miss statistics of the cache since it was opened.
+
+        :returns (dict) with the number of hits, misses and the hit rate.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        """Writes all stored completions to disk and closes the cache."""
+        self.conn.commit()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,375 @@
+import asyncio
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from metrics import METRICS
+
+
+class RateLimitError(Exception):
+    def __init__(self, retry_after=None):
+        """Raised by a backend when the provider rejects a request for exceeding its rate limit.
+
+        :param retry_after: (optional float) the number of seconds the provider asked to wait.
+        """
+        super().__init__("rate limited by provider")
+        self.retry_after = retry_after
+
+
+class TransientError(Exception):
+    """Raised by a backend when a request failed in a way that may succeed if retried, e.g. a 5xx
+    status, a dropped connection or a timeout."""
+
+
+class TokenBucket:
+    def __init__(self, per_minute, capacity=None):
+        """Initializes a token bucket that refills continuously at a fixed rate.
+
+        :param per_minute: (float) the number of tokens added to the bucket per minute.
+        :param capacity: (optional float) the maximum number of tokens the bucket holds.
+            Defaults to one minute worth of tokens.
+        """
+        self.rate = per_minute / 60
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        """Waits until the bucket holds enough tokens and takes them.
+
+        :param amount: (float) the number of tokens to take, capped at the bucket capacity.
+        """
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class OpenAIBackend:
+    def __init__(self, api_key=None):
+        """Initializes a backend that sends completions requests through the openai package.
+
+        :param api_key: (optional str) the API key, defaults to the OPENAI_API_KEY variable.
+        """
+        import openai
+
+        self.openai = openai
+        if api_key:
+            openai.api_key = api_key
+
+    async def complete(self, prompts, **params):
+        """Requests completions for a batch of prompts.
+
+        :param prompts: (list) of (str) prompts.
+        :param params: the completion parameters, e.g. model, temperature and max_tokens.
+        :returns (list) of (str) the completion of each prompt, in order.
+        """
+        error = self.openai.error
+        try:
+            response = await self.openai.Completion.acreate(prompt=prompts, **params)
+        except error.RateLimitError:
+            raise RateLimitError()
+        except (error.APIError, error.Timeout, error.APIConnectionError,
+                error.ServiceUnavailableError) as e:
+            raise TransientError(str(e)) from e
+        return _choices_text(response, len(prompts))
+
+
+class HTTPBackend:
+    def __init__(self, url, api_key=None, timeout=60):
+        """Initializes a backend for any server exposing an OpenAI style completions endpoint.
+
+        :param url: (str) the URL of the completions endpoint.
+        :param api_key: (optional str) a bearer token sent with every request.
+        :param timeout: (float) the number of seconds to wait for a response.
+        """
+        self.url = url
+        self.api_key = api_key
+        self.timeout = timeout
+
+    async def complete(self, prompts, **params):
+        """Requests completions for a batch of prompts.
+
+        :param prompts: (list) of (str) prompts.
+        :param params: the completion parameters, e.g. model, temperature and max_tokens.
+        :returns (list) of (str) the completion of each prompt, in order.
+        """
+        return await asyncio.to_thread(self._post, dict(params, prompt=prompts), len(prompts))
+
+    def _post(self, body, n):
+        headers = {'Content-Type': 'application/json'}
+        if self.api_key:
+            headers['Authorization'] = f"Bearer {self.api_key}"
+
+        request = urllib.request.Request(self.url, data=json.dumps(body).encode(),
+                                         headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as r:
+                response = json.load(r)
+        except urllib.error.HTTPError as e:
+            if e.code == 429:
+                retry_after = e.headers.get('Retry-After')
+                raise RateLimitError(float(retry_after) if retry_after else None)
+            if e.code >= 500:
+                raise TransientError(f"server error {e.code}") from e
+            raise
+        except (urllib.error.URLError, ConnectionError, TimeoutError) as e:
+            raise TransientError(str(e)) from e
+        return _choices_text(response, n)
+
+
+class MockServer:
+    def __init__(self, latency=0.05, rate_limit_probability=0.0, port=0):
+        """Initializes a local stand-in for a completions API, for offline tests and benchmarks.
+
+        The server answers every prompt with a fixed bash command or an echo of the prompt,
+        after a configurable delay, and can reject a fraction of requests with a 429 status.
+
+        :param latency: (float) the number of seconds to wait before answering each request.
+        :param rate_limit_probability: (float) the probability of answering with a 429 status.
+        :param port: (int) the port to listen on, 0 picks a free port.
+        """
+        self.latency = latency
+        self.rate_limit_probability = rate_limit_probability
+        self.requests = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        """The URL of the mock completions endpoint."""
+        return f"http://127.0.0.1:{self.server.server_address[1]}/v1/completions"
+
+    def start(self):
+        """Starts serving requests in a background thread."""
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stops the server."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                mock.requests += 1
+                time.sleep(mock.latency)
+
+                if random.random() < mock.rate_limit_probability:
+                    self.send_response(429)
+                    self.send_header('Retry-After', '0.1')
+                    self.end_headers()
+                    return
+
+                prompts = body['prompt'] if isinstance(body['prompt'], list) else [body['prompt']]
+                choices = [{'index': i, 'text': mock.respond(prompt)}
+                           for i, prompt in enumerate(prompts)]
+                data = json.dumps({'choices': choices}).encode()
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    @staticmethod
+    def respond(prompt):
+        """Builds the mock completion of a prompt.
+
+        :param prompt: (str) the prompt.
+        :returns (str) the completion, formatted like the completions of the real API.
+        """
+        if prompt.startswith("Translate to english:"):
+            return "\nRun the command " + prompt.split("\n")[1]
+        return "\nfind . -name '*.txt' -type f"
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class LLMRunner:
+    def __init__(self, backend, concurrency=8, batch_size=10, requests_per_minute=3000,
+                 tokens_per_minute=250000, max_retries=6, max_backoff=60, cache=None):
+        """Initializes a runner that sends prompts to a backend concurrently within rate limits.
+
+        Requests share a backoff delay. Every 429 from the provider doubles it and pauses all
+        requests for that long, and every successful request shrinks it again, so the runner
+        settles just under the rate the provider accepts. Requests that fail with a transient
+        error are retried after a random exponential delay of their own.
+
+        :param backend: the backend to send requests to, e.g. OpenAIBackend or HTTPBackend.
+        :param concurrency: (int) the maximum number of requests in flight at once.
+        :param batch_size: (int) the number of prompts sent in each request.
+        :param requests_per_minute: (float) the maximum number of requests sent per minute.
+        :param tokens_per_minute: (float) the maximum number of prompt and completion tokens
+            requested per minute.
+        :param max_retries: (int) the number of times a rate limited or failed request is
+            retried.
+        :param max_backoff: (float) the maximum number of seconds to back off for.
+        :param cache: (optional ResponseCache) a cache of previous completions. Cached prompts
+            are not sent again and new completions are stored in it.
+        """
+        self.backend = backend
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.cache = cache
+
+        self.backoff = 0.0
+        self.resume_at = 0.0
+        self.requests = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self.saved_requests = 0
+
+    def run(self, prompts, **params):
+        """Gets the completions of a list of prompts.
+
+        :param prompts: (list) of (str) prompts.
+        :param params: the completion parameters, e.g. model, temperature and max_tokens.
+        :returns (list) of (str) the completion of each prompt, in order.
+        """
+        return asyncio.run(self.complete_all(prompts, **params))
+
+    async def complete_all(self, prompts, **params):
+        """Gets the completions of a list of prompts, batching and sending them concurrently.
+
+        When the runner has a cache and the request is cacheable, cached prompts are answered
+        from the cache and repeated prompts are only sent once.
+
+        :param prompts: (list) of (str) prompts.
+        :param params: the completion parameters, e.g. model, temperature and max_tokens.
+        :returns (list) of (str) the completion of each prompt, in order.
+        """
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._requests_bucket = TokenBucket(self.requests_per_minute)
+        self._tokens_bucket = TokenBucket(self.tokens_per_minute)
+
+        use_cache = self.cache is not None and self.cache.cacheable(params)
+        known = {}
+        if use_cache:
+            for prompt in prompts:
+                if prompt not in known:
+                    text = self.cache.get(prompt, params)
+                    if text is not None:
+                        known[prompt] = text
+            to_send = list(dict.fromkeys(p for p in prompts if p not in known))
+        else:
+            to_send = prompts
+
+        batches = [to_send[i:i + self.batch_size]
+                   for i in range(0, len(to_send), self.batch_size)]
+        self.saved_requests += -(-len(prompts) // self.batch_size) - len(batches)
+        METRICS.inc('llm_cached_prompts_total', len(prompts) - len(to_send))
+        results = await asyncio.gather(*[self.complete(batch, **params) for batch in batches])
+        texts = [text for batch in results for text in batch]
+
+        if not use_cache:
+            return texts
+
+        for prompt, text in zip(to_send, texts):
+            known[prompt] = text
+            self.cache.put(prompt, params, text)
+        self.cache.commit()
+        return [known[prompt] for prompt in prompts]
+
+    async def complete(self, prompts, **params):
+        """Sends one batch of prompts, waiting for the rate limits and retrying on 429s and
+        transient errors.
+
+        :param prompts: (list) of (str) prompts.
+        :param params: the completion parameters, e.g. model, temperature and max_tokens.
+        :returns (list) of (str) the completion of each prompt, in order.
+        """
+        tokens = sum(len(p) // 4 for p in prompts) + params.get('max_tokens', 256) * len(prompts)
+
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self._requests_bucket.acquire()
+                await self._tokens_bucket.acquire(tokens)
+                delay = self.resume_at - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                self.requests += 1
+                sent = time.perf_counter()
+                try:
+                    texts = await self.backend.complete(prompts, **params)
+                except RateLimitError as e:
+                    METRICS.observe('llm_request_latency_seconds', time.perf_counter() - sent,
+                                    outcome='rate_limited')
+                    METRICS.inc('llm_requests_total', outcome='rate_limited')
+                    self.rate_limited += 1
+                    if attempt == self.max_retries:
+                        raise
+                    self.backoff = min(self.max_backoff, max(1.0, self.backoff * 2))
+                    wait = max(self.backoff, e.retry_after or 0) * random.uniform(0.5, 1.0)
+                    self.resume_at = max(self.resume_at, time.monotonic() + wait)
+                    continue
+                except TransientError:
+                    METRICS.observe('llm_request_latency_seconds', time.perf_counter() - sent,
+                                    outcome='error')
+                    METRICS.inc('llm_requests_total', outcome='error')
+                    self.errors += 1
+                    if attempt == self.max_retries:
+                        raise
+                    await asyncio.sleep(random.uniform(1, max(1, min(self.max_backoff,
+                                                                     2 ** attempt))))
+                    continue
+
+                METRICS.observe('llm_request_latency_seconds', time.perf_counter() - sent,
+                                outcome='ok')
+                METRICS.inc('llm_requests_total', outcome='ok')
+                METRICS.inc('llm_prompts_total', len(prompts))
+                self.backoff /= 2
+                return texts
+
+    def stats(self):
+        """Gets the request statistics of the runner.
+
+        :returns (dict) with the number of requests sent, rate limited, failed with a transient
+            error and saved by the cache, and the cache hit rate.
+        """
+        return {
+            'requests': self.requests,
+            'rate_limited': self.rate_limited,
+            'errors': self.errors,
+            'saved_requests': self.saved_requests,
+            'cache_hit_rate': self.cache.stats()['hit_rate'] if self.cache is not None else 0.0,
+        }
+
+
+def _choices_text(response, n):
+    """Orders the text of the choices of a completions response by prompt index."""
+    texts = [""] * n
+    for choice in response['choices']:
+        texts[choice['index']] = choice['text']
+    return texts
@@ -0,0 +1,278 @@
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+                   60.0)
+
+_NULL_TIMER = contextlib.nullcontext()
+
+
+class Metrics:
+    def __init__(self, sinks=None, enabled=None, buckets=LATENCY_BUCKETS):
+        """Initializes a registry of counters and latency histograms.
+
+        Every metric is identified by its name and labels, e.g. inc("validated_total",
+        utility="find"). While the registry is disabled, recording a metric returns straight away,
+        so instrumented code costs one attribute check per call.
+
+        :param sinks: (optional list) of sinks to write snapshots to on flush, e.g. a
+            JSONLinesSink or a PrometheusSink.
+        :param enabled: (optional bool) whether to record metrics, defaults to whether any sink
+            is given.
+        :param buckets: (tuple) of (float) the upper bounds of the histogram buckets.
+        """
+        self.sinks = list(sinks or [])
+        self.enabled = bool(self.sinks) if enabled is None else enabled
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        """Adds to a counter.
+
+        :param name: (str) the name of the counter.
+        :param value: (float) the amount to add.
+        :param labels: (str) the labels of the counter.
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Records a value, usually a latency in seconds, in a histogram.
+
+        :param name: (str) the name of the histogram.
+        :param value: (float) the value to record.
+        :param labels: (str) the labels of the histogram.
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            hist[0][bisect.bisect_left(self.buckets, value)] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    def timer(self, name, **labels):
+        """Times a block of code into a histogram.
+
+        :param name: (str) the name of the histogram.
+        :param labels: (str) the labels of the histogram.
+        :returns a context manager timing the block it wraps.
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def event(self, record):
+        """Sends a record, e.g. a progress report, to every sink that keeps a log.
+
+        :param record: (dict) a JSON serializable record.
+        """
+        if not self.enabled:
+            return
+        for sink in self.sinks:
+            sink.event(record)
+
+    def snapshot(self):
+        """Gets the current value of every metric.
+
+        :returns (dict) with the "counters" and "histograms", each a (list) of (dict) with the
+            name, labels and values of one metric.
+        """
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = [{'name': name, 'labels': dict(labels), 'buckets': list(self.buckets),
+                           'counts': list(hist[0]), 'sum': hist[1], 'count': hist[2]}
+                          for (name, labels), hist in sorted(self.histograms.items())]
+        return {'time': time.time(), 'counters': counters, 'histograms': histograms}
+
+    def flush(self):
+        """Writes a snapshot of every metric to the sinks."""
+        if not self.enabled or not self.sinks:
+            return
+        snapshot = self.snapshot()
+        for sink in self.sinks:
+            sink.write(snapshot)
+
+
+class _Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class Progress:
+    def __init__(self, name, total=None, interval=5.0, metrics=None):
+        """Initializes a progress report printed at most once per interval.
+
+        :param name: (str) what is being processed, e.g. "validate".
+        :param total: (optional int) the number of items to process.
+        :param interval: (float) the minimum number of seconds between two reports.
+        :param metrics: (optional Metrics) the registry to send reports to and flush along with
+            them, defaults to the global registry.
+        """
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.metrics = metrics or METRICS
+        self.done = 0
+        self.fields = {}
+        self.start = time.perf_counter()
+        self._next = time.monotonic() + interval
+
+    def update(self, done=None, **fields):
+        """Records progress, reporting it if the interval has passed since the last report.
+
+        :param done: (optional int) the number of items processed so far, defaults to one more.
+        :param fields: other values to show in the report, e.g. accepted=12.
+        """
+        self.done = self.done + 1 if done is None else done
+        if fields:
+            self.fields.update(fields)
+        if time.monotonic() >= self._next:
+            self.report()
+
+    def report(self):
+        """Prints the progress and sends it to the metric sinks."""
+        self._next = time.monotonic() + self.interval
+        elapsed = time.perf_counter() - self.start
+        rate = self.done / elapsed if elapsed else 0.0
+
+        count = f"{self.done}/{self.total}" if self.total is not None else str(self.done)
+        extra = "".join(f", {k} {v:.3g}" if isinstance(v, float) else f", {k} {v}"
+                        for k, v in self.fields.items())
+        print(f"{self.name}: processed {count} ({rate:.1f}/sec){extra}")
+
+        self.metrics.event(dict(type='progress', name=self.name, done=self.done,
+                                total=self.total, seconds=elapsed, rate=rate, **self.fields))
+        self.metrics.flush()
+
+    def close(self):
+        """Reports the final progress."""
+        self.report()
+
+
+class JSONLinesSink:
+    def __init__(self, path):
+        """Initializes a sink appending every snapshot and event to a JSON lines file.
+
+        :param path: (str) the path of the file, created if it does not exist.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, snapshot):
+        self.event(dict(type='snapshot', **snapshot))
+
+    def event(self, record):
+        record.setdefault('time', time.time())
+        line = json.dumps(record) + "\n"
+        with self._lock, open(self.path, 'a') as fp:
+            fp.write(line)
+
+
+class PrometheusSink:
+    def __init__(self, path, prefix='bash_gen_'):
+        """Initializes a sink rewriting a Prometheus text file with the latest snapshot.
+
+        The file is written next to its destination and renamed over it, so a node exporter
+        textfile collector never reads a partial file.
+
+        :param path: (str) the path of the file, usually ending in ".prom".
+        :param prefix: (str) a prefix added to every metric name.
+        """
+        self.path = path
+        self.prefix = prefix
+
+    def write(self, snapshot):
+        lines, typed = [], set()
+        for c in snapshot['counters']:
+            name = self.prefix + c['name']
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_labels(c['labels'])} {c['value']}")
+
+        for h in snapshot['histograms']:
+            name = self.prefix + h['name']
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in zip(list(h['buckets']) + ['+Inf'], h['counts']):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(h['labels'], le=bound)} {cumulative}")
+            lines.append(f"{name}_sum{_labels(h['labels'])} {h['sum']}")
+            lines.append(f"{name}_count{_labels(h['labels'])} {h['count']}")
+
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as fp:
+            fp.write("\n".join(lines) + "\n")
+        os.replace(tmp, self.path)
+
+    def event(self, record):
+        pass
+
+
+def _labels(labels, **extra):
+    """Renders labels in the Prometheus text format, e.g. {utility="find"}."""
+    labels = dict(labels, **extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def configure(sinks=None, enabled=True):
+    """Enables the global registry and sets its sinks.
+
+    :param sinks: (optional list) of sinks to write snapshots to.
+    :param enabled: (bool) whether to record metrics.
+    :returns (Metrics) the global registry.
+    """
+    METRICS.sinks = list(sinks or [])
+    METRICS.enabled = enabled
+    return METRICS
+
+
+def sinks_from_paths(jsonl_path=None, prom_path=None):
+    """Builds the sinks for the metric output paths given on a command line.
+
+    :param jsonl_path: (optional str) the path of a JSON lines file.
+    :param prom_path: (optional str) the path of a Prometheus text file.
+    :returns (list) of sinks.
+    """
+    sinks = []
+    if jsonl_path:
+        sinks.append(JSONLinesSink(jsonl_path))
+    if prom_path:
+        sinks.append(PrometheusSink(prom_path))
+    return sinks
+
+
+# the registry instrumented code records to, disabled until configured
+METRICS = Metrics(enabled=False)
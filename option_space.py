@@ -0,0 +1,294 @@
+from math import comb
+import bisect
+import random
+
+
+class OptionSpace:
+    def __init__(self, flags):
+        """Initializes a random access index over the options combinations of a utility.
+
+        The space holds the same combinations as the generator's nested loop over flags: every
+        combination of three flags, every combination of two flags followed by at least one more
+        flag, and every single flag followed by at least two more flags. Combinations are ordered
+        by size and then lexicographically by flag position, so any combination can be built
+        (unranked) from its index without enumerating the ones before it.
+
+        :param flags: (list) of (str) flags rendered with their argument types.
+        """
+        self.flags = list(flags)
+        n = len(self.flags)
+
+        # (number of flags to choose from, combination size) for singles, pairs and triples
+        self._blocks = [(n - 2, 1), (n - 1, 2), (n, 3)] if n >= 3 else []
+        self._sizes = [comb(m, k) for m, k in self._blocks]
+
+    def __len__(self):
+        return sum(self._sizes)
+
+    def __getitem__(self, index):
+        """Gets the options combination at a given index.
+
+        :param index: (int) the index of the combination, negative indices count from the end.
+        :returns (str) the options combination.
+        """
+        return " ".join(self.flags[i] for i in self.combination(index))
+
+    def combination(self, index):
+        """Gets the positions of the flags of the combination at a given index.
+
+        :param index: (int) the index of the combination, negative indices count from the end.
+        :returns (list) of (int) strictly increasing positions into the flag list.
+        """
+        size = len(self)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError("option space index out of range")
+
+        for (m, k), block_size in zip(self._blocks, self._sizes):
+            if index < block_size:
+                return _unrank(m, k, index)
+            index -= block_size
+
+    def compatible(self, position):
+        """Gets the flags combined with a flag in at least one combination of the space.
+
+        :param position: (int) the position of the flag.
+        :returns (int) a bitset of flag positions.
+        """
+        if not self._blocks:
+            return 0
+        return ((1 << len(self.flags)) - 1) & ~(1 << position)
+
+    def __iter__(self):
+        flags = self.flags
+        n = len(flags)
+
+        for i in range(n - 2):
+            yield flags[i]
+        for i in range(n - 2):
+            for j in range(i + 1, n - 1):
+                yield " ".join([flags[i], flags[j]])
+        for i in range(n - 2):
+            for j in range(i + 1, n - 1):
+                for k in range(j + 1, n):
+                    yield " ".join([flags[i], flags[j], flags[k]])
+
+    def rank(self, positions):
+        """Gets the index of the combination made of the flags at the given positions.
+
+        :param positions: (list) of (int) strictly increasing positions into the flag list.
+        :returns (int) the index of the combination within the space.
+        """
+        offset = 0
+        for (m, k), block_size in zip(self._blocks, self._sizes):
+            if len(positions) == k:
+                if positions[-1] >= m or any(a >= b for a, b in zip(positions, positions[1:])):
+                    break
+                return offset + _rank(m, k, positions)
+            offset += block_size
+        raise ValueError(f"{positions} is not a combination in the option space")
+
+    def sample(self, k, rng=None):
+        """Samples combinations uniformly without replacement.
+
+        Only the sampled indices are unranked, so the cost depends on k and not on the size of
+        the space.
+
+        :param k: (int) the number of combinations to sample.
+        :param rng: (optional random.Random) the random number generator to use.
+        :returns (list) of (str) sampled options combinations.
+        """
+        rng = rng or random
+        return [self[i] for i in rng.sample(range(len(self)), k)]
+
+
+def _rank(m, k, combo):
+    """Gets the lexicographic rank of a k-combination of range(m)."""
+    r, v = 0, 0
+    for i, c in enumerate(combo):
+        while v < c:
+            r += comb(m - 1 - v, k - 1 - i)
+            v += 1
+        v += 1
+    return r
+
+
+def _unrank(m, k, r):
+    """Gets the k-combination of range(m) with the given lexicographic rank."""
+    combo, v = [], 0
+    for i in range(k):
+        while True:
+            c = comb(m - 1 - v, k - 1 - i)
+            if r < c:
+                break
+            r -= c
+            v += 1
+        combo.append(v)
+        v += 1
+    return combo
+
+
+class CompatibleOptionSpace(OptionSpace):
+    def __init__(self, flags, conflicts=None, requires=None):
+        """Initializes a random access index over the compatible options combinations of a
+        utility.
+
+        The space holds the combinations of `OptionSpace`, in the same order, except those
+        with two conflicting flags and those with a flag none of whose required flags is in
+        the combination. Flag sets are bitsets, so the number of combinations starting with each
+        flag or pair of flags is counted with a few integer operations, and combinations are
+        unranked from these counts like in `OptionSpace`.
+
+        :param flags: (list) of (str) flags rendered with their argument types.
+        :param conflicts: (optional list) of (int) bitsets, bit j of conflicts[i] being set when
+            flags i and j cannot be combined.
+        :param requires: (optional list) of (int) bitsets or None, requires[i] holding the flags
+            one of which must be combined with flag i, or None when flag i needs no other flag.
+        """
+        super().__init__(flags)
+        n = len(self.flags)
+        self._all = (1 << n) - 1
+        conflicts = conflicts or [0] * n
+        requires = requires or [None] * n
+
+        self._compatible = [self._all & ~conflicts[i] & ~(1 << i) for i in range(n)]
+        self._requires = [self._all if r is None else r for r in requires]
+        self._independent = independent = sum(1 << i for i, r in enumerate(requires) if r is None)
+        # ok[i] holds the flags whose requirement is met by flag i, or that need no other flag
+        self._ok = [independent] * n
+        for i, r in enumerate(requires):
+            if r is not None:
+                for j in _bits(r):
+                    self._ok[j] |= 1 << i
+
+        # together[i] holds the flags combined with flag i in at least one combination
+        self._together = [0] * n
+        if n < 3:
+            self._singles, self._pair_offsets, self._triple_offsets = [], [0], [0]
+            self._pair_seconds = []
+            return
+        self._singles = [i for i in range(n - 2) if requires[i] is None]
+        self._pair_offsets = [0]
+        for a in range(n - 1):
+            mask = self._pair_mask(a)
+            self._pair_offsets.append(self._pair_offsets[-1] + _popcount(mask))
+            self._together[a] |= mask
+        # for every first flag, the second flags with their cumulative numbers of triples
+        self._pair_seconds = []
+        self._triple_offsets = [0]
+        for a in range(n):
+            seconds, cumulative, total = [], [0], 0
+            for b in _bits(self._compatible[a] & ~((2 << a) - 1)):
+                mask = self._triple_mask(a, b)
+                if mask:
+                    seconds.append(b)
+                    total += _popcount(mask)
+                    cumulative.append(total)
+                    self._together[a] |= mask | 1 << b
+                    self._together[b] |= mask
+            self._pair_seconds.append((seconds, cumulative))
+            self._triple_offsets.append(self._triple_offsets[-1] + total)
+        for a in range(n):
+            for b in _bits(self._together[a]):
+                self._together[b] |= 1 << a
+
+    def __len__(self):
+        return len(self._singles) + self._pair_offsets[-1] + self._triple_offsets[-1]
+
+    def combination(self, index):
+        size = len(self)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError("option space index out of range")
+
+        if index < len(self._singles):
+            return [self._singles[index]]
+        index -= len(self._singles)
+        if index < self._pair_offsets[-1]:
+            a = bisect.bisect_right(self._pair_offsets, index) - 1
+            return [a, _nth_bit(self._pair_mask(a), index - self._pair_offsets[a])]
+        index -= self._pair_offsets[-1]
+        a = bisect.bisect_right(self._triple_offsets, index) - 1
+        index -= self._triple_offsets[a]
+        seconds, cumulative = self._pair_seconds[a]
+        pos = bisect.bisect_right(cumulative, index) - 1
+        b = seconds[pos]
+        return [a, b, _nth_bit(self._triple_mask(a, b), index - cumulative[pos])]
+
+    def compatible(self, position):
+        return self._together[position]
+
+    def __iter__(self):
+        flags = self.flags
+        for a in self._singles:
+            yield flags[a]
+        for a in range(len(self._pair_offsets) - 1):
+            for b in _bits(self._pair_mask(a)):
+                yield " ".join([flags[a], flags[b]])
+        for a, (seconds, _) in enumerate(self._pair_seconds):
+            for b in seconds:
+                for c in _bits(self._triple_mask(a, b)):
+                    yield " ".join([flags[a], flags[b], flags[c]])
+
+    def rank(self, positions):
+        n = len(self.flags)
+        if any(not 0 <= p < n for p in positions) \
+                or any(a >= b for a, b in zip(positions, positions[1:])):
+            raise ValueError(f"{positions} is not a combination in the option space")
+
+        if len(positions) == 1 and positions[0] in self._singles:
+            return self._singles.index(positions[0])
+        offset = len(self._singles)
+        if len(positions) == 2 and positions[0] < len(self._pair_offsets) - 1:
+            a, b = positions
+            mask = self._pair_mask(a)
+            if mask >> b & 1:
+                return offset + self._pair_offsets[a] + _popcount(mask & ((1 << b) - 1))
+        offset += self._pair_offsets[-1]
+        if len(positions) == 3:
+            a, b, c = positions
+            seconds, cumulative = self._pair_seconds[a]
+            pos = bisect.bisect_left(seconds, b)
+            if pos < len(seconds) and seconds[pos] == b:
+                mask = self._triple_mask(a, b)
+                if mask >> c & 1:
+                    return offset + self._triple_offsets[a] + cumulative[pos] \
+                        + _popcount(mask & ((1 << c) - 1))
+        raise ValueError(f"{positions} is not a combination in the option space")
+
+    def _pair_mask(self, a):
+        """Gets the flags that complete a pair starting with flag a."""
+        mask = self._compatible[a] & ~((2 << a) - 1) & (self._all >> 1) & self._ok[a]
+        return mask if self._independent >> a & 1 else mask & self._requires[a]
+
+    def _triple_mask(self, a, b):
+        """Gets the flags that complete a triple starting with flags a and b."""
+        mask = self._compatible[a] & self._compatible[b] & ~((2 << b) - 1) \
+            & (self._ok[a] | self._ok[b])
+        if not self._ok[b] >> a & 1:
+            mask &= self._requires[a]
+        if not self._ok[a] >> b & 1:
+            mask &= self._requires[b]
+        return mask
+
+
+def _bits(mask):
+    """Iterates over the positions of the set bits of a bitset in increasing order."""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def _nth_bit(mask, r):
+    """Gets the position of the set bit of a bitset with r set bits below it."""
+    for i, pos in enumerate(_bits(mask)):
+        if i == r:
+            return pos
+    raise IndexError("bit index out of range")
+
+
+def _popcount(mask):
+    return bin(mask).count("1")
@@ -0,0 +1,278 @@
+from utils import POST_PIPE
+import bisect
+import random
+
+# utilities that read standard input when their trailing file operand is left out
+READS_STDIN = {'grep', 'wc', 'sort', 'head', 'tail', 'cat', 'cut', 'uniq', 'rev', 'od', 'md5sum',
+               'awk', 'sed', 'tr'}
+
+# utilities run on the file names produced by xargs or find -exec
+NESTED_UTILITIES = ['rm', 'ls', 'grep', 'wc', 'cat', 'head', 'tail', 'du', 'md5sum', 'sort',
+                    'file', 'chmod', 'chown', 'od']
+
+# utilities whose input only comes from standard input, so they never start a pipeline
+STDIN_ONLY = {'xargs'}
+
+FILE = " [File]"
+
+
+class CommandSpace:
+    def __init__(self, generator, utilities, drop_file=False, append=""):
+        """Initializes a random access index over the commands of one or more utilities.
+
+        :param generator: (Generator) the generator providing the syntax and option spaces.
+        :param utilities: (list) of (str) the utilities, in order.
+        :param drop_file: (bool) whether to remove a trailing "[File]" operand from the syntax.
+        :param append: (str) text added to the end of every command.
+        """
+        self.generator = generator
+        self.templates = []
+        self.offsets = [0]
+        for ut in utilities:
+            syntax = generator.syntax[ut]
+            if drop_file and syntax.endswith(FILE):
+                syntax = syntax[:-len(FILE)]
+            self.templates.append((generator.option_space(ut), syntax + append))
+            self.offsets.append(self.offsets[-1] + len(generator.option_space(ut)))
+        self.size = self.offsets[-1]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        pos = bisect.bisect_right(self.offsets, index) - 1
+        space, syntax = self.templates[pos]
+        return syntax.replace("[Options]", space[index - self.offsets[pos]])
+
+    def __iter__(self):
+        for space, syntax in self.templates:
+            prefix, options, suffix = syntax.partition("[Options]")
+            for option_combo in space:
+                yield prefix + option_combo + suffix
+
+
+class ProductSpace:
+    def __init__(self, parts, join):
+        """Initializes a random access index over the product of several spaces.
+
+        Indices are mixed radix numbers with one digit per part, the first part being the most
+        significant, so the product is never materialized. Products easily outgrow what
+        `len` can return, so the number of items is kept in the size attribute.
+
+        :param parts: (list) of the spaces to combine.
+        :param join: (callable) combining the (str) items of every part into one command.
+        """
+        self.parts = parts
+        self.join = join
+        self.size = 1
+        for part in parts:
+            self.size *= part.size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        items = []
+        for part in reversed(self.parts):
+            index, digit = divmod(index, part.size)
+            items.append(part[digit])
+        return self.join(items[::-1])
+
+    def __iter__(self):
+        if self.size:
+            for items in _product(self.parts):
+                yield self.join(items)
+
+
+class UnionSpace:
+    def __init__(self, spaces):
+        """Initializes a random access index over several spaces, one after the other.
+
+        :param spaces: (list) of the spaces to concatenate.
+        """
+        self.spaces = spaces
+        self.offsets = [0]
+        for space in spaces:
+            self.offsets.append(self.offsets[-1] + space.size)
+        self.size = self.offsets[-1]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        pos = bisect.bisect_right(self.offsets, index) - 1
+        return self.spaces[pos][index - self.offsets[pos]]
+
+    def __iter__(self):
+        for space in self.spaces:
+            yield from space
+
+
+class PipelineGenerator:
+    def __init__(self, generator, producers=None, consumers=POST_PIPE, max_depth=2, min_depth=2,
+                 nested=NESTED_UTILITIES, exec_nesting=True):
+        """Initializes a generator of piped commands, e.g. "find ... | xargs grep ... | sort".
+
+        The first stage of a pipeline is any producer command, and every following stage is a
+        consumer command reading standard input, so its trailing "[File]" operand is dropped.
+        xargs stages run a nested command on the names they read, and when exec_nesting is set,
+        find commands also run a nested command through -exec. Pipelines are addressed by index
+        in a mixed radix number system over the stages, so they can be enumerated lazily or
+        sampled without building the product space.
+
+        :param generator: (Generator) the generator providing the syntax and option spaces.
+        :param producers: (optional list) of (str) utilities that may start a pipeline, defaults
+            to every utility of the generator. Utilities in STDIN_ONLY are left out, as they
+            would have nothing to read.
+        :param consumers: (iterable) of (str) utilities that may follow a pipe.
+        :param max_depth: (int) the maximum number of stages in a pipeline.
+        :param min_depth: (int) the minimum number of stages in a pipeline, 1 also includes the
+            producer commands on their own.
+        :param nested: (list) of (str) utilities run by xargs and find -exec.
+        :param exec_nesting: (bool) whether to generate find -exec commands as producers.
+        """
+        self.generator = generator
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+
+        supported = generator._valid_utilities(generator.utilities)
+        missing = sorted(set(consumers) - set(supported))
+        if missing:
+            print(f"No support for {missing} utilities, not used after pipes")
+        producers = [ut for ut in generator._valid_utilities(producers or supported)
+                     if ut not in STDIN_ONLY]
+        consumers = [ut for ut in supported if ut in consumers]
+        nested = [ut for ut in generator._valid_utilities(list(nested))
+                  if generator.syntax[ut].endswith(FILE)]
+
+        nested_space = CommandSpace(generator, nested, drop_file=True)
+
+        self.producers = {ut: CommandSpace(generator, [ut]) for ut in producers}
+        if exec_nesting and 'find' in self.producers:
+            exec_space = ProductSpace([self.producers['find'],
+                                       CommandSpace(generator, nested, True, r" {} \;")],
+                                      " -exec ".join)
+            self.producers['find'] = UnionSpace([self.producers['find'], exec_space])
+
+        self.consumers = {}
+        for ut in consumers:
+            if ut == 'xargs':
+                self.consumers[ut] = ProductSpace([CommandSpace(generator, [ut]), nested_space],
+                                                  _fill_command)
+            else:
+                self.consumers[ut] = CommandSpace(generator, [ut], drop_file=ut in READS_STDIN)
+
+        self._producer_space = UnionSpace(list(self.producers.values()))
+        self._consumer_space = UnionSpace(list(self.consumers.values()))
+        self.depths = {}
+        for depth in range(min_depth, max_depth + 1):
+            self.depths[depth] = ProductSpace(
+                [self._producer_space] + [self._consumer_space] * (depth - 1), " | ".join)
+        self.space = UnionSpace(list(self.depths.values()))
+
+    def count_commands(self):
+        """Counts the pipelines that can be generated without generating them.
+
+        :returns (int) the exact number of pipelines `iter_commands` would generate.
+        """
+        return self.space.size
+
+    def iter_commands(self):
+        """Lazily generates every pipeline, shortest pipelines first.
+
+        :returns a generator of (str) piped commands.
+        """
+        return iter(self.space)
+
+    def command_at(self, index):
+        """Gets the pipeline at a given position of `iter_commands` without enumerating.
+
+        :param index: (int) the position of the pipeline.
+        :returns (str) the piped command.
+        """
+        if index < 0:
+            index += self.space.size
+        if not 0 <= index < self.space.size:
+            raise IndexError("pipeline index out of range")
+        return self.space[index]
+
+    def sample_commands(self, k, weights=None, depth_weights=None, rng=None):
+        """Samples distinct pipelines, uniformly or by utility weights.
+
+        Uniform samples are drawn by unranking random indices of the whole space. Weighted
+        samples first draw a depth, then a utility for every stage in proportion to its weight,
+        then a command of that utility uniformly.
+
+        :param k: (int) the number of pipelines to sample, at most the number of pipelines.
+        :param weights: (optional dict) mapping (str) utilities to (float) weights, e.g. their
+            counts in the training data. Utilities without a weight are never drawn.
+        :param depth_weights: (optional dict) mapping (int) depths to (float) weights, defaults
+            to equal weights for a weighted sample.
+        :param rng: (optional random.Random) the random number generator to use.
+        :returns (list) of (str) sampled piped commands.
+        """
+        rng = rng or random
+        if weights is None and depth_weights is None:
+            return [self.space[i] for i in _sample_indices(self.space.size, k, rng)]
+
+        weights = weights or {}
+        depth_weights = depth_weights or {d: 1 for d in self.depths}
+        depths = [d for d in self.depths if depth_weights.get(d, 0) > 0]
+        producers = [(ut, weights.get(ut, 1 if not weights else 0))
+                     for ut, space in self.producers.items() if space.size]
+        consumers = [(ut, weights.get(ut, 1 if not weights else 0))
+                     for ut, space in self.consumers.items() if space.size]
+        producers = [p for p in producers if p[1] > 0]
+        consumers = [c for c in consumers if c[1] > 0]
+        if not depths or not producers or (not consumers and max(depths) > 1):
+            raise ValueError("weights leave no pipelines to sample")
+
+        ret, seen, attempts = [], set(), 0
+        while len(ret) < k and attempts < 100 * k:
+            attempts += 1
+            depth = rng.choices(depths, [depth_weights[d] for d in depths])[0]
+            stages = [_choose(self.producers, producers, rng)]
+            stages += [_choose(self.consumers, consumers, rng) for _ in range(depth - 1)]
+            cmd = " | ".join(stages)
+            if cmd not in seen:
+                seen.add(cmd)
+                ret.append(cmd)
+        if len(ret) < k:
+            print(f"Unable to sample enough distinct pipelines, sampled {len(ret)}/{k}")
+        return ret
+
+
+def _fill_command(items):
+    """Substitutes a nested command into the "[Command]" operand of an xargs command."""
+    outer, inner = items
+    return outer.replace("[Command]", inner, 1) if "[Command]" in outer else f"{outer} {inner}"
+
+
+def _choose(spaces, weighted, rng):
+    """Draws a utility by weight, then one of its commands uniformly."""
+    ut = rng.choices([ut for ut, w in weighted], [w for ut, w in weighted])[0]
+    space = spaces[ut]
+    return space[rng.randrange(space.size)]
+
+
+def _product(parts):
+    """Iterates the product of several re-iterable spaces without materializing any of them."""
+    if len(parts) == 1:
+        for item in parts[0]:
+            yield [item]
+        return
+    for item in parts[0]:
+        for rest in _product(parts[1:]):
+            yield [item] + rest
+
+
+def _sample_indices(n, k, rng):
+    """Samples k distinct indices below n, even when n is too large for `random.sample`."""
+    if k > n:
+        raise ValueError("sample larger than the number of pipelines")
+    if 2 * k > n:
+        return rng.sample(range(n), k)
+    drawn = {}
+    while len(drawn) < k:
+        drawn.setdefault(rng.randrange(n), None)
+    return list(drawn)
@@ -0,0 +1,106 @@
+from corpus_stats import CorpusStats
+import collections
+import json
+import math
+
+
+def load_distribution(reference, top=None):
+    """Loads a reference distribution of utilities.
+
+    :param reference: (str) the path to a text file of commands, whose first utilities are
+        counted with the cached statistics of `CorpusStats`, or to a json file mapping utilities
+        to counts, or a (dict) / (Counter) of counts.
+    :param top: (optional int) the number of most common utilities to keep.
+    :returns (Counter) mapping (str) utilities to their counts.
+    """
+    if isinstance(reference, str):
+        if reference.endswith('.json'):
+            with open(reference) as fp:
+                counts = collections.Counter(json.load(fp))
+        else:
+            counts = CorpusStats([reference]).utility_counts()
+    else:
+        counts = collections.Counter(reference)
+
+    counts = collections.Counter({ut: count for ut, count in counts.items() if count > 0})
+    if top is not None:
+        counts = collections.Counter(dict(counts.most_common(top)))
+    return counts
+
+
+def apportion(weights, total):
+    """Splits a total into integer parts proportional to weights by the largest remainder method.
+
+    :param weights: (dict) mapping keys to (float) non negative weights.
+    :param total: (int) the total to split.
+    :returns (dict) mapping every key to its (int) part, the parts summing to the total.
+    """
+    weight_sum = sum(weights.values())
+    if not weight_sum:
+        return {key: 0 for key in weights}
+
+    exact = {key: total * w / weight_sum for key, w in weights.items()}
+    parts = {key: math.floor(x) for key, x in exact.items()}
+    left = total - sum(parts.values())
+    by_remainder = sorted(weights, key=lambda key: parts[key] - exact[key])
+    for key in by_remainder[:left]:
+        parts[key] += 1
+    return parts
+
+
+def allocate_quotas(weights, total, capacities):
+    """Allocates a number of commands to utilities in proportion to their weights.
+
+    Utilities whose share exceeds the number of commands they can generate are capped at their
+    capacity, and their shortfall is redistributed to the remaining utilities in proportion to
+    their weights, until every quota fits.
+
+    :param weights: (dict) mapping (str) utilities to (float) weights.
+    :param total: (int) the number of commands to allocate.
+    :param capacities: (dict) mapping (str) utilities to the (int) number of commands they can
+        generate, missing utilities cannot generate any.
+    :returns (dict) mapping every utility to its (int) quota.
+    """
+    quotas = {ut: 0 for ut in weights}
+    active = {ut: w for ut, w in weights.items() if w > 0 and capacities.get(ut, 0) > 0}
+    remaining = min(total, sum(capacities.get(ut, 0) for ut in active))
+
+    while active:
+        parts = apportion(active, remaining)
+        capped = [ut for ut, part in parts.items() if part >= capacities[ut]]
+        if not capped:
+            quotas.update(parts)
+            break
+        for ut in capped:
+            quotas[ut] = capacities[ut]
+            remaining -= capacities[ut]
+            del active[ut]
+    return quotas
+
+
+def distribution_report(weights, achieved, capacities=None):
+    """Compares a target distribution of utilities with the one achieved.
+
+    :param weights: (dict) mapping (str) utilities to their (float) target weights.
+    :param achieved: (dict) mapping (str) utilities to the (int) number of commands generated.
+    :param capacities: (optional dict) mapping (str) utilities to the (int) number of commands
+        they can generate.
+    :returns (dict) with the total number of commands generated, the total variation distance
+        between both distributions, and per utility the target and achieved shares.
+    """
+    weight_sum = sum(weights.values()) or 1
+    total = sum(achieved.values())
+
+    utilities = {}
+    for ut, w in sorted(weights.items(), key=lambda item: -item[1]):
+        count = achieved.get(ut, 0)
+        utilities[ut] = {
+            'target_share': w / weight_sum,
+            'achieved': count,
+            'achieved_share': count / total if total else 0.0,
+        }
+        if capacities is not None:
+            utilities[ut]['capacity'] = capacities.get(ut, 0)
+
+    distance = sum(abs(u['target_share'] - u['achieved_share']) for u in utilities.values()) / 2
+    return {'total': total, 'distance': distance, 'utilities': utilities}
@@ -0,0 +1,115 @@
+import json
+import multiprocessing
+import re
+import time
+
+
+class Replacer:
+    def __init__(self, reps, reverse=False):
+        """Compiles a word mapping into a single pass matcher.
+
+        Every key of the mapping is folded into one regular expression, tried longest first, so
+        each line is scanned once no matter how many keys there are. Placeholders such as "[File]"
+        are replaced wherever they appear, including inside quotes and after "=". Plain values,
+        as used when reversing the mapping, only match as whole words, optionally quoted or after
+        "=", so that "." does not match inside "temp.txt".
+
+        :param reps: (dict) mapping words to their replacements.
+        :param reverse: (bool) whether to reverse the direction of the mapping.
+        """
+        if reverse:
+            reps = {value: key for (key, value) in reps.items()}
+        self.reps = reps
+
+        placeholders = [k for k in reps if k.startswith('[') and k.endswith(']')]
+        words = [k for k in reps if k not in placeholders]
+
+        alternatives = []
+        if placeholders:
+            alternatives.append(_alternation(placeholders))
+        if words:
+            alternatives.append(r"""(?<![^\s'"=])""" + _alternation(words) + r"""(?![^\s'"])""")
+        self.pattern = re.compile("|".join(alternatives) or r"(?!)")
+
+    def replace(self, text):
+        """Replaces every mapped word in a string.
+
+        :param text: (str) any number of commands, separated by newlines.
+        :returns (str) the text with every mapped word replaced.
+        """
+        reps = self.reps
+        return self.pattern.sub(lambda m: reps[m.group(0)], text)
+
+    def replace_file(self, in_path, out_path, chunk_size=1 << 20, processes=1):
+        """Streams a file of commands through the matcher.
+
+        :param in_path: (str) the path of the text file of commands to convert.
+        :param out_path: (str) the path of the file to save the converted commands to.
+        :param chunk_size: (int) the approximate number of characters converted at a time.
+        :param processes: (int) the number of processes to convert chunks in parallel.
+        :returns (dict) with the number of lines converted, the seconds taken and lines/sec.
+        """
+        start = time.perf_counter()
+        lines, chunk = 0, ""
+        with open(in_path) as fin, open(out_path, 'w') as fout:
+            chunks = _read_chunks(fin, chunk_size)
+            if processes > 1:
+                pool = multiprocessing.Pool(processes, _init_worker, (self.reps,))
+                converted = pool.imap(_replace_chunk, chunks)
+            else:
+                pool = None
+                converted = map(self.replace, chunks)
+
+            try:
+                for chunk in converted:
+                    lines += chunk.count("\n")
+                    fout.write(chunk)
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+        if chunk and not chunk.endswith("\n"):
+            lines += 1
+
+        elapsed = time.perf_counter() - start
+        return {'lines': lines, 'seconds': elapsed,
+                'lines_per_sec': lines / elapsed if elapsed else 0}
+
+    @classmethod
+    def from_file(cls, rep_path, reverse=False):
+        """Builds a Replacer from a json file of word mappings.
+
+        :param rep_path: (str) the path to a json file with the word mappings.
+        :param reverse: (bool) whether to reverse the direction of the mapping.
+        :returns (Replacer) the compiled replacer.
+        """
+        with open(rep_path, 'r') as fp:
+            return cls(json.load(fp), reverse)
+
+
+def _alternation(words):
+    """Builds a regular expression matching any of the words, longest first."""
+    return "(?:" + "|".join(re.escape(w) for w in sorted(words, key=len, reverse=True)) + ")"
+
+
+def _read_chunks(fp, chunk_size):
+    """Reads a file in chunks of roughly chunk_size characters that end on a line boundary."""
+    while True:
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            return
+        if not chunk.endswith("\n"):
+            chunk += fp.readline()
+        yield chunk
+
+
+_worker_replacer = None
+
+
+def _init_worker(reps):
+    global _worker_replacer
+    _worker_replacer = Replacer(reps)
+
+
+def _replace_chunk(chunk):
+    return _worker_replacer.replace(chunk)
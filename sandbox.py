@@ -0,0 +1,135 @@
+import collections
+import os
+import selectors
+import signal
+import subprocess
+import time
+
+ExecutionResult = collections.namedtuple(
+    'ExecutionResult', ['code', 'timed_out', 'signal', 'wall_time', 'cpu_time', 'stdout', 'stderr',
+                        'truncated'])
+
+
+# ulimit options of the resource limits, the memory and file size ones in units of 1024 and 512
+# bytes as the shell expects them
+_ULIMITS = [('-t', 1), ('-v', 1024), ('-n', 1), ('-f', 512)]
+
+
+class Sandbox:
+    def __init__(self, cpu_seconds=5, memory_bytes=1 << 30, max_files=256,
+                 file_size_bytes=16 << 20, output_bytes=64 << 10, cwd=None, env=None):
+        """Initializes an execution backend running shell commands under resource limits.
+
+        Every command runs in a new session, so it leads its own process group. When the command
+        times out, or once its shell has exited, the whole group is killed, so grandchildren such
+        as "find -exec", "xargs" or "tail -f" do not outlive it. Limits are set with ulimit by a
+        shell that then execs the command's shell in place, so everything the command runs
+        inherits them, and the process is spawned without running Python code in the child.
+
+        :param cpu_seconds: (optional int) the RLIMIT_CPU of the command, in seconds.
+        :param memory_bytes: (optional int) the RLIMIT_AS of the command, in bytes.
+        :param max_files: (optional int) the RLIMIT_NOFILE of the command.
+        :param file_size_bytes: (optional int) the RLIMIT_FSIZE of the command, in bytes.
+        :param output_bytes: (int) the number of bytes of stdout and of stderr kept, the rest is
+            read and discarded.
+        :param cwd: (optional str) the directory to run commands in.
+        :param env: (optional dict) the environment to run commands with.
+        """
+        limits = [cpu_seconds, memory_bytes, max_files, file_size_bytes]
+        self.prefix = "".join(f"ulimit {opt} {value // unit} && "
+                              for (opt, unit), value in zip(_ULIMITS, limits) if value is not None)
+        self.output_bytes = output_bytes
+        self.cwd = cwd
+        self.env = env
+
+    def run(self, cmd, timeout=0.25, cwd=None):
+        """Runs a shell command to completion or until it times out.
+
+        :param cmd: (str) the command.
+        :param timeout: (float) the number of seconds the command may run before its process
+            group is killed.
+        :param cwd: (optional str) the directory to run the command in, overriding the sandbox's.
+        :returns (ExecutionResult) with the exit code (the negated signal number when killed by
+            a signal), whether it timed out, the signal that ended it, its wall and CPU time in
+            seconds, its bounded stdout and stderr, and whether either was truncated.
+        """
+        start = time.perf_counter()
+        deadline = time.monotonic() + timeout
+        args = ['/bin/sh', '-c', self.prefix + 'exec /bin/sh -c "$0"', cmd] if self.prefix \
+            else ['/bin/sh', '-c', cmd]
+        proc = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, cwd=cwd or self.cwd, env=self.env,
+                                start_new_session=True)
+
+        out = {proc.stdout: bytearray(), proc.stderr: bytearray()}
+        truncated, timed_out = False, False
+        pidfd = _pidfd_open(proc.pid)
+        with selectors.DefaultSelector() as sel:
+            for fp in out:
+                sel.register(fp, selectors.EVENT_READ)
+            if pidfd is not None:
+                sel.register(pidfd, selectors.EVENT_READ)
+
+            def read(wait):
+                nonlocal truncated
+                events = sel.select(wait)
+                for key, _ in events:
+                    if key.fileobj not in out:
+                        continue
+                    chunk = os.read(key.fd, 65536)
+                    if not chunk:
+                        sel.unregister(key.fileobj)
+                        continue
+                    buf = out[key.fileobj]
+                    keep = max(0, self.output_bytes - len(buf))
+                    truncated |= len(chunk) > keep
+                    buf += chunk[:keep]
+                return events
+
+            # without a pidfd to wake up on, check on the shell at least every 10ms
+            cap = None if pidfd is not None else 0.01
+            while not _exited(proc.pid):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    timed_out = True
+                    break
+                read(remaining if cap is None else min(remaining, cap))
+
+            # the shell is not reaped yet, so its process group id cannot have been reused
+            _kill_group(proc.pid)
+            _, status, usage = os.wait4(proc.pid, 0)
+            if pidfd is not None:
+                sel.unregister(pidfd)
+                os.close(pidfd)
+            while sel.get_map() and read(0.05):
+                pass
+
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        for fp in out:
+            fp.close()
+
+        sig = -proc.returncode if proc.returncode < 0 else None
+        return ExecutionResult(proc.returncode, timed_out, sig, time.perf_counter() - start,
+                               usage.ru_utime + usage.ru_stime, bytes(out[proc.stdout]),
+                               bytes(out[proc.stderr]), truncated)
+
+
+def _pidfd_open(pid):
+    """Opens a file descriptor that becomes readable when a process exits, where supported."""
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+
+def _kill_group(pgid):
+    """Kills every process left in a process group."""
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _exited(pid):
+    """Checks whether a child process has exited, without reaping it."""
+    return os.waitid(os.P_PID, pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
@@ -1,20 +1,357 @@
 import requests
 from bs4 import BeautifulSoup
+from corpus_stats import CorpusStats
+from metrics import METRICS, Progress
 from utils import UTILITIES, TYPE_MAPS, ARG_TYPES, MANUAL_SYNTAX_INSERTS
+import concurrent.futures
+import gzip
+import hashlib
 import json
+import os
+import re
 from pprint import pprint
 
+MAN7_URL = 'https://man7.org/linux/man-pages/man1/{utility}.{section}.html'
+
+
+def parse_html_page(html):
+    """Extracts the synopsis line and flag definition lines from a man7.org man page.
+
+    :param html: (str) the html of the man page.
+    :returns (tuple) of the (str) synopsis line and the (set) of (str) lines defining flags.
+    """
+    with METRICS.timer('scraper_parse_seconds'):
+        soup = BeautifulSoup(html, features='lxml')
+        pres = [pre.text for pre in soup.find_all('pre')]
+
+    synopsis = pres[2].split('\n')[1].strip()
+
+    options = "\n".join(pres[3:])
+    stripped_options = [line.strip() for line in options.split('\n')]
+    flag_lines = set(filter(lambda x: x and x[0] == "-", stripped_options))
+    return synopsis, flag_lines
+
+
+class HTTPPageSource:
+    def __init__(self, cache_dir=None, workers=8, timeout=30, url=MAN7_URL):
+        """Initializes a source of man pages fetched from man7.org or a mirror of it.
+
+        Pages are fetched concurrently over one pooled session. With a cache directory, every
+        page is stored on disk along with its ETag and Last-Modified headers, and later scrapes
+        only download pages the server reports as changed.
+
+        :param cache_dir: (optional str) a directory to cache fetched pages in.
+        :param workers: (int) the number of pages to fetch at once.
+        :param timeout: (float) the number of seconds to wait for each response.
+        :param url: (str) the page URL template, with {utility} and {section} fields.
+        """
+        self.url = url
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def iter_pages(self, utilities):
+        """Fetches and parses the man pages of a list of utilities.
+
+        :param utilities: (list) of (str) utilities.
+        :returns a generator of (tuple) of the utility, its synopsis line and its set of flag
+            lines, in the order of the utilities. Both are None for utilities without a page.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for utility, html in zip(utilities, pool.map(self.fetch, utilities)):
+                yield (utility, *parse_html_page(html)) if html else (utility, None, None)
+
+    def fetch(self, utility):
+        """Fetches the html of the man page of a utility.
+
+        :param utility: (str) the utility.
+        :returns (str) the html of the page, or None if it has no page.
+        """
+        for section in (1, 2):
+            html = self._get(self.url.format(utility=utility, section=section))
+            if html is not None:
+                return html
+        return None
+
+    def _get(self, url):
+        """Gets a page, revalidating and updating its cached copy when caching is enabled."""
+        headers, cached = {}, None
+        if self.cache_dir:
+            path = os.path.join(self.cache_dir, hashlib.sha1(url.encode()).hexdigest())
+            if os.path.exists(path + '.json'):
+                with open(path + '.json') as fp:
+                    meta = json.load(fp)
+                with open(path + '.html') as fp:
+                    cached = fp.read()
+                if meta.get('etag'):
+                    headers['If-None-Match'] = meta['etag']
+                if meta.get('last_modified'):
+                    headers['If-Modified-Since'] = meta['last_modified']
+
+        with METRICS.timer('scraper_fetch_seconds'):
+            r = self.session.get(url, headers=headers, timeout=self.timeout)
+        METRICS.inc('scraper_responses_total', status=r.status_code)
+        if r.status_code == 304 and cached is not None:
+            return cached
+        if r.status_code != 200:
+            return None
+
+        if self.cache_dir:
+            with open(path + '.html', 'w') as fp:
+                fp.write(r.text)
+            with open(path + '.json', 'w') as fp:
+                json.dump({'url': url, 'etag': r.headers.get('ETag'),
+                           'last_modified': r.headers.get('Last-Modified')}, fp)
+        return r.text
+
+
+class FixturePageSource:
+    def __init__(self, directory):
+        """Initializes a source of man pages stored on disk, to scrape without a network.
+
+        :param directory: (str) a directory of pages named like "find.1.html" or "find.2.html".
+        """
+        self.directory = directory
+
+    def iter_pages(self, utilities):
+        """Reads and parses the stored man pages of a list of utilities.
+
+        :param utilities: (list) of (str) utilities.
+        :returns a generator of (tuple) of the utility, its synopsis line and its set of flag
+            lines, in the order of the utilities. Both are None for utilities without a page.
+        """
+        for utility in utilities:
+            html = self.fetch(utility)
+            yield (utility, *parse_html_page(html)) if html else (utility, None, None)
+
+    def fetch(self, utility):
+        """Reads the stored html of the man page of a utility.
+
+        :param utility: (str) the utility.
+        :returns (str) the html of the page, or None if it has no page.
+        """
+        for section in (1, 2):
+            path = os.path.join(self.directory, f'{utility}.{section}.html')
+            if os.path.exists(path):
+                with open(path) as fp:
+                    return fp.read()
+        return None
+
+
+class LocalManPageSource:
+    def __init__(self, man_dir='/usr/share/man', section='1', processes=None):
+        """Initializes a source of the groff man pages installed on this machine.
+
+        Pages are rendered to plain text with a small groff interpreter that understands the
+        font and paragraph macros man pages use, so no man or groff binary is needed. Pages are
+        read and parsed in a process pool.
+
+        :param man_dir: (str) the root directory of the installed man pages.
+        :param section: (str) the manual section to read pages from.
+        :param processes: (optional int) the number of processes to parse pages in. Defaults to
+            the number of CPUs.
+        """
+        self.man_dir = man_dir
+        self.section = section
+        self.processes = processes
+
+    def installed_utilities(self):
+        """Lists every utility with a page installed in the section.
+
+        :returns (list) of (str) utilities, sorted by name.
+        """
+        directory = os.path.join(self.man_dir, f'man{self.section}')
+        suffixes = [f'.{self.section}', f'.{self.section}.gz']
+        ret = set()
+        for name in os.listdir(directory):
+            for suffix in suffixes:
+                if name.endswith(suffix):
+                    ret.add(name[:-len(suffix)])
+        return sorted(ret)
+
+    def iter_pages(self, utilities):
+        """Reads and parses the installed man pages of a list of utilities.
+
+        :param utilities: (list) of (str) utilities.
+        :returns a generator of (tuple) of the utility, its synopsis line and its set of flag
+            lines, in the order of the utilities. Both are None for utilities without a page.
+        """
+        paths = [self.page_path(utility) for utility in utilities]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.processes) as pool:
+            for utility, page in zip(utilities, pool.map(_parse_local_page, paths, chunksize=8)):
+                yield (utility, *page) if page else (utility, None, None)
+
+    def page_path(self, utility):
+        """Finds the file holding the man page of a utility.
+
+        :param utility: (str) the utility.
+        :returns (str) the path of the page, or None if it is not installed.
+        """
+        for suffix in ('', '.gz'):
+            path = os.path.join(self.man_dir, f'man{self.section}',
+                                f'{utility}.{self.section}{suffix}')
+            if os.path.exists(path):
+                return path
+        return None
+
+
+def parse_groff_page(source):
+    """Extracts the synopsis line and flag definition lines from a groff man page.
+
+    :param source: (str) the groff source of the man page.
+    :returns (tuple) of the (str) synopsis line and the (set) of (str) lines defining flags, or
+        None if the page has no synopsis.
+    """
+    sections = {}
+    for title, lines in _render_groff(source):
+        sections.setdefault(title, []).extend(lines)
+
+    synopsis = [line for line in sections.get('SYNOPSIS', []) if line.strip()]
+    if not synopsis:
+        return None
+
+    flag_lines = set()
+    for title, lines in sections.items():
+        if title not in ('NAME', 'SYNOPSIS'):
+            flag_lines.update(line.strip() for line in lines if line.strip()[:1] == '-')
+    return synopsis[0].strip(), flag_lines
+
+
+def _parse_local_page(path):
+    """Reads and parses an installed man page, following ".so" links to other pages."""
+    if path is None:
+        return None
+
+    for _ in range(3):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', errors='replace') as fp:
+            source = fp.read()
+        link = re.match(r'\.so\s+(\S+)', source)
+        if not link:
+            return parse_groff_page(source)
+
+        # links are relative to the root of the man directory
+        root = os.path.dirname(os.path.dirname(path))
+        path = os.path.join(root, link.group(1))
+        if not os.path.exists(path) and os.path.exists(path + '.gz'):
+            path += '.gz'
+    return None
+
+
+GROFF_ESCAPES = [
+    (re.compile(r'\\f(\[[^\]]*\]|\(..|.)'), ''),
+    (re.compile(r'\\\((em|en|hy)'), '-'),
+    (re.compile(r'\\\((aq|cq|oq)'), "'"),
+    (re.compile(r'\\\((dq|lq|rq)'), '"'),
+    (re.compile(r'\\\(..'), ''),
+    (re.compile(r'\\[-]'), '-'),
+    (re.compile(r'\\[e\\]'), '\\\\'),
+    (re.compile(r'\\[ ~0]'), ' '),
+    (re.compile(r'\\[&,/|^%:]'), ''),
+    (re.compile(r'\\\*\(..|\\\*.'), ''),
+]
+BREAK_MACROS = {'br', 'sp', 'PP', 'P', 'LP', 'TP', 'IP', 'HP', 'RS', 'RE', 'SH', 'SS', 'nf', 'fi',
+                'TQ', 'EX', 'EE', 'in', 'ti'}
+FONT_MACROS = {'B', 'I', 'SM', 'SB', 'BI', 'BR', 'IB', 'IR', 'RB', 'RI'}
+
+
+def _unescape(text):
+    """Removes groff font changes and converts special characters to plain text."""
+    for pattern, repl in GROFF_ESCAPES:
+        text = pattern.sub(repl, text)
+    return text
+
+
+def _macro_args(text):
+    """Splits the arguments of a groff macro, honouring double quotes."""
+    # macro arguments are read in copy mode, where an escaped backslash is a single backslash
+    return [(quoted if quoted else plain).replace('\\\\', '\\')
+            for quoted, plain in re.findall(r'"((?:[^"]|"")*)"|(\S+)', text)]
+
+
+def _render_groff(source):
+    """Renders a groff man page into plain text lines grouped by section.
+
+    Text is filled into one line per paragraph, like man7.org renders it before wrapping, and
+    the tag of every ".TP" and ".IP" paragraph gets a line of its own.
+
+    :param source: (str) the groff source of the man page.
+    :returns a generator of (tuple) of the (str) section title and (list) of (str) lines.
+    """
+    title, lines, current, tag_next = None, [], [], False
+
+    def flush():
+        if current:
+            lines.append(" ".join(current))
+            current.clear()
+
+    # a backslash at the end of a line continues it on the next line
+    source = re.sub(r'(?<!\\)\\\n', '', source)
+
+    for raw in source.split('\n'):
+        if raw.startswith(('.\\"', "'\\\"", '\\"')):
+            continue
+
+        if raw[:1] in ('.', "'"):
+            parts = raw[1:].strip().split(None, 1)
+            if not parts:
+                continue
+            macro, rest = parts[0], parts[1] if len(parts) > 1 else ''
+
+            if macro in BREAK_MACROS:
+                flush()
+            if macro == 'SH':
+                if title is not None:
+                    yield title, lines
+                title, lines = _unescape(" ".join(_macro_args(rest))).upper(), []
+            elif macro == 'TP':
+                tag_next = True
+            elif macro == 'IP' and rest:
+                lines.append(_unescape(_macro_args(rest)[0]))
+            elif macro in FONT_MACROS:
+                args = _macro_args(rest)
+                joiner = " " if macro in ('B', 'I', 'SM', 'SB') else ""
+                current.append(_unescape(joiner.join(args)))
+                if tag_next:
+                    flush()
+                    tag_next = False
+            continue
+
+        text = _unescape(raw).strip()
+        if not text:
+            flush()
+            continue
+        current.append(text)
+        if tag_next:
+            flush()
+            tag_next = False
+
+    flush()
+    if title is not None:
+        yield title, lines
+
 
 class WebScraper:
-    def __init__(self, utilities=None):
+    def __init__(self, utilities=None, source=None):
         """Initializes the WebScraper class to scrape for a given list of utilities.
 
         :param utilities: (list) a list of utilities to scrape for. Defaults to list from utils.py.
+        :param source: (optional) where to read man pages from, e.g. a FixturePageSource or a
+            LocalManPageSource. Defaults to fetching them from man7.org with an HTTPPageSource.
         """
         if utilities is None:
             utilities = UTILITIES
 
         self.utilities = utilities
+        self.source = source
         self.descs = {}
         self.data = {}
         self.relevant_flags = {}
@@ -23,13 +360,13 @@ class WebScraper:
         """Saves all of the flags included in the original training set to the class instance.
 
         This method takes note of all of the flags used in the training data to help limit the
-        use of rare and unnecessary flags in the bash generator.
+        use of rare and unnecessary flags in the bash generator. Flags are read from the cached
+        statistics of `CorpusStats`, including the ones after a pipe, without their values.
 
         :param path: (str) the file path for the original training data.
         """
 
-        with open(path) as fp:
-            self.relevant_flags = set(fp.read().replace('\n', ' ').split(' '))
+        self.relevant_flags = CorpusStats([path]).flags()
 
     def is_relevant(self, flag):
         """Returns whether or not a flag is relevant enough to be incorporated in bash generation.
@@ -50,49 +387,39 @@ class WebScraper:
     def extract_utilities(self):
         """Extracts all of the utility information from the man pages."""
 
-        print(f"Scraping the internet for {len(self.utilities)} utilities, this may take some "
+        print(f"Scraping man pages for {len(self.utilities)} utilities, this may take some "
               f"time ...")
 
         # lists to keep track of utilities with unknown man pages or syntax structures
         no_page_uts, no_syntax_uts = [], []
         successful_searches = []
 
-        for utility in self.utilities:
-            utility_url = f'https://man7.org/linux/man-pages/man1/{utility}.1.html'
-            r = requests.get(utility_url)
-
-            # search different man pages for utility description if needed
-            if r.status_code != 200:
-                utility_url = f'https://man7.org/linux/man-pages/man1/{utility}.2.html'
-                r = requests.get(utility_url)
-
-            if r.status_code == 200:
-                soup = BeautifulSoup(r.text, features='lxml')
-                desc = soup.find_all('pre')[2].text
-
-                syntax = WebScraper._generate_syntax(utility, desc.split('\n')[1].strip())
-                if not syntax:
-                    if utility in MANUAL_SYNTAX_INSERTS:
-                        # manually insert syntax structure for given utility
-                        self.descs[utility] = MANUAL_SYNTAX_INSERTS[utility]
-                        successful_searches.append(utility)
-                    else:
-                        no_syntax_uts.append(utility)
-                elif utility:
-                    self.descs[utility] = syntax
-                    successful_searches.append(utility)
-
-                # build options
-                pre_len = len(soup.find_all('pre'))
-                options = "\n".join([soup.find_all('pre')[i].text for i in range(3, pre_len)])
-                stripped_options = [line.strip() for line in options.split('\n')]
-                flag_lines = list(filter(lambda x: x and x[0] == "-", stripped_options))
-
-                d = set(flag for flag in flag_lines)
-
-                self._clean_and_insert_flags(utility, d)
-            else:
+        source = self.source or HTTPPageSource()
+        progress = Progress("scrape", total=len(self.utilities))
+        for utility, synopsis, flag_lines in source.iter_pages(self.utilities):
+            progress.update()
+            if synopsis is None:
+                METRICS.inc('scraper_utilities_total', outcome='no_page')
                 no_page_uts.append(utility)
+                continue
+
+            syntax = WebScraper._generate_syntax(utility, synopsis)
+            if not syntax:
+                if utility in MANUAL_SYNTAX_INSERTS:
+                    # manually insert syntax structure for given utility
+                    self.descs[utility] = MANUAL_SYNTAX_INSERTS[utility]
+                    successful_searches.append(utility)
+                else:
+                    METRICS.inc('scraper_utilities_total', outcome='no_syntax')
+                    no_syntax_uts.append(utility)
+            elif utility:
+                self.descs[utility] = syntax
+                successful_searches.append(utility)
+
+            # build options
+            self._clean_and_insert_flags(utility, flag_lines)
+            METRICS.inc('scraper_flags_total', len(self.data[utility]), utility=utility)
+        progress.close()
 
         self.convert_flag_types()
         self.data['find -L'] = self.data['find']  # specific behavior for find command
@@ -0,0 +1,195 @@
+from generator import Generator
+import argparse
+import bisect
+import collections
+import concurrent.futures
+import json
+import random
+
+# number of consecutive option space indices per block, the unit shards are made of
+BLOCK_SIZE = 4096
+
+
+def shard_blocks(generator, shard, shards, max_commands=None, utilities=None,
+                 block_size=BLOCK_SIZE, seed=0):
+    """Partitions the option spaces of utilities into blocks and picks those of one shard.
+
+    The option space of every utility is cut into blocks of block_size consecutive indices, and
+    each block holds the commands of its utility's sample that fall into it, see
+    `sample_indices`. The blocks of all utilities, in order, are then split into shards
+    contiguous runs of about the same number of commands. Blocks do not depend on the number of
+    shards, so concatenating the shards restores the full order.
+
+    :param generator: (Generator) the generator providing the option spaces.
+    :param shard: (int) the index of the shard, from 0 to shards - 1.
+    :param shards: (int) the number of shards.
+    :param max_commands: (optional int) the maximum number of commands per utility.
+    :param utilities: (optional list) of (str) utilities, defaults to every generator utility.
+    :param block_size: (int) the number of option space indices per block.
+    :param seed: (int) the seed of the run.
+    :returns (list) of (str, int, int, int, int) tuples of the utility, the block number, the
+        first and last (exclusive) option space index and the number of commands of each block
+        of the shard.
+    """
+    if not 0 <= shard < shards:
+        raise ValueError(f"shard {shard} out of range for {shards} shards")
+
+    blocks = []
+    for ut in generator._valid_utilities(utilities or generator.utilities):
+        size = len(generator.option_space(ut))
+        indices = sample_indices(ut, size, seed, max_commands)
+        counts = collections.Counter(index // block_size for index in indices) \
+            if indices is not None else None
+        for block, start in enumerate(range(0, size, block_size)):
+            end = min(size, start + block_size)
+            count = counts[block] if counts is not None else end - start
+            if count:
+                blocks.append((ut, block, start, end, count))
+
+    total = sum(block[-1] for block in blocks)
+    lo, hi = shard * total / shards, (shard + 1) * total / shards
+    ret, done = [], 0
+    for block in blocks:
+        if lo <= done < hi or (shard == shards - 1 and done >= hi):
+            ret.append(block)
+        done += block[-1]
+    return ret
+
+
+def sample_indices(utility, size, seed, max_commands=None):
+    """Samples the option space indices of a utility uniformly, the same way in every shard.
+
+    The sample is drawn over the whole option space by one random number generator seeded by
+    the seed and the utility, so it matches the sample of an unsharded run and every shard can
+    draw it on its own.
+
+    :param utility: (str) the utility.
+    :param size: (int) the size of the option space of the utility.
+    :param seed: (int) the seed of the run.
+    :param max_commands: (optional int) the number of indices to sample.
+    :returns (list) of (int) the sorted sampled indices, or None when every index is kept.
+    """
+    if not max_commands or max_commands >= size:
+        return None
+    rng = random.Random(f"{seed}/{utility}")
+    if 2 * max_commands > size:
+        return sorted(rng.sample(range(size), max_commands))
+    drawn = set()
+    while len(drawn) < max_commands:
+        drawn.add(rng.randrange(size))
+    return sorted(drawn)
+
+
+def iter_shard(generator, shard, shards, seed=0, max_commands=None, utilities=None,
+               block_size=BLOCK_SIZE):
+    """Lazily generates the commands of one shard.
+
+    Without max_commands, every command of the shard's blocks is generated in order. Otherwise
+    every utility samples max_commands indices uniformly from its whole option space with
+    `sample_indices`, and each block generates the sampled indices that fall into it. The
+    sample never depends on the shards, so any number of shards together generate exactly the
+    commands of a single shard.
+
+    :param generator: (Generator) the generator providing the option spaces.
+    :param shard: (int) the index of the shard, from 0 to shards - 1.
+    :param shards: (int) the number of shards.
+    :param seed: (int) the seed of the run.
+    :param max_commands: (optional int) the maximum number of commands per utility.
+    :param utilities: (optional list) of (str) utilities, defaults to every generator utility.
+    :param block_size: (int) the number of option space indices per block.
+    :returns a generator of (str) commands.
+    """
+    samples = {}
+    for ut, block, start, end, count in shard_blocks(generator, shard, shards, max_commands,
+                                                     utilities, block_size, seed):
+        space = generator.option_space(ut)
+        if count == end - start:
+            indices = range(start, end)
+        else:
+            if ut not in samples:
+                samples[ut] = sample_indices(ut, len(space), seed, max_commands)
+            sampled = samples[ut]
+            indices = sampled[bisect.bisect_left(sampled, start):bisect.bisect_left(sampled, end)]
+        for index in indices:
+            yield generator.grammar.render(ut, space[index])
+
+
+def write_shard(generator, shard, shards, out_path, **kwargs):
+    """Writes the commands of one shard to a file, one command per line.
+
+    Every command, including the last one, ends with a newline, so the shard files of a run
+    concatenated in shard order are byte for byte the file of a single shard run.
+
+    :param generator: (Generator) the generator providing the option spaces.
+    :param shard: (int) the index of the shard, from 0 to shards - 1.
+    :param shards: (int) the number of shards.
+    :param out_path: (str) the path of the file to write the commands to.
+    :param kwargs: the other arguments of `iter_shard`.
+    :returns (int) the number of commands written.
+    """
+    count = 0
+    with open(out_path, 'w') as fp:
+        for cmd in iter_shard(generator, shard, shards, **kwargs):
+            fp.write(cmd + "\n")
+            count += 1
+    return count
+
+
+def generate_sharded(out_pattern, shards, processes=None, syntax_path='syntax.json',
+                     map_path='utility_map.json', grammar_path=None, **kwargs):
+    """Generates every shard of a run in a pool of processes.
+
+    :param out_pattern: (str) the path of the shard files, with a "{shard}" field, e.g.
+        "cmds.{shard}.txt".
+    :param shards: (int) the number of shards.
+    :param processes: (optional int) the number of processes, defaults to the number of CPUs.
+    :param syntax_path: (str) A file path to retrieve syntax structure.
+    :param map_path: (str) A file path to retrieve utility, flag, arg mappings.
+    :param grammar_path: (optional str) A file path to a compiled grammar.
+    :param kwargs: the other arguments of `iter_shard`.
+    :returns (list) of (str) the paths of the shard files, in shard order.
+    """
+    paths = [out_pattern.format(shard=shard) for shard in range(shards)]
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        futures = [pool.submit(_write_shard, (syntax_path, map_path, grammar_path), shard, shards,
+                               path, kwargs) for shard, path in enumerate(paths)]
+        for shard, future in enumerate(futures):
+            print(f"Generated {future.result()} commands for shard {shard}/{shards}")
+    return paths
+
+
+def _write_shard(generator_args, shard, shards, out_path, kwargs):
+    """Builds a generator in a worker process and writes one shard with it."""
+    syntax_path, map_path, grammar_path = generator_args
+    generator = Generator(syntax_path, map_path, grammar_path=grammar_path)
+    return write_shard(generator, shard, shards, out_path, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate one or every shard of a command set.")
+    parser.add_argument('out', help="shard file path, with a {shard} field for --all")
+    parser.add_argument('--shard', type=int, default=0)
+    parser.add_argument('--shards', type=int, default=1)
+    parser.add_argument('--all', action='store_true', help="generate every shard in processes")
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-commands', type=int)
+    parser.add_argument('--utilities', nargs='+')
+    parser.add_argument('--syntax', default='syntax.json')
+    parser.add_argument('--map', default='utility_map.json')
+    parser.add_argument('--grammar')
+    args = parser.parse_args()
+
+    kwargs = dict(seed=args.seed, max_commands=args.max_commands, utilities=args.utilities)
+    if args.all:
+        paths = generate_sharded(args.out, args.shards, args.processes, args.syntax, args.map,
+                                 args.grammar, **kwargs)
+        print(json.dumps(paths, indent=2))
+    else:
+        generator = Generator(args.syntax, args.map, grammar_path=args.grammar)
+        count = write_shard(generator, args.shard, args.shards, args.out, **kwargs)
+        print(f"Generated {count} commands for shard {args.shard}/{args.shards}")
+
+
+if __name__ == '__main__':
+    main()
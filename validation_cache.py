@@ -0,0 +1,133 @@
+import hashlib
+import json
+import sqlite3
+import time
+
+
+class ValidationCache:
+    def __init__(self, path='validation_cache.db', fixture_version='', max_entries=None):
+        """Initializes an on-disk cache of command validation results.
+
+        Results are keyed by a hash of the concrete command, the fixture environment version,
+        sudo mode and timeout. Opening the cache with a different fixture version than it was
+        last used with invalidates every stored result, since commands may behave differently
+        against different fixture files.
+
+        :param path: (str) the path to the SQLite database holding the cache.
+        :param fixture_version: (str) an identifier of the environment commands are run in.
+        :param max_entries: (optional int) the maximum number of results to keep. The least
+            recently used results are evicted first when the cache is closed.
+        """
+        self.path = path
+        self.fixture_version = fixture_version
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+
+        self.conn = sqlite3.connect(path)
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(results)")]
+        if columns and 'cpu_time' not in columns:
+            # results stored before signals and CPU times were kept cannot be completed
+            self.conn.execute("DROP TABLE results")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, code INTEGER, "
+                          "duration REAL, timed_out INTEGER, last_used REAL, signal INTEGER, "
+                          "cpu_time REAL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+
+        row = self.conn.execute("SELECT value FROM meta WHERE name = 'fixture_version'").fetchone()
+        if row is None or row[0] != fixture_version:
+            self.invalidate()
+        self.conn.commit()
+
+    def key(self, cmd, sudo=False, timeout=0.25):
+        """Gets the cache key of a command run under particular conditions.
+
+        :param cmd: (str) the concrete command.
+        :param sudo: (bool) whether the command runs as a root user.
+        :param timeout: (float) the number of seconds the command may run for.
+        :returns (str) a hex digest identifying the command and its run conditions.
+        """
+        ident = json.dumps([cmd, self.fixture_version, bool(sudo), timeout])
+        return hashlib.sha256(ident.encode()).hexdigest()
+
+    def get(self, cmd, sudo=False, timeout=0.25):
+        """Looks up the stored validation result of a command.
+
+        :param cmd: (str) the concrete command.
+        :param sudo: (bool) whether the command runs as a root user.
+        :param timeout: (float) the number of seconds the command may run for.
+        :returns (tuple) of the exit code, duration, timeout flag, signal and CPU time, or None if
+            not cached.
+        """
+        key = self.key(cmd, sudo, timeout)
+        row = self.conn.execute("SELECT code, duration, timed_out, signal, cpu_time FROM results "
+                                "WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+        return row[0], row[1], bool(row[2]), row[3], row[4]
+
+    def put(self, cmd, code, duration, timed_out, sudo=False, timeout=0.25, signal=None,
+            cpu_time=None):
+        """Stores the validation result of a command.
+
+        :param cmd: (str) the concrete command.
+        :param code: (int) or (None) the exit code of the command.
+        :param duration: (float) the number of seconds the command ran for.
+        :param timed_out: (bool) whether the command was killed for running too long.
+        :param sudo: (bool) whether the command ran as a root user.
+        :param timeout: (float) the number of seconds the command was allowed to run for.
+        :param signal: (optional int) the signal that ended the command.
+        :param cpu_time: (optional float) the number of CPU seconds the command used.
+        """
+        self.conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          (self.key(cmd, sudo, timeout), code, duration, int(timed_out),
+                           time.time(), signal, cpu_time))
+        self.stored += 1
+        if self.stored % 1000 == 0:
+            self.conn.commit()
+
+    def invalidate(self):
+        """Removes every stored result and ties the cache to the current fixture version."""
+        self.conn.execute("DELETE FROM results")
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('fixture_version', ?)",
+                          (self.fixture_version,))
+
+    def evict(self):
+        """Removes the least recently used results beyond max_entries."""
+        if self.max_entries is None:
+            return
+        self.conn.execute("DELETE FROM results WHERE key IN (SELECT key FROM results "
+                          "ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def stats(self):
+        """Gets the hit and miss statistics of the cache since it was opened.
+
+        :returns (dict) with the number of hits, misses, stored results and the hit rate.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stored': self.stored,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        """Evicts stale results and writes all pending changes to disk."""
+        self.evict()
+        self.conn.commit()
+        self.conn.close()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()